@@ -0,0 +1,381 @@
+"""
+AI-CARE Lung - 標註一致性分析模組
+================================
+功能：
+1. 依訊息彙整多位標註者的標籤（來源：對話儲存的 annotator_labels，或標註者交回的檔案）
+2. 每種標籤（意圖 / 情緒 / 緊急程度）轉為整數陣列 (訊息, 標註者, 類別)
+3. Fleiss' kappa：訊息 × 類別計數矩陣一次 bincount 求得（每則訊息的標註人數可不同）
+4. Cohen's kappa：每對標註者以排序交集找出共同訊息，bincount 建立混淆矩陣
+5. 列出一致性最低的訊息供仲裁
+
+    python annotation_agreement.py [labels/*.jsonl] [--from-store] [--limit 50] [--flagged flagged.jsonl]
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from itertools import combinations
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Tuple
+
+import numpy as np
+
+# ============================================
+# 設定
+# ============================================
+
+# 分析的標籤：標註者標籤中的鍵 → 報告名稱
+LABEL_TYPES = {
+    "intent": "annotated_intent",
+    "emotion": "annotated_emotion",
+    "urgency": "annotated_urgency",
+}
+
+# 一對標註者至少共同標註幾則訊息才計算 Cohen's kappa
+DEFAULT_MIN_OVERLAP = 20
+
+# 報告列出的低一致性訊息數
+DEFAULT_FLAG_LIMIT = 50
+
+# (message_id, 標註者 → 標籤)
+LabeledMessage = Tuple[str, Dict[str, Dict[str, Any]]]
+
+
+# ============================================
+# 資料來源
+# ============================================
+
+def iter_store_labels(store) -> Iterator[LabeledMessage]:
+    """對話儲存中有多位標註者標籤的訊息"""
+    return store.iter_annotator_labels()
+
+
+def iter_file_labels(paths: List[str]) -> Iterator[LabeledMessage]:
+    """
+    標註者交回的檔案（格式與標註回匯相同）
+
+    同一標註者對同一訊息重複交回時以後者為準；無效紀錄略過
+    """
+    from annotation_import import iter_annotation_records, parse_label
+
+    grouped: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for path in paths:
+        for _, record in iter_annotation_records(path):
+            try:
+                parsed = parse_label(record)
+            except ValueError:
+                continue
+            if parsed is not None:
+                message_id, annotator_id, label = parsed
+                grouped.setdefault(message_id, {})[annotator_id] = label
+    return iter(grouped.items())
+
+
+# ============================================
+# kappa
+# ============================================
+
+def kappa_from_confusion(confusion: np.ndarray) -> Tuple[float, float]:
+    """
+    混淆矩陣 → (Cohen's kappa, 觀察一致率)
+
+    兩位標註者只用到同一個類別時期望一致率為 1，kappa 定義為 1.0（完全一致）
+    """
+    total = confusion.sum()
+    if total == 0:
+        return float("nan"), float("nan")
+    observed = np.trace(confusion) / total
+    expected = float(confusion.sum(axis=1) @ confusion.sum(axis=0)) / (total * total)
+    if expected >= 1.0:
+        return 1.0, float(observed)
+    return float((observed - expected) / (1.0 - expected)), float(observed)
+
+
+def fleiss_kappa(counts: np.ndarray) -> Tuple[float, float, np.ndarray]:
+    """
+    訊息 × 類別計數矩陣 → (Fleiss' kappa, 平均一致率, 各訊息一致率)
+
+    只計入至少兩位標註者的訊息；各訊息標註人數可不同
+    （P_i = Σ n_ij(n_ij - 1) / n_i(n_i - 1)）
+    """
+    raters = counts.sum(axis=1)
+    counts = counts[raters >= 2]
+    raters = raters[raters >= 2]
+    if not len(raters):
+        return float("nan"), float("nan"), np.empty(0)
+
+    per_item = (counts * (counts - 1)).sum(axis=1) / (raters * (raters - 1))
+    observed = per_item.mean()
+    proportions = counts.sum(axis=0) / raters.sum()
+    expected = float(proportions @ proportions)
+    if expected >= 1.0:
+        return 1.0, float(observed), per_item
+    return float((observed - expected) / (1.0 - expected)), float(observed), per_item
+
+
+# ============================================
+# 報告
+# ============================================
+
+@dataclass
+class LabelAgreement:
+    """單一標籤類型的一致性"""
+    label_type: str
+    items: int = 0                   # 至少兩位標註者的訊息數
+    ratings: int = 0
+    categories: List[Any] = field(default_factory=list)
+    fleiss_kappa: float = float("nan")
+    observed_agreement: float = float("nan")
+    cohen_kappa_mean: float = float("nan")     # 各對標註者依共同訊息數加權
+    pairs: List[Dict[str, Any]] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        def clean(value):
+            return None if isinstance(value, float) and np.isnan(value) else value
+        return {
+            "label_type": self.label_type,
+            "items": self.items,
+            "ratings": self.ratings,
+            "categories": self.categories,
+            "fleiss_kappa": clean(self.fleiss_kappa),
+            "observed_agreement": clean(self.observed_agreement),
+            "cohen_kappa_mean": clean(self.cohen_kappa_mean),
+            "pairs": self.pairs,
+        }
+
+
+@dataclass
+class AgreementReport:
+    """標註一致性報告"""
+    messages: int = 0                # 有標籤的訊息數
+    multi_annotated: int = 0         # 至少兩位標註者的訊息數
+    annotators: Dict[str, int] = field(default_factory=dict)    # 標註者 → 標註訊息數
+    labels: Dict[str, LabelAgreement] = field(default_factory=dict)
+    flagged: List[Dict[str, Any]] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "messages": self.messages,
+            "multi_annotated": self.multi_annotated,
+            "annotators": self.annotators,
+            "labels": {name: agreement.to_dict() for name, agreement in self.labels.items()},
+            "flagged": self.flagged,
+            "elapsed": self.elapsed,
+        }
+
+
+def _label_agreement(
+    label_type: str,
+    items: np.ndarray,
+    raters: np.ndarray,
+    values: List[Any],
+    n_items: int,
+    annotator_names: List[str],
+    min_overlap: int
+) -> Tuple[LabelAgreement, np.ndarray, np.ndarray]:
+    """
+    單一標籤類型
+
+    Returns:
+        (一致性, 計入的訊息編號, 各訊息一致率)
+    """
+    agreement = LabelAgreement(label_type, ratings=len(values))
+    if not len(values):
+        return agreement, np.empty(0, dtype=np.int64), np.empty(0)
+
+    # 類別 → 連續整數
+    categories = sorted(set(values), key=str)
+    codes = {value: i for i, value in enumerate(categories)}
+    cats = np.fromiter((codes[value] for value in values), dtype=np.int64, count=len(values))
+    n_cats = len(categories)
+    agreement.categories = categories
+
+    # Fleiss：訊息 × 類別計數
+    counts = np.bincount(items * n_cats + cats, minlength=n_items * n_cats).reshape(n_items, n_cats)
+    rated_items = np.flatnonzero(counts.sum(axis=1) >= 2)
+    agreement.items = len(rated_items)
+    agreement.fleiss_kappa, agreement.observed_agreement, per_item = fleiss_kappa(counts)
+
+    # Cohen：每位標註者的 (訊息, 類別) 依訊息排序
+    order = np.lexsort((items, raters))
+    sorted_raters, sorted_items, sorted_cats = raters[order], items[order], cats[order]
+    bounds = np.flatnonzero(np.diff(sorted_raters)) + 1
+    starts = np.concatenate(([0], bounds))
+    by_rater = {
+        int(sorted_raters[start]): (rater_items, rater_cats)
+        for start, rater_items, rater_cats in zip(
+            starts, np.split(sorted_items, bounds), np.split(sorted_cats, bounds)
+        )
+    }
+
+    weighted, total = 0.0, 0
+    for a, b in combinations(sorted(by_rater), 2):
+        items_a, cats_a = by_rater[a]
+        items_b, cats_b = by_rater[b]
+        _, ia, ib = np.intersect1d(items_a, items_b, assume_unique=True, return_indices=True)
+        if len(ia) < min_overlap:
+            continue
+        confusion = np.bincount(cats_a[ia] * n_cats + cats_b[ib], minlength=n_cats * n_cats).reshape(n_cats, n_cats)
+        kappa, observed = kappa_from_confusion(confusion)
+        agreement.pairs.append({
+            "annotators": [annotator_names[a], annotator_names[b]],
+            "overlap": int(len(ia)),
+            "cohen_kappa": kappa,
+            "observed_agreement": observed,
+        })
+        weighted += kappa * len(ia)
+        total += len(ia)
+    if total:
+        agreement.cohen_kappa_mean = weighted / total
+    agreement.pairs.sort(key=lambda pair: pair["cohen_kappa"])
+
+    return agreement, rated_items, per_item
+
+
+def compute_agreement(
+    labeled: Iterable[LabeledMessage],
+    min_overlap: int = DEFAULT_MIN_OVERLAP,
+    flag_limit: int = DEFAULT_FLAG_LIMIT
+) -> AgreementReport:
+    """
+    計算標註一致性
+
+    Args:
+        labeled: (message_id, 標註者 → 標籤)
+        min_overlap: 計算 Cohen's kappa 的最少共同訊息數
+        flag_limit: 列出幾則一致性最低的訊息
+
+    低一致性分數為訊息在各標籤類型一致率（意見相同的標註者配對比例）的平均，
+    只計入有至少兩位標註者的標籤類型。
+    """
+    start = time.perf_counter()
+    report = AgreementReport()
+
+    message_ids: List[str] = []
+    annotator_codes: Dict[str, int] = {}
+    annotator_counts: List[int] = []
+    # 標籤類型 → 三欄（訊息編號, 標註者編號, 值）
+    columns = {name: ([], [], []) for name in LABEL_TYPES}
+    all_labels: List[Dict[str, Dict[str, Any]]] = []
+
+    for message_id, labels in labeled:
+        item = len(message_ids)
+        message_ids.append(message_id)
+        all_labels.append(labels)
+        for annotator, label in labels.items():
+            rater = annotator_codes.get(annotator)
+            if rater is None:
+                rater = annotator_codes[annotator] = len(annotator_codes)
+                annotator_counts.append(0)
+            annotator_counts[rater] += 1
+            for name, (item_col, rater_col, value_col) in columns.items():
+                value = label.get(name)
+                if value is not None:
+                    item_col.append(item)
+                    rater_col.append(rater)
+                    value_col.append(value)
+
+    n_items = len(message_ids)
+    annotator_names = list(annotator_codes)
+    report.messages = n_items
+    report.multi_annotated = sum(1 for labels in all_labels if len(labels) >= 2)
+    report.annotators = dict(zip(annotator_names, annotator_counts))
+
+    # 各訊息一致率加總與計入的標籤類型數
+    score_sum = np.zeros(n_items)
+    score_count = np.zeros(n_items, dtype=np.int64)
+    for name, (item_col, rater_col, value_col) in columns.items():
+        agreement, rated_items, per_item = _label_agreement(
+            name,
+            np.array(item_col, dtype=np.int64),
+            np.array(rater_col, dtype=np.int64),
+            value_col,
+            n_items,
+            annotator_names,
+            min_overlap
+        )
+        report.labels[name] = agreement
+        score_sum[rated_items] += per_item
+        score_count[rated_items] += 1
+
+    scored = np.flatnonzero(score_count)
+    if len(scored) and flag_limit > 0:
+        scores = score_sum[scored] / score_count[scored]
+        limit = min(flag_limit, len(scored))
+        lowest = np.argpartition(scores, limit - 1)[:limit]
+        lowest = lowest[np.argsort(scores[lowest], kind="stable")]
+        for index in lowest.tolist():
+            item = int(scored[index])
+            score = float(scores[index])
+            if score >= 1.0:
+                break
+            labels = all_labels[item]
+            report.flagged.append({
+                "message_id": message_ids[item],
+                "agreement": score,
+                "labels": {
+                    LABEL_TYPES[name]: {
+                        annotator: label[name] for annotator, label in labels.items()
+                        if label.get(name) is not None
+                    }
+                    for name in LABEL_TYPES
+                },
+            })
+
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="標註一致性報告（Cohen's / Fleiss' kappa）")
+    parser.add_argument("paths", nargs="*", help="標註者交回的檔案（.json / .jsonl，可加 .gz）")
+    parser.add_argument("--from-store", action="store_true", help="使用對話儲存中已回匯的標註")
+    parser.add_argument("--min-overlap", type=int, default=DEFAULT_MIN_OVERLAP)
+    parser.add_argument("--limit", type=int, default=DEFAULT_FLAG_LIMIT, help="列出的低一致性訊息數")
+    parser.add_argument("--output", default=None, help="完整報告輸出路徑（JSON）")
+    parser.add_argument("--flagged", default=None, help="待仲裁訊息輸出路徑（JSONL）")
+    args = parser.parse_args()
+
+    if args.from_store:
+        from conversation_store import get_conversation_store
+        labeled = iter_store_labels(get_conversation_store())
+    elif args.paths:
+        labeled = iter_file_labels(args.paths)
+    else:
+        parser.error("請指定標註檔或 --from-store")
+
+    report = compute_agreement(labeled, args.min_overlap, args.limit)
+
+    print(f"訊息 {report.messages} 則（{report.multi_annotated} 則有多位標註者），標註者 {len(report.annotators)} 位")
+    for name, agreement in report.labels.items():
+        data = agreement.to_dict()
+        fleiss = "—" if data["fleiss_kappa"] is None else f"{data['fleiss_kappa']:.3f}"
+        cohen = "—" if data["cohen_kappa_mean"] is None else f"{data['cohen_kappa_mean']:.3f}"
+        print(f"{name:<8} 訊息 {agreement.items:>7}  Fleiss κ {fleiss}  Cohen κ（平均）{cohen}  標註者配對 {len(agreement.pairs)}")
+        for pair in agreement.pairs[:3]:
+            print(f"    {' / '.join(pair['annotators'])}: κ {pair['cohen_kappa']:.3f}（{pair['overlap']} 則）")
+    print(f"低一致性訊息 {len(report.flagged)} 則，耗時 {report.elapsed:.1f} 秒")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report.to_dict(), f, ensure_ascii=False, indent=2)
+        print(f"報告：{args.output}")
+    if args.flagged:
+        os.makedirs(os.path.dirname(os.path.abspath(args.flagged)), exist_ok=True)
+        with open(args.flagged, "w", encoding="utf-8") as f:
+            for record in report.flagged:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"待仲裁清單：{args.flagged}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+"""
+AI-CARE Lung - 標註回匯模組
+==========================
+功能：
+1. 串流讀取標註團隊交回的 JSON / JSONL 檔（可 gzip 壓縮；JSON 陣列也逐筆解析，不整檔載入）
+2. 依 IntentCategory / EmotionCategory / UrgencyLevel 驗證標籤（接受列舉值或名稱）
+3. 先以 message_id 雜湊索引彙整所有檔案，再單次掃描批次合併到對話儲存（日誌 message_update）
+4. 多位標註者：各自的標籤保留在 annotator_labels，annotated_* 取多數決；
+   意見不一致的欄位列為衝突（平手時不下結論，留待仲裁）
+
+匯出格式即 iter_annotation_export / export_for_annotation 的輸出，
+標註者填寫 annotated_* 與 annotator_id 後交回（consensus_* 是匯出當下的多數決，
+僅供參考，回匯時不讀取；預填的實體與 entities_prefill_hash 相同時視為未修改，不算人工標註）：
+
+    python annotation_import.py labels/*.jsonl [--annotator nurse_a] [--conflicts conflicts.jsonl]
+
+請在 Streamlit 應用停止時執行（同一份對話日誌不可由兩個行程同時寫入，應用執行中會因日誌鎖定直接失敗）。
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Iterator, Tuple, IO
+
+from models import IntentCategory, EmotionCategory, UrgencyLevel
+
+# ============================================
+# 設定
+# ============================================
+
+# 每次合併（持有儲存鎖）的訊息數
+DEFAULT_BATCH_SIZE = 5000
+
+# 報告中保留的錯誤範例數
+MAX_REPORTED_ERRORS = 100
+
+# JSON 陣列串流讀取的區塊大小
+_READ_CHUNK = 1 << 20
+
+# 標籤欄位：匯出欄位名稱 → 標註者標籤中的鍵
+LABEL_FIELDS = {
+    "annotated_intent": "intent",
+    "annotated_emotion": "emotion",
+    "annotated_urgency": "urgency",
+    "annotated_entities": "entities",
+}
+
+
+def _enum_lookup(enum_cls) -> Dict[str, Any]:
+    """列舉值與名稱（不分大小寫）→ 列舉值"""
+    lookup = {}
+    for member in enum_cls:
+        lookup[str(member.value).lower()] = member.value
+        lookup[member.name.lower()] = member.value
+    return lookup
+
+
+_INTENTS = _enum_lookup(IntentCategory)
+_EMOTIONS = _enum_lookup(EmotionCategory)
+_URGENCIES = _enum_lookup(UrgencyLevel)
+
+
+# ============================================
+# 讀取
+# ============================================
+
+def _open_text(path: str) -> IO[str]:
+    # utf-8-sig：容許試算表工具另存時加上的 BOM
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8-sig")
+    return open(path, "r", encoding="utf-8-sig")
+
+
+def _iter_json_lines(fp: IO[str]) -> Iterator[Tuple[int, Any]]:
+    for line_no, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, e
+
+
+def _iter_json_array(fp: IO[str]) -> Iterator[Tuple[int, Any]]:
+    """逐筆解析頂層 JSON 陣列（物件包著陣列時整檔載入）"""
+    decoder = json.JSONDecoder()
+    buffer = fp.read(_READ_CHUNK).lstrip()
+    if not buffer:
+        return
+    if buffer[0] != "[":
+        # {"records": [...]} 或單一物件
+        data = json.loads(buffer + fp.read())
+        if isinstance(data, dict):
+            for key in ("records", "messages", "data"):
+                if isinstance(data.get(key), list):
+                    data = data[key]
+                    break
+            else:
+                data = [data]
+        for index, record in enumerate(data, 1):
+            yield index, record
+        return
+
+    pos, index, eof = 1, 0, False
+    while True:
+        # 略過空白與分隔逗號
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError("JSON 陣列未結束")
+            buffer, pos = fp.read(_READ_CHUNK), 0
+            eof = not buffer
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # 物件跨區塊：丟掉已解析的部分再補讀
+            chunk = fp.read(_READ_CHUNK)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        index += 1
+        yield index, record
+        pos = end
+
+
+def iter_annotation_records(path: str) -> Iterator[Tuple[int, Any]]:
+    """
+    逐筆讀取標註檔
+
+    Yields:
+        (行號或陣列序號, 紀錄字典)；JSONL 單行解析失敗時紀錄為 JSONDecodeError
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    with _open_text(path) as fp:
+        if name.endswith((".jsonl", ".ndjson")):
+            yield from _iter_json_lines(fp)
+        else:
+            yield from _iter_json_array(fp)
+
+
+# ============================================
+# 驗證
+# ============================================
+
+def _enum_value(value: Any, lookup: Dict[str, Any], field_name: str) -> Any:
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        key = value.strip().lower()
+    elif isinstance(value, int) and not isinstance(value, bool):
+        key = str(value)
+    else:
+        key = None
+    if key not in lookup:
+        raise ValueError(f"{field_name} 不是有效值: {value!r}")
+    return lookup[key]
+
+
+def _entities(value: Any) -> Optional[List[Dict[str, Any]]]:
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        raise ValueError("annotated_entities 必須是陣列")
+    entities = []
+    for entity in value:
+        if not isinstance(entity, dict):
+            raise ValueError("annotated_entities 的項目必須是物件")
+        start, end, label = entity.get("start"), entity.get("end"), entity.get("label")
+        if not (isinstance(start, int) and isinstance(end, int) and 0 <= start < end):
+            raise ValueError(f"實體位置無效: {entity!r}")
+        if not isinstance(label, str) or not label:
+            raise ValueError(f"實體缺少 label: {entity!r}")
+        entities.append(entity)
+    return entities or None
+
+
+def entities_fingerprint(entities: Optional[List[Dict[str, Any]]]) -> str:
+    """實體陣列的指紋（只看位置、標籤與否定；欄位順序、text 與項目順序不影響）"""
+    spans = sorted(
+        (entity["start"], entity["end"], entity["label"], bool(entity.get("negated")))
+        for entity in entities or []
+    )
+    return hashlib.sha1(json.dumps(spans, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def _prefill_fingerprint(record: Dict[str, Any]) -> Optional[str]:
+    """匯出時預填實體的指紋；沒有預填時為 None"""
+    if record.get("entities_prefill_hash"):
+        return record["entities_prefill_hash"]
+    if record.get("entities_prefilled") and isinstance(record.get("content"), str):
+        # 加入指紋前匯出的檔案：以同一擷取器重新產生預填內容比對
+        from entity_extractor import entity_extractor
+        return entities_fingerprint(entity_extractor.extract_entities(record["content"]))
+    return None
+
+
+def parse_label(
+    record: Any,
+    default_annotator: Optional[str] = None
+) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+    """
+    標註紀錄 → (message_id, annotator_id, 標籤)
+
+    標籤格式：{"intent", "emotion", "urgency", "entities", "time"}，未填的欄位為 None。
+
+    Returns:
+        None 表示尚未標註（匯出後沒有填寫的列）
+
+    Raises:
+        ValueError: 紀錄格式或標籤值無效
+    """
+    if not isinstance(record, dict):
+        raise ValueError("紀錄必須是 JSON 物件")
+
+    entities = _entities(record.get("annotated_entities"))
+    prefill = _prefill_fingerprint(record)
+    if entities is not None and prefill is not None and entities_fingerprint(entities) == prefill:
+        # 與匯出時的預填內容相同：標註者沒有修改，仍是擷取器的結果
+        entities = None
+
+    label = {
+        "intent": _enum_value(record.get("annotated_intent"), _INTENTS, "annotated_intent"),
+        "emotion": _enum_value(record.get("annotated_emotion"), _EMOTIONS, "annotated_emotion"),
+        "urgency": _enum_value(record.get("annotated_urgency"), _URGENCIES, "annotated_urgency"),
+        "entities": entities,
+    }
+    if all(value is None for value in label.values()):
+        return None
+
+    message_id = record.get("message_id")
+    if not isinstance(message_id, str) or not message_id:
+        raise ValueError("缺少 message_id")
+    annotator_id = record.get("annotator_id") or default_annotator
+    if not annotator_id:
+        raise ValueError("缺少 annotator_id")
+
+    annotation_time = record.get("annotation_time")
+    if annotation_time:
+        try:
+            parsed_time = datetime.fromisoformat(annotation_time)
+        except (TypeError, ValueError):
+            raise ValueError(f"annotation_time 格式錯誤: {annotation_time!r}")
+        # 與系統其他時間一致，存成本地時間（不含時區）
+        if parsed_time.tzinfo is not None:
+            parsed_time = parsed_time.astimezone().replace(tzinfo=None)
+        annotation_time = parsed_time.isoformat()
+    label["time"] = annotation_time or None
+
+    return message_id, str(annotator_id), label
+
+
+# ============================================
+# 合併
+# ============================================
+
+def _vote_key(value: Any) -> Any:
+    # 實體陣列不可雜湊，以正規化 JSON 比較
+    if isinstance(value, list):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return value
+
+
+def merge_annotator_labels(
+    annotations: Optional[Dict[str, Any]],
+    new_labels: Dict[str, Dict[str, Any]],
+    import_time: str
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    將新標籤合併進訊息的標註欄位
+
+    同一位標註者再次交回時以新值覆蓋（未填的欄位保留舊值）；
+    annotated_* 取所有標註者的多數決，平手時為 None。
+
+    Args:
+        annotations: 訊息目前的標註字典（ConversationMessage.annotations）
+        new_labels: 標註者 → 標籤
+        import_time: 標籤沒有 annotation_time 時使用的時間
+
+    Returns:
+        (新的標註字典, 衝突列表 [{"field", "labels": {標註者: 值}}])
+    """
+    merged = dict(annotations or {})
+    labels: Dict[str, Dict[str, Any]] = {
+        annotator: dict(label) for annotator, label in (merged.get("annotator_labels") or {}).items()
+    }
+
+    # 舊版只有單一標註者的標註，轉為該標註者的標籤
+    if not labels and merged.get("annotator_id"):
+        legacy = {key: merged.get(name) for name, key in LABEL_FIELDS.items()}
+        if any(value is not None for value in legacy.values()):
+            time_value = merged.get("annotation_time")
+            legacy["time"] = time_value.isoformat() if isinstance(time_value, datetime) else time_value
+            labels[merged["annotator_id"]] = legacy
+
+    for annotator, label in new_labels.items():
+        current = labels.setdefault(annotator, {})
+        for key, value in label.items():
+            if value is not None:
+                current[key] = value
+        current["time"] = label.get("time") or import_time
+
+    conflicts = []
+    for name, key in LABEL_FIELDS.items():
+        votes = {
+            annotator: label[key] for annotator, label in labels.items()
+            if label.get(key) is not None
+        }
+        if not votes:
+            merged.pop(name, None)
+            continue
+
+        # 多數情況只有一位標註者或意見一致，不需計票
+        counts: Dict[Any, int] = {}
+        first: Dict[Any, Any] = {}
+        for value in votes.values():
+            vote = _vote_key(value)
+            counts[vote] = counts.get(vote, 0) + 1
+            first.setdefault(vote, value)
+        if len(counts) == 1:
+            merged[name] = next(iter(first.values()))
+            continue
+
+        conflicts.append({"field": name, "labels": votes})
+        ranked = sorted(counts.values(), reverse=True)
+        if ranked[0] == ranked[1]:
+            merged.pop(name, None)
+        else:
+            merged[name] = first[max(counts, key=counts.get)]
+
+    merged["annotator_labels"] = labels
+    merged["annotator_id"] = ",".join(sorted(labels))
+    # 時間皆為 isoformat() 輸出的本地時間，字串比較即時間先後
+    merged["annotation_time"] = datetime.fromisoformat(
+        max(label["time"] for label in labels.values() if label.get("time"))
+    )
+    return merged, conflicts
+
+
+# ============================================
+# 回匯
+# ============================================
+
+@dataclass
+class ImportReport:
+    """回匯統計"""
+    files: int = 0
+    records: int = 0             # 讀到的紀錄數
+    labels: int = 0              # 有效標籤數
+    unlabeled: int = 0           # 未填寫的紀錄
+    invalid: int = 0             # 格式或值無效
+    duplicates: int = 0          # 同一標註者對同一訊息重複交回（以後者為準）
+    messages: int = 0            # 涉及的訊息數
+    merged: int = 0              # 寫回的訊息數
+    unknown_ids: List[str] = field(default_factory=list)
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    conflicts: List[Dict[str, Any]] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.labels / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def conflicts_by_field(self) -> Dict[str, int]:
+        return dict(Counter(conflict["field"] for conflict in self.conflicts))
+
+
+def import_annotations(
+    paths: List[str],
+    store=None,
+    default_annotator: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> ImportReport:
+    """
+    回匯標註檔
+
+    先讀完所有檔案，以 message_id 彙整（message_id → 標註者 → 標籤），
+    再依批次交由 store.merge_annotations 單次掃描合併。
+
+    Args:
+        paths: 標註檔路徑（.json / .jsonl，可加 .gz）
+        store: ConversationStore（預設為全域實例）
+        default_annotator: 紀錄沒有 annotator_id 時使用
+        batch_size: 每批合併的訊息數
+    """
+    if store is None:
+        from conversation_store import get_conversation_store
+        store = get_conversation_store()
+
+    report = ImportReport()
+    start = time.perf_counter()
+    pending: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    for path in paths:
+        report.files += 1
+        try:
+            for position, record in iter_annotation_records(path):
+                report.records += 1
+                try:
+                    if isinstance(record, json.JSONDecodeError):
+                        raise ValueError(f"JSON 格式錯誤: {record.msg}")
+                    parsed = parse_label(record, default_annotator)
+                except ValueError as e:
+                    report.invalid += 1
+                    if len(report.errors) < MAX_REPORTED_ERRORS:
+                        report.errors.append({"file": path, "position": position, "error": str(e)})
+                    continue
+
+                if parsed is None:
+                    report.unlabeled += 1
+                    continue
+                message_id, annotator_id, label = parsed
+                report.labels += 1
+                by_annotator = pending.setdefault(message_id, {})
+                if annotator_id in by_annotator:
+                    report.duplicates += 1
+                by_annotator[annotator_id] = label
+        except (OSError, ValueError) as e:
+            # 整個檔案無法讀取（已讀到的紀錄仍會合併）
+            report.errors.append({"file": path, "position": None, "error": str(e)})
+
+    report.messages = len(pending)
+    items = list(pending.items())
+    del pending
+    for i in range(0, len(items), batch_size):
+        merged, unknown, conflicts = store.merge_annotations(dict(items[i:i + batch_size]))
+        report.merged += merged
+        report.unknown_ids.extend(unknown)
+        report.conflicts.extend(conflicts)
+
+    if report.merged and store.storage is not None:
+        store.checkpoint()
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="回匯標註團隊交回的標註檔")
+    parser.add_argument("paths", nargs="+", help="標註檔（.json / .jsonl，可加 .gz）")
+    parser.add_argument("--annotator", default=None, help="紀錄沒有 annotator_id 時使用的標註者")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--conflicts", default=None, help="衝突清單輸出路徑（JSONL）")
+    args = parser.parse_args()
+
+    report = import_annotations(args.paths, default_annotator=args.annotator, batch_size=args.batch_size)
+
+    print(f"讀取 {report.files} 個檔案、{report.records} 筆紀錄")
+    print(f"有效標籤 {report.labels} 筆（未填寫 {report.unlabeled}、無效 {report.invalid}、重複 {report.duplicates}）")
+    print(f"合併 {report.merged} / {report.messages} 則訊息，找不到 {len(report.unknown_ids)} 則")
+    print(f"標註者衝突 {len(report.conflicts)} 筆 {report.conflicts_by_field}")
+    print(f"耗時 {report.elapsed:.1f} 秒，{report.rate:,.0f} 筆/秒")
+    for error in report.errors[:10]:
+        print(f"  {error['file']}:{error['position']} {error['error']}")
+
+    if args.conflicts and report.conflicts:
+        os.makedirs(os.path.dirname(os.path.abspath(args.conflicts)), exist_ok=True)
+        with open(args.conflicts, "w", encoding="utf-8") as f:
+            for conflict in report.conflicts:
+                f.write(json.dumps(conflict, ensure_ascii=False) + "\n")
+        print(f"衝突清單：{args.conflicts}")
+
+
+if __name__ == "__main__":
+    main()
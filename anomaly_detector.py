@@ -0,0 +1,265 @@
+"""
+AI-CARE Lung - 個人化症狀異常偵測模組
+====================================
+功能：
+1. 以 Welford 演算法即時更新每位病人、每個症狀的平均與變異數
+2. 與病人自己的基準相比，偵測分數的突然變化
+3. 每次更新 O(1)，不需重新掃描歷史回報
+4. 狀態以固定長度二進位紀錄存於本地鍵值檔（dbm）
+
+補充固定門檻（例如 >= 7 分）無法察覺的個人變化：
+平常都 1 分的病人突然回報 5 分，也值得個管師注意。
+
+三軍總醫院 數位醫療中心
+"""
+
+import dbm
+import math
+import os
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple
+
+from models import LOCAL_DATA_DIR
+
+# ============================================
+# 設定
+# ============================================
+
+# 狀態檔位置
+ANOMALY_STATE_PATH = os.path.join(LOCAL_DATA_DIR, "anomaly_state")
+
+# 每筆狀態：觀察次數 (uint32)、平均 (float64)、M2 (float64)，共 20 bytes
+_STATE_FORMAT = struct.Struct("<Idd")
+
+# 鍵值分隔字元
+_KEY_SEPARATOR = "\x1f"
+
+
+@dataclass
+class ScoreAnomaly:
+    """偏離個人基準的分數"""
+    patient_id: str
+    symptom: str
+    score: float
+    baseline_mean: float
+    baseline_std: float
+    z_score: float
+    observations: int
+
+    @property
+    def message(self) -> str:
+        """顯示用說明"""
+        return (
+            f"{self.symptom}：{self.score:.0f} 分"
+            f"（平常約 {self.baseline_mean:.1f} ± {self.baseline_std:.1f} 分）"
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "patient_id": self.patient_id,
+            "symptom": self.symptom,
+            "score": self.score,
+            "baseline_mean": round(self.baseline_mean, 2),
+            "baseline_std": round(self.baseline_std, 2),
+            "z_score": round(self.z_score, 2),
+            "observations": self.observations
+        }
+
+
+class AnomalyDetector:
+    """
+    個人化異常偵測器
+
+    每個 (病人, 症狀) 只保存 (n, mean, M2) 三個數值：
+        n    += 1
+        delta = x - mean
+        mean += delta / n
+        M2   += delta * (x - mean)
+    變異數 = M2 / (n - 1)
+    """
+
+    def __init__(
+        self,
+        path: str = ANOMALY_STATE_PATH,
+        z_threshold: float = 2.5,
+        min_observations: int = 5,
+        min_std: float = 1.0,
+        min_delta: float = 2.0,
+        two_sided: bool = False
+    ):
+        """
+        Args:
+            path: 狀態檔路徑（None 表示只存在記憶體）
+            z_threshold: 判定為異常的 z 分數
+            min_observations: 基準至少需要的回報次數
+            min_std: 標準差下限（避免分數一向穩定的病人小幅變動就被標記）
+            min_delta: 與平均至少要差幾分才標記
+            two_sided: 是否也標記突然改善（預設只標記惡化）
+        """
+        self.path = path
+        self.z_threshold = z_threshold
+        self.min_observations = min_observations
+        self.min_std = min_std
+        self.min_delta = min_delta
+        self.two_sided = two_sided
+
+        self._lock = threading.Lock()
+        self._memory: Dict[bytes, bytes] = {}
+        self._db = None
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = dbm.open(path, "c")
+
+    # ============================================
+    # 狀態存取
+    # ============================================
+
+    @staticmethod
+    def _key(patient_id: str, symptom: str) -> bytes:
+        return f"{patient_id}{_KEY_SEPARATOR}{symptom}".encode("utf-8")
+
+    def _store(self):
+        return self._db if self._db is not None else self._memory
+
+    def _read(self, key: bytes) -> Tuple[int, float, float]:
+        raw = self._store().get(key)
+        if raw is None:
+            return 0, 0.0, 0.0
+        return _STATE_FORMAT.unpack(raw)
+
+    def _write(self, key: bytes, n: int, mean: float, m2: float):
+        self._store()[key] = _STATE_FORMAT.pack(n, mean, m2)
+
+    def _std(self, n: int, m2: float) -> float:
+        variance = m2 / (n - 1) if n > 1 else 0.0
+        return max(math.sqrt(variance), self.min_std)
+
+    # ============================================
+    # 偵測與更新
+    # ============================================
+
+    def check(self, patient_id: str, symptom: str, score: float) -> Optional[ScoreAnomaly]:
+        """與目前基準比較（不更新狀態）"""
+        with self._lock:
+            n, mean, m2 = self._read(self._key(patient_id, symptom))
+        return self._evaluate(patient_id, symptom, float(score), n, mean, m2)
+
+    def _evaluate(
+        self, patient_id: str, symptom: str, score: float, n: int, mean: float, m2: float
+    ) -> Optional[ScoreAnomaly]:
+        if n < self.min_observations:
+            return None
+
+        delta = score - mean
+        if not self.two_sided and delta <= 0:
+            return None
+        if abs(delta) < self.min_delta:
+            return None
+
+        std = self._std(n, m2)
+        z_score = delta / std
+        if abs(z_score) < self.z_threshold:
+            return None
+
+        return ScoreAnomaly(
+            patient_id=patient_id,
+            symptom=symptom,
+            score=score,
+            baseline_mean=mean,
+            baseline_std=std,
+            z_score=z_score,
+            observations=n
+        )
+
+    def update(self, patient_id: str, symptom: str, score: float):
+        """以新分數更新基準（Welford）"""
+        key = self._key(patient_id, symptom)
+        with self._lock:
+            self._update_locked(key, float(score))
+
+    def _update_locked(self, key: bytes, score: float) -> Tuple[int, float, float]:
+        n, mean, m2 = self._read(key)
+        n += 1
+        delta = score - mean
+        mean += delta / n
+        m2 += delta * (score - mean)
+        self._write(key, n, mean, m2)
+        return n, mean, m2
+
+    def observe(self, patient_id: str, scores: Dict[str, Any]) -> List[ScoreAnomaly]:
+        """
+        處理一筆新回報：先與基準比較，再把分數併入基準
+
+        Args:
+            patient_id: 病人ID
+            scores: {"pain": 3, "fatigue": 2, ...}
+
+        Returns:
+            偏離個人基準的症狀列表
+        """
+        anomalies = []
+
+        with self._lock:
+            for symptom, score in scores.items():
+                if score is None or score == "":
+                    continue
+                score = float(score)
+                key = self._key(patient_id, symptom)
+
+                n, mean, m2 = self._read(key)
+                anomaly = self._evaluate(patient_id, symptom, score, n, mean, m2)
+                if anomaly:
+                    anomalies.append(anomaly)
+
+                self._update_locked(key, score)
+
+            self._sync()
+
+        return anomalies
+
+    def get_baseline(self, patient_id: str, symptom: str) -> Optional[Dict[str, float]]:
+        """取得病人某症狀的基準"""
+        with self._lock:
+            n, mean, m2 = self._read(self._key(patient_id, symptom))
+        if n == 0:
+            return None
+        return {
+            "observations": n,
+            "mean": round(mean, 2),
+            "std": round(math.sqrt(m2 / (n - 1)) if n > 1 else 0.0, 2)
+        }
+
+    # ============================================
+    # 持久化
+    # ============================================
+
+    def _sync(self):
+        """將狀態寫回磁碟（dbm.gnu 需要明確 sync）"""
+        if self._db is not None and hasattr(self._db, "sync"):
+            self._db.sync()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# ============================================
+# 全域實例
+# ============================================
+
+_detector: Optional[AnomalyDetector] = None
+_detector_lock = threading.Lock()
+
+
+def get_anomaly_detector() -> AnomalyDetector:
+    """取得全域異常偵測器（延遲建立）"""
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = AnomalyDetector()
+        return _detector
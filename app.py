@@ -19,6 +19,7 @@ AI-CARE Lung 病人端應用程式 v2.2
 """
 
 import streamlit as st
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date
 import json
 import uuid
@@ -30,12 +31,15 @@ from models import (
     generate_report_id, generate_session_id
 )
 from conversation_store import (
-    conversation_store, log_patient_input, log_ai_response,
+    get_conversation_store, log_patient_input, log_ai_response,
     log_open_ended_response
 )
 from expert_templates import (
     template_manager, get_expert_response, get_symptom_response
 )
+from anomaly_detector import get_anomaly_detector
+from store_telemetry import get_store_telemetry
+from detection_worker import EscalationRecorder
 
 # AI 語音電話 Demo 模組
 try:
@@ -641,7 +645,7 @@ def render_home():
         with col1:
             if st.button("💬 AI 對話回報", use_container_width=True, type="primary"):
                 # 開始新的對話會話
-                session = conversation_store.start_session(
+                session = get_conversation_store().start_session(
                     patient_id=st.session_state.patient["id"],
                     session_type="daily_report"
                 )
@@ -715,7 +719,7 @@ def render_ai_chat():
     if st.button("← 返回首頁"):
         # 結束會話（如果是中途離開）
         if st.session_state.conversation_session_id:
-            conversation_store.end_session(
+            get_conversation_store().end_session(
                 st.session_state.conversation_session_id,
                 completion_type="abandoned"
             )
@@ -754,6 +758,7 @@ def render_ai_chat():
         # 記錄 AI 訊息
         log_ai_response(
             patient_id=patient["id"],
+            session_id=st.session_state.conversation_session_id,
             content=welcome_msg,
             source=source if source else MessageSource.AI_GENERATED,
             template_id=template_id
@@ -784,6 +789,7 @@ def render_ai_chat():
         
         log_ai_response(
             patient_id=patient["id"],
+            session_id=st.session_state.conversation_session_id,
             content=first_question,
             source=MessageSource.SYSTEM_AUTO
         )
@@ -869,6 +875,7 @@ def handle_text_input(user_input: str, current_symptom: dict):
     # 記錄原始輸入（最重要！）
     log_patient_input(
         patient_id=patient_id,
+        session_id=st.session_state.conversation_session_id,
         content=user_input,
         input_method="text",
         raw_input=user_input
@@ -905,6 +912,7 @@ def handle_text_input(user_input: str, current_symptom: dict):
         
         log_ai_response(
             patient_id=patient_id,
+            session_id=st.session_state.conversation_session_id,
             content=response,
             source=MessageSource.SYSTEM_AUTO
         )
@@ -981,6 +989,7 @@ def handle_score_selection(score: int, input_method: str = "button", raw_input:
     if input_method == "button":
         log_patient_input(
             patient_id=patient_id,
+            session_id=st.session_state.conversation_session_id,
             content=user_content,
             input_method="button"
         )
@@ -1057,6 +1066,7 @@ def handle_score_selection(score: int, input_method: str = "button", raw_input:
     # 記錄 AI 回應
     log_ai_response(
         patient_id=patient_id,
+        session_id=st.session_state.conversation_session_id,
         content=response,
         source=source,
         template_id=template_id
@@ -1151,7 +1161,7 @@ def submit_report():
     
     # 結束對話會話
     if st.session_state.conversation_session_id:
-        conversation_store.end_session(
+        get_conversation_store().end_session(
             st.session_state.conversation_session_id,
             completion_type="completed"
         )
@@ -1190,6 +1200,9 @@ def submit_report():
                 
                 # 更新成就列表
                 st.session_state.achievements = am.get_all_achievements_status(patient_id)
+                
+                # 與個人基準比較（只有成功存檔的回報才併入基準並通知個管師）
+                check_score_anomalies(rm, patient_id, report_id, st.session_state.current_scores)
         
         except Exception as e:
             st.warning(f"雲端儲存失敗，資料已暫存本地: {e}")
@@ -1227,6 +1240,33 @@ def submit_report():
         st.rerun()
 
 
+def check_score_anomalies(rm, patient_id: str, report_id: str, scores: dict):
+    """
+    與病人自己的歷史基準比較，明顯變化的症狀寫入異常警示工作表並告知病人
+    
+    只在回報已成功存到工作表後呼叫（Demo 模式與存檔失敗都不更新基準）
+    """
+    try:
+        anomalies = get_anomaly_detector().observe(patient_id, scores)
+    except Exception:
+        return
+    
+    if not anomalies:
+        return
+    
+    routed = rm.save_anomaly_alerts(patient_id, report_id, anomalies)
+    
+    names = {s["id"]: s["name"] for s in SYMPTOMS}
+    lines = [
+        f"- {names.get(a.symptom, a.symptom)}：{a.score:.0f} 分（平常約 {a.baseline_mean:.1f} 分）"
+        for a in anomalies
+    ]
+    if routed:
+        st.warning("⚠️ 以下症狀比您平常明顯加重，已通知個管師：\n" + "\n".join(lines))
+    else:
+        st.warning("⚠️ 以下症狀比您平常明顯加重，若持續或加劇請主動聯繫個管師：\n" + "\n".join(lines))
+
+
 # ============================================
 # 數位問卷回報頁面
 # ============================================
@@ -1326,6 +1366,9 @@ def render_questionnaire():
                             st.balloons()
                         
                         st.session_state.achievements = am.get_all_achievements_status(patient["id"])
+                        
+                        # 與個人基準比較
+                        check_score_anomalies(rm, patient["id"], report_id, st.session_state.questionnaire_scores)
                 
                 except Exception as e:
                     st.warning(f"雲端儲存失敗: {e}")
@@ -1439,6 +1482,41 @@ def render_history():
     with col3:
         st.metric("連續天數", f"{compliance['current_streak']} 天")
 
+    # 與同術後天數病友比較
+    if not st.session_state.use_demo_mode and GOOGLE_SHEET_ENABLED:
+        render_cohort_comparison(st.session_state.patient["id"])
+
+
+def render_cohort_comparison(patient_id: str):
+    """渲染與同術後天數病友的比較"""
+    try:
+        from cohort_analytics import get_cohort_analytics
+        analytics = get_cohort_analytics()
+        comparison = analytics.compare_patient(patient_id) if analytics else {}
+    except Exception:
+        comparison = {}
+
+    if not comparison:
+        return
+
+    post_op_day = next(iter(comparison.values()))["post_op_day"]
+
+    st.markdown("---")
+    st.markdown(f"#### 👥 與術後第 {post_op_day} 天病友比較")
+    st.caption("中位數：一半病友的分數低於此值；P90：九成病友的分數低於此值")
+
+    for symptom in SYMPTOMS:
+        item = comparison.get(symptom["id"])
+        if not item or item["score"] is None or item["p50"] is None:
+            continue
+
+        trend = item["trend"]
+        trend_text = "" if trend is None else ("↗️ 上升" if trend > 0.2 else "↘️ 下降" if trend < -0.2 else "➡️ 持平")
+        st.markdown(
+            f"{symptom['icon']} **{symptom['name']}**：{int(item['score'])} 分"
+            f"｜病友中位數 {item['p50']:.0f} 分｜P90 {item['p90']:.0f} 分 {trend_text}"
+        )
+
 
 # ============================================
 # 成就中心頁面
@@ -1689,36 +1767,204 @@ def render_data_export():
     
     st.warning("⚠️ 此功能僅供研究人員使用")
     
+    collapse = st.checkbox("近似重複的訊息每群只匯出一筆", value=False, key="export_collapse_duplicates")
+    prefill = st.checkbox("預填症狀實體（標註者只需修正）", value=True, key="export_prefill_entities")
+    
     col1, col2 = st.columns(2)
     
     with col1:
         st.markdown("#### 對話資料")
         if st.button("匯出標註資料", use_container_width=True):
-            data = conversation_store.export_for_annotation()
-            st.json(data[:5])  # 只顯示前5筆
-            st.download_button(
-                "下載完整資料",
-                data=json.dumps(data, ensure_ascii=False, indent=2),
-                file_name=f"annotation_data_{datetime.now().strftime('%Y%m%d')}.json",
-                mime="application/json"
+            render_conversation_export(
+                lambda: get_conversation_store().iter_annotation_export(
+                    collapse_duplicates=collapse, prefill_entities=prefill
+                ),
+                f"annotation_data_{datetime.now().strftime('%Y%m%d')}.jsonl.gz"
+            )
+        if st.button("匯出分析資料（欄式）", use_container_width=True):
+            render_columnar_export()
+        
+        sample_size = st.number_input("抽樣筆數", min_value=10, max_value=5000, value=500, step=50)
+        sample_seed = st.number_input("批次編號（亂數種子）", min_value=0, value=0, step=1)
+        if st.button("抽樣標註批次（意圖 × 緊急程度平衡）", use_container_width=True):
+            batch = get_conversation_store().sample_for_annotation(
+                int(sample_size), seed=int(sample_seed), collapse_duplicates=collapse,
+                prefill_entities=prefill
+            )
+            render_conversation_export(
+                lambda: iter(batch),
+                f"annotation_batch_{int(sample_seed)}_{datetime.now().strftime('%Y%m%d')}.jsonl.gz"
             )
     
     with col2:
         st.markdown("#### 開放式回應")
         if st.button("匯出開放式回應", use_container_width=True):
-            data = conversation_store.export_open_ended_for_annotation()
-            st.json(data[:5])
-            st.download_button(
-                "下載完整資料",
-                data=json.dumps(data, ensure_ascii=False, indent=2),
-                file_name=f"open_ended_{datetime.now().strftime('%Y%m%d')}.json",
-                mime="application/json"
+            render_conversation_export(
+                lambda: get_conversation_store().iter_open_ended_export(collapse_duplicates=collapse),
+                f"open_ended_{datetime.now().strftime('%Y%m%d')}.jsonl.gz"
+            )
+    
+    # 全文檢索
+    st.markdown("---")
+    st.markdown("#### 🔍 搜尋訊息與開放式回應")
+    query = st.text_input(
+        "關鍵字",
+        placeholder="例如：咳血　／　傷口 紅腫　／　咳血 OR 血痰 -沒有",
+        key="fulltext_query"
+    )
+    if query:
+        found = get_conversation_store().search(query, limit=100)
+        st.caption(f"索引候選 {found['candidates']} 筆，顯示前 {len(found['results'])} 筆")
+        if found["results"]:
+            st.dataframe(found["results"], use_container_width=True)
+    
+    # 症狀回報（研究匯出）
+    if GOOGLE_SHEET_ENABLED and not st.session_state.use_demo_mode:
+        st.markdown("---")
+        st.markdown("#### 症狀回報（全部病人）")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            export_format = st.selectbox("格式", ["jsonl", "csv"], key="report_export_format")
+        with col2:
+            pseudonymize = st.checkbox("病人ID假名化", value=True, key="report_export_pseudonymize")
+        
+        if st.button("匯出症狀回報", use_container_width=True):
+            render_report_export(export_format, pseudonymize)
+
+
+@contextmanager
+def export_temp_dir():
+    """匯出檔暫存目錄（離開時刪除；下載按鈕已持有檔案內容）"""
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp(prefix="aicare_export_")
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def render_file_download(path: str, file_name: str, label: str, mime: str = "application/gzip"):
+    """
+    提供匯出檔下載
+
+    st.download_button 會把整個檔案讀進記憶體（交給 Streamlit 保存到使用者下載為止），
+    所以匯出時逐筆寫檔只省下組字串的尖峰；按鈕建立後暫存檔即可刪除。
+    """
+    with open(path, "rb") as f:
+        st.download_button(
+            label,
+            data=f.read(),
+            file_name=file_name,
+            mime=mime
+        )
+
+
+def render_conversation_export(iter_records, file_name: str):
+    """逐筆寫出 gzip JSONL 並提供下載（預覽前 5 筆）"""
+    import os
+    from itertools import islice
+    from research_export import write_jsonl_gz
+    
+    st.json(list(islice(iter_records(), 5)))  # 只顯示前5筆
+    
+    with export_temp_dir() as directory:
+        path = os.path.join(directory, file_name)
+        with st.spinner("匯出中..."):
+            count = write_jsonl_gz(iter_records(), path)
+        
+        st.success(f"已匯出 {count} 筆")
+        render_file_download(path, file_name, "下載完整資料")
+
+
+def render_columnar_export():
+    """匯出欄式分析檔（Parquet，未安裝 pyarrow 時為 .npz）並提供下載"""
+    import os
+    from columnar_export import export_messages_columnar
+    
+    with export_temp_dir() as directory:
+        with st.spinner("匯出中..."):
+            path, count = export_messages_columnar(
+                get_conversation_store(),
+                directory,
+                include_ai_responses=True
             )
+        
+        st.success(f"已匯出 {count} 筆")
+        render_file_download(path, os.path.basename(path), "下載分析資料", mime="application/octet-stream")
+
+
+def render_report_export(export_format: str, pseudonymize: bool):
+    """分批匯出症狀回報並提供下載"""
+    import os
+    from research_export import iter_sheet_rows, export_reports
+    from google_sheet_db import get_spreadsheet, SHEET_REPORTS
+    
+    spreadsheet = get_spreadsheet()
+    if not spreadsheet:
+        return
+    
+    file_name = f"reports_{datetime.now().strftime('%Y%m%d')}.{export_format}.gz"
+    
+    with export_temp_dir() as directory:
+        path = os.path.join(directory, file_name)
+        with st.spinner("匯出中..."):
+            count = export_reports(
+                iter_sheet_rows(spreadsheet.worksheet(SHEET_REPORTS)),
+                path,
+                fmt=export_format,
+                pseudonymize=pseudonymize
+            )
+        
+        st.success(f"已匯出 {count} 筆回報")
+        render_file_download(path, file_name, "下載症狀回報")
 
 
 # ============================================
 # 側邊欄
 # ============================================
+def render_store_telemetry():
+    """對話儲存遙測（筆數、記憶體估計、寫入速率、門檻警報）"""
+    telemetry = get_store_telemetry()
+    snapshot = telemetry.collect()
+    alarms = telemetry.check(snapshot)
+    
+    st.markdown("**📈 儲存狀態**")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("訊息", f"{snapshot.messages:,}")
+        st.metric("開放式回應", f"{snapshot.responses:,}")
+        st.metric("估計記憶體", f"{snapshot.approx_mb:,.1f} MB")
+    with col2:
+        st.metric("會話", f"{snapshot.sessions:,}", f"移出 {snapshot.spilled_sessions:,}", delta_color="off")
+        st.metric("寫入速率", f"{snapshot.insert_rate:.1f}/s")
+        st.metric("行程 RSS", "—" if snapshot.rss_mb is None else f"{snapshot.rss_mb:,.0f} MB")
+    
+    st.caption(
+        f"快取訊息 {snapshot.cached_messages:,}｜病人 {snapshot.patients:,}｜"
+        f"待偵測 {snapshot.detection_pending:,}"
+        + ("" if snapshot.traced_bytes is None else f"｜tracemalloc {snapshot.traced_bytes / 1024 / 1024:,.1f} MB")
+    )
+    for alarm in alarms:
+        st.error(f"⚠️ {alarm.message}")
+    
+    # 背景偵測判定為緊急、已記錄待個管師檢視的訊息
+    escalations = EscalationRecorder().recent(5)
+    if escalations:
+        st.markdown("**🚨 緊急訊息升級紀錄**")
+        for record in escalations:
+            st.caption(f"{record['recorded_at'][:16]}｜病人 {record['patient_id']}｜訊息 {record['message_id']}")
+    
+    st.download_button(
+        "📊 匯出指標 (Prometheus)",
+        telemetry.to_prometheus(snapshot),
+        file_name="aicare_store_metrics.prom",
+        mime="text/plain",
+        use_container_width=True
+    )
+
+
 def render_sidebar():
     """渲染側邊欄"""
     with st.sidebar:
@@ -1771,6 +2017,8 @@ def render_sidebar():
                 if st.button("🔄 重置今日回報", use_container_width=True):
                     st.session_state.today_reported = False
                     st.rerun()
+                
+                render_store_telemetry()
             
             st.markdown("---")
             
@@ -0,0 +1,399 @@
+"""
+AI-CARE Lung - 效能量測腳本
+==========================
+功能：
+1. keyword：關鍵字偵測（逐條 any(kw in text) vs 單次掃描自動機）
+2. memory：每則 ConversationMessage 的記憶體用量（舊版 dict 欄位 vs __slots__ 稀疏標註）
+3. concurrency：多執行緒同時對話的壓力測試（檢查會話互不串流，並量測吞吐量）
+4. columnar：分析資料載入（gzip JSONL vs 欄式 .npz / Parquet）的檔案大小與載入時間
+5. search：全文檢索（逐筆 in 掃描 vs 二元組倒排索引）
+6. replay：以已儲存的真實會話重播對話邏輯（每步耗時、回應是否與記錄一致）
+
+用法：
+    python benchmarks.py keyword [--messages 20000]
+    python benchmarks.py memory [--messages 1000000]
+    python benchmarks.py concurrency [--chats 500] [--turns 10] [--threads 1,8,64,500]
+    python benchmarks.py columnar [--messages 200000]
+    python benchmarks.py search [--messages 1000000]
+    python benchmarks.py replay [--sessions 1000]
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import gc
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+# ============================================
+# 共用工具
+# ============================================
+
+SAMPLE_PHRASES = [
+    "今天傷口還是有點痛", "昨天晚上睡不著", "咳嗽有痰，顏色偏黃", "走路會喘，胸悶",
+    "這樣正常嗎？會不會是感染", "止痛藥吃了有副作用嗎", "可以洗澡嗎", "謝謝護理師",
+    "心情有點低落，不想出門", "很擔心復發", "早安", "胃口不好沒吃什麼",
+    "非常痛受不了", "發燒到三十八度", "今天好多了，很開心", "有點累沒力氣",
+]
+
+
+def generate_messages(count: int, seed: int = 42) -> List[str]:
+    """組合常見句型產生測試訊息"""
+    rng = random.Random(seed)
+    return [
+        "，".join(rng.sample(SAMPLE_PHRASES, rng.randint(1, 4)))
+        for _ in range(count)
+    ]
+
+
+def timed(func: Callable[[], Any]) -> Tuple[float, Any]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+# ============================================
+# keyword：關鍵字偵測
+# ============================================
+
+def _first_rule(rules, text, default):
+    """原本的規則式偵測：依序逐條 any(kw in text)"""
+    for value, keywords in rules:
+        if any(kw in text for kw in keywords):
+            return value
+    return default
+
+
+def _all_rules(rules, text):
+    return [value for value, keywords in rules if any(kw in text for kw in keywords)]
+
+
+def bench_keyword(args):
+    from keyword_matcher import (
+        keyword_matcher, INTENT_RULES, EMOTION_RULES, URGENCY_RULES, SYMPTOM_RULES
+    )
+    from models import IntentCategory, EmotionCategory, UrgencyLevel
+
+    messages = generate_messages(args.messages)
+
+    def naive():
+        return [
+            (
+                _first_rule(INTENT_RULES, text, IntentCategory.OTHER),
+                _first_rule(EMOTION_RULES, text, EmotionCategory.NEUTRAL),
+                _first_rule(URGENCY_RULES, text, UrgencyLevel.NORMAL),
+                _all_rules(SYMPTOM_RULES, text),
+            )
+            for text in messages
+        ]
+
+    def automaton():
+        results = []
+        for text in messages:
+            d = keyword_matcher.detect(text)
+            results.append((d.intent, d.emotion, d.urgency, d.symptoms))
+        return results
+
+    naive_time, expected = timed(naive)
+    fast_time, actual = timed(automaton)
+
+    mismatches = sum(1 for a, b in zip(expected, actual) if a != b)
+    print(f"訊息數：{len(messages)}")
+    print(f"逐條比對：{naive_time * 1000:.1f} ms")
+    print(f"自動機：  {fast_time * 1000:.1f} ms（{naive_time / fast_time:.1f}x）")
+    print(f"結果不一致：{mismatches}")
+
+
+# ============================================
+# memory：訊息記憶體用量
+# ============================================
+
+def _legacy_message_class():
+    """重建舊版訊息類別：一般 dataclass（有 __dict__），標註欄位逐一展開"""
+    from dataclasses import make_dataclass, fields, field, MISSING
+    from models import ConversationMessage, ANNOTATION_FIELDS
+
+    spec = []
+    for f in fields(ConversationMessage):
+        if f.name == "annotations":
+            continue
+        if f.default_factory is not MISSING:
+            spec.append((f.name, f.type, field(default_factory=f.default_factory)))
+        elif f.default is not MISSING:
+            spec.append((f.name, f.type, field(default=f.default)))
+        else:
+            spec.append((f.name, f.type))
+    spec += [(name, object, field(default=None)) for name in ANNOTATION_FIELDS]
+    return make_dataclass("LegacyConversationMessage", spec)
+
+
+def _measure(factory: Callable[[int], Any], count: int) -> Tuple[float, list]:
+    """建立 count 筆物件，回傳每筆平均位元組數"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count, objects
+
+
+def bench_memory(args):
+    from datetime import datetime, timedelta
+    from models import ConversationMessage, MessageRole, MessageSource
+
+    legacy_class = _legacy_message_class()
+    contents = generate_messages(1000)
+    base_time = datetime(2025, 1, 1)
+
+    def fields_for(i: int):
+        # ID 每次重新組字串，模擬從日誌 / 工作表解碼的情況
+        return dict(
+            message_id=f"msg_{i:012d}",
+            session_id=f"sess_{i // 20:08d}",
+            patient_id=f"P{i % 500:04d}",
+            role=MessageRole.PATIENT,
+            content=contents[i % len(contents)],
+            source=MessageSource.PATIENT_RAW_INPUT,
+            timestamp=base_time + timedelta(seconds=i),
+            input_method="text",
+            raw_input=contents[i % len(contents)],
+        )
+
+    legacy_bytes, objects = _measure(lambda i: legacy_class(**fields_for(i)), args.messages)
+    del objects
+    compact_bytes, objects = _measure(lambda i: ConversationMessage(**fields_for(i)), args.messages)
+    del objects
+
+    print(f"訊息數：{args.messages:,}")
+    print(f"舊版（dict 欄位）：{legacy_bytes:,.0f} bytes/則，合計 {legacy_bytes * args.messages / 2**20:,.0f} MiB")
+    print(f"新版（__slots__）：{compact_bytes:,.0f} bytes/則，合計 {compact_bytes * args.messages / 2**20:,.0f} MiB")
+    print(f"節省 {1 - compact_bytes / legacy_bytes:.0%}")
+
+
+# ============================================
+# concurrency：多使用者並行
+# ============================================
+
+def _simulate_chat(store, chat_no: int, turns: int, pass_session: bool) -> List[str]:
+    """
+    模擬一個瀏覽器工作階段的完整對話，回傳發現的問題
+
+    病人 ID 刻意讓兩個對話共用（同一病人開兩個分頁），
+    pass_session=False 時不傳 session_id，改用分片記錄的活躍會話。
+    """
+    patient_id = f"P{chat_no // 2:04d}" if pass_session else f"Q{chat_no:04d}"
+    session = store.start_session(patient_id)
+    session_id = session.session_id if pass_session else None
+
+    for turn in range(turns):
+        store.add_patient_message(
+            patient_id, f"chat{chat_no}-turn{turn} {SAMPLE_PHRASES[turn % len(SAMPLE_PHRASES)]}",
+            raw_input="x", session_id=session_id
+        )
+        store.add_ai_message(patient_id, f"chat{chat_no}-reply{turn}", session_id=session_id)
+    store.end_session(session.session_id)
+
+    problems = []
+    messages = store.get_session_messages(session.session_id)
+    expected = []
+    for turn in range(turns):
+        expected += [f"chat{chat_no}-turn{turn}", f"chat{chat_no}-reply{turn}"]
+    actual = [m.content.split(" ")[0] for m in messages]
+    if actual != expected:
+        problems.append(f"chat{chat_no}: 會話內容不符（{len(actual)} / {len(expected)} 則）")
+    if any(m.patient_id != patient_id for m in messages):
+        problems.append(f"chat{chat_no}: 混入其他病人的訊息")
+    return problems
+
+
+def bench_concurrency(args):
+    from conversation_store import ConversationStore
+    from segment_log import SegmentLog
+
+    print(f"對話數：{args.chats}，每個對話 {args.turns} 輪（{args.chats * args.turns * 2:,} 則訊息）")
+    for threads in [int(t) for t in args.threads.split(",")]:
+        directory = tempfile.mkdtemp(prefix="aicare_bench_")
+        try:
+            store = ConversationStore(storage=SegmentLog(directory))
+
+            def run(chat_no: int) -> List[str]:
+                return _simulate_chat(store, chat_no, args.turns, pass_session=chat_no % 2 == 0)
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                elapsed, results = timed(lambda: list(executor.map(run, range(args.chats))))
+            problems = [p for chat_problems in results for p in chat_problems]
+
+            # 重啟後還原的結果也必須一致
+            store.close()
+            restored = ConversationStore(storage=SegmentLog(directory))
+            if len(restored.messages) != args.chats * args.turns * 2:
+                problems.append(f"還原後訊息數 {len(restored.messages)}")
+            restored.close()
+
+            rate = args.chats * args.turns * 2 / elapsed
+            print(f"執行緒 {threads:>4}：{elapsed:6.2f} 秒，{rate:,.0f} 則/秒，問題 {len(problems)} 個")
+            for problem in problems[:10]:
+                print(f"  - {problem}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# ============================================
+# columnar：分析資料載入
+# ============================================
+
+def bench_columnar(args):
+    import gzip
+    import json
+    import os
+    from conversation_store import ConversationStore
+    from columnar_export import export_messages_columnar, read_npz_columns, PARQUET_ENABLED
+    from research_export import write_jsonl_gz
+
+    store = ConversationStore(max_cached_records=args.messages * 2)
+    contents = generate_messages(1000)
+    for i in range(args.messages):
+        patient_id = f"P{i % 500:04d}"
+        store.add_patient_message(patient_id, contents[i % len(contents)], raw_input="x")
+        store.add_ai_message(patient_id, "收到，謝謝您的回報")
+
+    directory = tempfile.mkdtemp(prefix="aicare_bench_")
+    try:
+        json_path = os.path.join(directory, "messages.jsonl.gz")
+        write_jsonl_gz(store.iter_annotation_export(include_ai_responses=True), json_path)
+
+        def load_json():
+            with gzip.open(json_path, "rt", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            # 分析常見的第一步：轉成欄位
+            return {key: [r[key] for r in records] for key in records[0]}
+
+        results = [("gzip JSONL", json_path, load_json)]
+
+        npz_path, _ = export_messages_columnar(store, directory, include_ai_responses=True, fmt="npz")
+        results.append(("NumPy .npz", npz_path, lambda: read_npz_columns(npz_path)))
+        results.append(("NumPy .npz（代碼）", npz_path, lambda: read_npz_columns(npz_path, decode=False)))
+
+        if PARQUET_ENABLED:
+            import pyarrow.parquet as pq
+            parquet_path, _ = export_messages_columnar(store, directory, include_ai_responses=True, fmt="parquet")
+            results.append(("Parquet", parquet_path, lambda: pq.read_table(parquet_path)))
+
+        print(f"訊息數：{args.messages * 2:,}")
+        base_time = None
+        for label, path, load in results:
+            elapsed, _ = timed(load)
+            base_time = base_time or elapsed
+            size = os.path.getsize(path) / 2**20
+            print(f"{label:<16} {size:7.1f} MiB  載入 {elapsed * 1000:8.1f} ms（{base_time / elapsed:.1f}x）")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ============================================
+# search：全文檢索
+# ============================================
+
+SEARCH_QUERIES = ["咳血", "傷口 痛", "發燒 OR 胸悶", "喘 -走路", "顏色偏黃"]
+
+
+def bench_search(args):
+    from datetime import date, timedelta
+    from fulltext_index import FullTextIndex, ParsedQuery, KIND_MESSAGE
+
+    rng = random.Random(7)
+    messages = generate_messages(args.messages)
+    # 少量訊息加入罕見詞
+    for i in rng.sample(range(len(messages)), max(1, len(messages) // 1000)):
+        messages[i] += "，今天早上有咳血"
+
+    index = FullTextIndex()
+    first_day = date(2025, 1, 1)
+    build_time, _ = timed(lambda: [
+        index.add(f"m{i}", KIND_MESSAGE, f"P{i % 500:04d}", first_day + timedelta(days=i % 365),
+                  len(text), index.terms(text))
+        for i, text in enumerate(messages)
+    ])
+    print(f"訊息數：{len(messages):,}，索引詞 {index.term_count:,} 個，建立 {build_time:.1f} 秒")
+
+    def scan_match(parsed, text):
+        """原本的做法：逐筆 in 比對"""
+        if any(term in text for term in parsed.exclude):
+            return False
+        return any(all(term in text for term in include) for include in parsed.clauses)
+
+    for query in SEARCH_QUERIES:
+        parsed = ParsedQuery(query)
+        scan_time, expected = timed(lambda: [i for i, text in enumerate(messages) if scan_match(parsed, text)])
+        index_time, (docs, _) = timed(lambda: index.search(parsed))
+        verified = sum(1 for doc in docs.tolist() if parsed.matches(messages[doc]))
+        print(
+            f"{query:<12} 命中 {len(expected):>7,}（索引候選 {len(docs):,}，確認 {verified:,}）"
+            f"  掃描 {scan_time * 1000:8.1f} ms  索引 {index_time * 1000:7.1f} ms"
+        )
+
+
+# ============================================
+# replay：真實會話重播
+# ============================================
+
+def bench_replay(args):
+    from conversation_store import get_conversation_store
+    from session_replay import iter_session_ids, run_replay
+
+    conversation_store = get_conversation_store()
+
+    session_ids = list(iter_session_ids(conversation_store, completed_only=args.completed_only))
+    session_ids = session_ids[:args.sessions]
+    print(f"重播會話：{len(session_ids):,}")
+    summary = run_replay(session_ids, conversation_store)
+    print(summary.format())
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="AI-CARE Lung 效能量測")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    keyword = subparsers.add_parser("keyword", help="關鍵字偵測")
+    keyword.add_argument("--messages", type=int, default=20000)
+    keyword.set_defaults(func=bench_keyword)
+
+    memory = subparsers.add_parser("memory", help="訊息記憶體用量")
+    memory.add_argument("--messages", type=int, default=1000000)
+    memory.set_defaults(func=bench_memory)
+
+    concurrency = subparsers.add_parser("concurrency", help="多使用者並行壓力測試")
+    concurrency.add_argument("--chats", type=int, default=500)
+    concurrency.add_argument("--turns", type=int, default=10)
+    concurrency.add_argument("--threads", default="1,8,64,500", help="以逗號分隔的執行緒數")
+    concurrency.set_defaults(func=bench_concurrency)
+
+    columnar = subparsers.add_parser("columnar", help="分析資料載入")
+    columnar.add_argument("--messages", type=int, default=200000)
+    columnar.set_defaults(func=bench_columnar)
+
+    search = subparsers.add_parser("search", help="全文檢索")
+    search.add_argument("--messages", type=int, default=1000000)
+    search.set_defaults(func=bench_search)
+
+    replay = subparsers.add_parser("replay", help="真實會話重播")
+    replay.add_argument("--sessions", type=int, default=1000)
+    replay.add_argument("--completed-only", action="store_true")
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+AI-CARE Lung - 內容定址儲存模組
+==============================
+功能：
+1. 以 SHA-256 為鍵儲存長文字（相同內容只存一份）
+2. zlib 壓縮
+3. 原子寫入（先寫暫存檔再改名）
+4. 依雜湊值延遲讀取
+
+工作表只保留預覽與雜湊值，完整病人敘述存在本地，
+全表掃描的資料量不會因長訊息而膨脹。
+
+三軍總醫院 數位醫療中心
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+from typing import Optional
+
+from models import LOCAL_DATA_DIR
+
+# ============================================
+# 設定
+# ============================================
+
+# 內容存放位置
+BLOB_STORE_DIR = os.path.join(LOCAL_DATA_DIR, "blobs")
+
+# 工作表內保留的預覽長度（超過才另存）
+PREVIEW_LENGTH = 500
+
+
+class BlobStore:
+    """
+    內容定址儲存
+
+    檔案路徑為 <root>/<雜湊前兩碼>/<完整雜湊>，避免單一目錄檔案過多
+    """
+
+    def __init__(self, root: str = BLOB_STORE_DIR, compression_level: int = 6):
+        self.root = root
+        self.compression_level = compression_level
+
+    @staticmethod
+    def content_hash(text: str) -> str:
+        """計算內容雜湊"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.root, content_hash[:2], content_hash)
+
+    def put(self, text: str) -> str:
+        """
+        儲存內容
+
+        Returns:
+            內容雜湊（已存在時直接回傳，不重複寫入）
+        """
+        content_hash = self.content_hash(text)
+        path = self._path(content_hash)
+
+        if os.path.exists(path):
+            return content_hash
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        data = zlib.compress(text.encode("utf-8"), self.compression_level)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return content_hash
+
+    def get(self, content_hash: str) -> Optional[str]:
+        """依雜湊讀取內容，不存在時回傳 None"""
+        if not content_hash:
+            return None
+        try:
+            with open(self._path(content_hash), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def exists(self, content_hash: str) -> bool:
+        return bool(content_hash) and os.path.exists(self._path(content_hash))
+
+
+def split_content(text: str, store: "BlobStore", preview_length: int = PREVIEW_LENGTH):
+    """
+    長內容另存
+
+    Returns:
+        (preview, content_hash)：未超過預覽長度時 content_hash 為空字串
+    """
+    if len(text) <= preview_length:
+        return text, ""
+    return text[:preview_length], store.put(text)
+
+
+# ============================================
+# 全域實例
+# ============================================
+
+_blob_store: Optional[BlobStore] = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    """取得全域內容儲存"""
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore()
+        return _blob_store
@@ -0,0 +1,408 @@
+"""
+AI-CARE Lung - 族群症狀軌跡分析模組
+==================================
+功能：
+1. 一次載入所有症狀回報，轉為 NumPy 陣列（病人 × 術後天數 × 症狀）
+2. 向量化計算各術後天數的族群百分位帶（例如中位數、P90）
+3. 向量化計算滾動平均與趨勢斜率
+4. 個別病人與族群比較
+5. 分析結果依日期快取（每天只重算一次）
+
+三軍總醫院 數位醫療中心
+"""
+
+import warnings
+from datetime import datetime, date
+from typing import Dict, List, Optional, Any, Sequence, Tuple
+
+import numpy as np
+
+from sheet_schema import PATIENTS_SCHEMA, REPORTS_SCHEMA, SCORE_KEYS
+
+# ============================================
+# 常數
+# ============================================
+
+# 症狀順序（陣列第三軸）
+SYMPTOM_KEYS = SCORE_KEYS
+
+# 追蹤的術後天數範圍（0 ~ MAX_POST_OP_DAY-1）
+MAX_POST_OP_DAY = 90
+
+# 預設百分位帶
+DEFAULT_PERCENTILES = (10, 50, 90)
+
+
+def _parse_date(value: Any) -> Optional[date]:
+    """解析 YYYY-MM-DD 日期字串"""
+    if isinstance(value, date):
+        return value
+    if not value:
+        return None
+    try:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _parse_score(value: Any) -> float:
+    """解析分數，無效值回傳 NaN"""
+    if value is None or value == "":
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# ============================================
+# 族群分析引擎
+# ============================================
+
+class CohortAnalytics:
+    """
+    族群症狀軌跡分析
+
+    所有回報只載入一次，存成 scores[patient, post_op_day, symptom]，
+    缺值為 NaN。之後的百分位、滾動平均、斜率都是對整個陣列的向量化運算，
+    不需要逐一病人掃描回報。
+    """
+
+    def __init__(
+        self,
+        patient_ids: List[str],
+        scores: np.ndarray,
+        as_of: Optional[date] = None
+    ):
+        self.patient_ids = patient_ids
+        self.patient_index = {pid: i for i, pid in enumerate(patient_ids)}
+        self.scores = scores
+        self.as_of = as_of or date.today()
+
+        # 計算結果快取（key: (種類, 參數)）
+        self._cache: Dict[Tuple, np.ndarray] = {}
+
+    # ============================================
+    # 建立
+    # ============================================
+
+    @classmethod
+    def from_records(
+        cls,
+        reports: Sequence[Dict[str, Any]],
+        surgery_dates: Dict[str, date],
+        max_day: int = MAX_POST_OP_DAY,
+        as_of: Optional[date] = None
+    ) -> "CohortAnalytics":
+        """
+        由回報記錄建立
+
+        Args:
+            reports: [{"patient_id", "date", "scores": {"pain": 3, ...}}, ...]
+            surgery_dates: {patient_id: 手術日期}
+            max_day: 追蹤的術後天數上限
+        """
+        patient_ids = sorted(surgery_dates.keys())
+        patient_index = {pid: i for i, pid in enumerate(patient_ids)}
+
+        rows, days, values = [], [], []
+        for report in reports:
+            pid = report.get("patient_id")
+            if pid not in patient_index:
+                continue
+            report_date = _parse_date(report.get("date"))
+            surgery_date = surgery_dates[pid]
+            if report_date is None or surgery_date is None:
+                continue
+            day = (report_date - surgery_date).days
+            if not 0 <= day < max_day:
+                continue
+            scores = report.get("scores", {})
+            rows.append(patient_index[pid])
+            days.append(day)
+            values.append([_parse_score(scores.get(key)) for key in SYMPTOM_KEYS])
+
+        cube = np.full((len(patient_ids), max_day, len(SYMPTOM_KEYS)), np.nan, dtype=np.float32)
+        if rows:
+            # 同一天多筆回報時，以較晚的一筆為準（後寫入覆蓋前者）
+            cube[np.asarray(rows), np.asarray(days)] = np.asarray(values, dtype=np.float32)
+
+        return cls(patient_ids, cube, as_of=as_of)
+
+    @classmethod
+    def from_sheet_values(
+        cls,
+        report_values: List[List[Any]],
+        patient_values: List[List[Any]],
+        max_day: int = MAX_POST_OP_DAY,
+        as_of: Optional[date] = None
+    ) -> "CohortAnalytics":
+        """
+        由工作表原始資料建立（get_all_values 的結果，第一列為標題）
+
+        欄位位置依工作表結構定義由標題列決定，之後逐列以位置取值
+        """
+        surgery_dates: Dict[str, date] = {}
+        if patient_values:
+            layout = PATIENTS_SCHEMA.bind(patient_values[0])
+            id_col = layout.index("patient_id")
+            surgery_col = layout.index("surgery_date")
+            for row in patient_values[1:]:
+                if len(row) > max(id_col, surgery_col) and row[id_col]:
+                    surgery_dates[row[id_col]] = _parse_date(row[surgery_col])
+
+        reports: List[Dict[str, Any]] = []
+        if report_values:
+            layout = REPORTS_SCHEMA.bind(report_values[0])
+            id_col = layout.index("patient_id")
+            date_col = layout.index("report_date")
+            score_cols = [(key, layout.index(key)) for key in SYMPTOM_KEYS if key in layout.positions]
+            for row in report_values[1:]:
+                if len(row) <= max(id_col, date_col):
+                    continue
+                reports.append({
+                    "patient_id": row[id_col],
+                    "date": row[date_col],
+                    "scores": {key: row[col] if col < len(row) else None for key, col in score_cols}
+                })
+
+        return cls.from_records(reports, surgery_dates, max_day=max_day, as_of=as_of)
+
+    # ============================================
+    # 向量化計算
+    # ============================================
+
+    @property
+    def observed(self) -> np.ndarray:
+        """有回報的位置（病人 × 天數 × 症狀）"""
+        return ~np.isnan(self.scores)
+
+    def counts_by_day(self) -> np.ndarray:
+        """各術後天數、各症狀的回報人數（天數 × 症狀）"""
+        key = ("counts",)
+        if key not in self._cache:
+            self._cache[key] = self.observed.sum(axis=0)
+        return self._cache[key]
+
+    def percentile_bands(self, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> np.ndarray:
+        """
+        族群百分位帶
+
+        Returns:
+            陣列 [len(percentiles), 天數, 症狀]，無資料處為 NaN
+        """
+        key = ("percentiles", tuple(percentiles))
+        if key not in self._cache:
+            with warnings.catch_warnings():
+                # 某些天數沒有任何回報時 nanpercentile 會警告，結果為 NaN 即可
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                self._cache[key] = np.nanpercentile(self.scores, list(percentiles), axis=0)
+        return self._cache[key]
+
+    def rolling_mean(self, window: int = 7) -> np.ndarray:
+        """
+        每位病人的滾動平均（忽略缺值）
+
+        Returns:
+            陣列 [病人, 天數, 症狀]，第 d 天為 d-window+1 ~ d 的平均
+        """
+        key = ("rolling_mean", window)
+        if key not in self._cache:
+            sums = self._window_sum(np.nan_to_num(self.scores), window)
+            counts = self._window_sum(self.observed.astype(np.float32), window)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                self._cache[key] = np.where(counts > 0, sums / counts, np.nan)
+        return self._cache[key]
+
+    def slopes(self, window: int = 7) -> np.ndarray:
+        """
+        每位病人的趨勢斜率（分/天，最小平方法，忽略缺值）
+
+        正值代表症狀加重，負值代表改善。窗口內少於兩筆回報時為 NaN。
+
+        Returns:
+            陣列 [病人, 天數, 症狀]
+        """
+        key = ("slopes", window)
+        if key not in self._cache:
+            mask = self.observed.astype(np.float64)
+            y = np.nan_to_num(self.scores).astype(np.float64)
+            x = np.arange(self.scores.shape[1], dtype=np.float64)[None, :, None] * mask
+
+            n = self._window_sum(mask, window)
+            sx = self._window_sum(x, window)
+            sy = self._window_sum(y, window)
+            sxy = self._window_sum(x * y, window)
+            sxx = self._window_sum(x * x, window)
+
+            denominator = n * sxx - sx * sx
+            with np.errstate(invalid="ignore", divide="ignore"):
+                slope = (n * sxy - sx * sy) / denominator
+            self._cache[key] = np.where((n >= 2) & (denominator > 0), slope, np.nan)
+        return self._cache[key]
+
+    def sorted_by_day(self) -> np.ndarray:
+        """各術後天數、各症狀的族群分數排序（沿病人軸，NaN 排在最後）"""
+        key = ("sorted",)
+        if key not in self._cache:
+            self._cache[key] = np.sort(self.scores, axis=0)
+        return self._cache[key]
+
+    def percentile_ranks(self) -> np.ndarray:
+        """
+        每筆回報在同術後天數族群中的百分等級（0-100）
+
+        對已排序的族群分數以二分搜尋計算「小於或等於」的人數，
+        每個（天數, 症狀）為 O(P log P)。只需要單一病人時用 patient_percentile_ranks。
+
+        Returns:
+            陣列 [病人, 天數, 症狀]
+        """
+        key = ("ranks",)
+        if key not in self._cache:
+            counts = self.counts_by_day()
+            ordered = self.sorted_by_day()
+            observed = self.observed
+            ranks = np.full(self.scores.shape, np.nan, dtype=np.float32)
+            for d, s in zip(*np.nonzero(counts)):
+                n = counts[d, s]
+                rows = observed[:, d, s]
+                at_or_below = np.searchsorted(ordered[:n, d, s], self.scores[rows, d, s], side="right")
+                ranks[rows, d, s] = at_or_below / n * 100
+            self._cache[key] = ranks
+        return self._cache[key]
+
+    def patient_percentile_ranks(self, i: int, post_op_day: int) -> np.ndarray:
+        """
+        單一病人某一術後天數的百分等級（不計算其他病人）
+
+        Returns:
+            陣列 [症狀]，該症狀沒有回報時為 NaN
+        """
+        counts = self.counts_by_day()[post_op_day]
+        ordered = self.sorted_by_day()[:, post_op_day, :]
+        scores = self.scores[i, post_op_day]
+        ranks = np.full(scores.shape, np.nan, dtype=np.float32)
+        for s in np.flatnonzero(~np.isnan(scores)):
+            n = counts[s]
+            ranks[s] = np.searchsorted(ordered[:n, s], scores[s], side="right") / n * 100
+        return ranks
+
+    @staticmethod
+    def _window_sum(values: np.ndarray, window: int) -> np.ndarray:
+        """沿天數軸計算尾端窗口總和（以累積和實作）"""
+        cumulative = np.cumsum(values, axis=1, dtype=np.float64)
+        shifted = np.zeros_like(cumulative)
+        shifted[:, window:] = cumulative[:, :-window]
+        return cumulative - shifted
+
+    # ============================================
+    # 查詢
+    # ============================================
+
+    def cohort_band(self, post_op_day: int, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> Dict[str, Dict[str, Any]]:
+        """
+        取得某一術後天數的族群百分位
+
+        Returns:
+            {"pain": {"n": 42, "p50": 3.0, "p90": 6.0, ...}, ...}
+        """
+        if not 0 <= post_op_day < self.scores.shape[1]:
+            return {}
+
+        bands = self.percentile_bands(percentiles)[:, post_op_day, :]
+        counts = self.counts_by_day()[post_op_day]
+
+        result = {}
+        for s, symptom in enumerate(SYMPTOM_KEYS):
+            entry: Dict[str, Any] = {"n": int(counts[s])}
+            for p, value in zip(percentiles, bands[:, s]):
+                entry[f"p{int(p)}"] = None if np.isnan(value) else round(float(value), 2)
+            result[symptom] = entry
+        return result
+
+    def compare_patient(self, patient_id: str, post_op_day: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        比較病人與同術後天數的族群
+
+        Args:
+            patient_id: 病人ID
+            post_op_day: 術後天數（預設為該病人最近一次回報的天數）
+
+        Returns:
+            {"pain": {"score", "p50", "p90", "percentile_rank", "trend"}, ...}
+        """
+        i = self.patient_index.get(patient_id)
+        if i is None:
+            return {}
+
+        if post_op_day is None:
+            reported_days = np.flatnonzero(self.observed[i].any(axis=1))
+            if len(reported_days) == 0:
+                return {}
+            post_op_day = int(reported_days[-1])
+
+        band = self.cohort_band(post_op_day, percentiles=(50, 90))
+        ranks = self.patient_percentile_ranks(i, post_op_day)
+        trend = self.slopes()[i, post_op_day]
+        scores = self.scores[i, post_op_day]
+
+        result = {}
+        for s, symptom in enumerate(SYMPTOM_KEYS):
+            result[symptom] = {
+                "post_op_day": post_op_day,
+                "score": None if np.isnan(scores[s]) else float(scores[s]),
+                "p50": band[symptom]["p50"],
+                "p90": band[symptom]["p90"],
+                "cohort_size": band[symptom]["n"],
+                "percentile_rank": None if np.isnan(ranks[s]) else round(float(ranks[s]), 1),
+                "trend": None if np.isnan(trend[s]) else round(float(trend[s]), 2)
+            }
+        return result
+
+
+# ============================================
+# 依日期快取
+# ============================================
+
+_daily_cache: Dict[date, CohortAnalytics] = {}
+
+
+def load_cohort_analytics(spreadsheet, max_day: int = MAX_POST_OP_DAY) -> Optional[CohortAnalytics]:
+    """
+    從試算表載入族群分析（每張工作表只讀取一次）
+    """
+    from google_sheet_db import SHEET_PATIENTS, SHEET_REPORTS
+
+    if not spreadsheet:
+        return None
+
+    try:
+        report_values = spreadsheet.worksheet(SHEET_REPORTS).get_all_values()
+        patient_values = spreadsheet.worksheet(SHEET_PATIENTS).get_all_values()
+    except Exception:
+        return None
+
+    return CohortAnalytics.from_sheet_values(report_values, patient_values, max_day=max_day)
+
+
+def get_cohort_analytics(spreadsheet=None, as_of: Optional[date] = None) -> Optional[CohortAnalytics]:
+    """
+    取得當日的族群分析（同一天內重複呼叫不會重新讀取試算表）
+    """
+    as_of = as_of or date.today()
+
+    if as_of not in _daily_cache:
+        if spreadsheet is None:
+            from google_sheet_db import get_spreadsheet
+            spreadsheet = get_spreadsheet()
+
+        analytics = load_cohort_analytics(spreadsheet)
+        if analytics is None:
+            return None
+
+        # 只保留當日結果
+        _daily_cache.clear()
+        _daily_cache[as_of] = analytics
+
+    return _daily_cache[as_of]
@@ -0,0 +1,374 @@
+"""
+AI-CARE Lung - 對話欄式匯出模組
+==============================
+功能：
+1. 將對話訊息轉為欄式陣列（每個欄位一個陣列，分塊建立）
+2. 列舉欄位（角色、來源、意圖、情緒、緊急程度）以字典編碼：整數代碼 + 類別表
+3. 有安裝 pyarrow 時寫出 Parquet；否則寫出 NumPy .npz
+4. read_npz_columns 讀回 .npz，可直接交給 pandas.DataFrame
+
+研究分析不必再解析整份 JSON，載入快、檔案小。
+
+    python columnar_export.py 輸出目錄 [--start 2025-01-01] [--end 2025-12-31] [--include-ai] [--format npz]
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import os
+from datetime import date, datetime
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Tuple
+
+import numpy as np
+
+from models import (
+    ConversationMessage, MessageRole, MessageSource,
+    IntentCategory, EmotionCategory, UrgencyLevel
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_ENABLED = True
+except ImportError:
+    PARQUET_ENABLED = False
+
+# ============================================
+# 設定
+# ============================================
+
+# 每塊列數（Parquet 的 row group 大小；也是建立陣列時的記憶體上限）
+DEFAULT_CHUNK_ROWS = 65536
+
+# .npz 格式版本
+NPZ_FORMAT_VERSION = 1
+
+
+# ============================================
+# 欄位定義
+# ============================================
+
+class DictionaryColumn:
+    """
+    字典編碼欄位
+
+    固定類別（列舉）的代碼在每個檔案都相同；其餘欄位依出現順序新增類別。
+    None 的代碼為 -1。
+    """
+
+    def __init__(self, categories: Optional[List[Any]] = None):
+        self.categories: List[Any] = list(categories or [])
+        self._codes: Dict[Any, int] = {value: i for i, value in enumerate(self.categories)}
+        self.values: List[int] = []
+
+    def append(self, value: Any):
+        if value is None:
+            self.values.append(-1)
+            return
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.categories)
+            self.categories.append(value)
+        self.values.append(code)
+
+    def take(self) -> np.ndarray:
+        codes = np.asarray(self.values, dtype=np.int32)
+        self.values = []
+        return codes
+
+
+def _enum_values(enum_class) -> List[Any]:
+    return [member.value for member in enum_class]
+
+
+# 欄位：(名稱, 類型)；類型為 "string"、"timestamp"、"bool"、"int" 或字典類別表（None 表示動態）
+MESSAGE_COLUMNS: List[Tuple[str, Any]] = [
+    ("message_id", "string"),
+    ("session_id", "dictionary"),
+    ("patient_id", "dictionary"),
+    ("timestamp", "timestamp"),
+    ("role", _enum_values(MessageRole)),
+    ("source", _enum_values(MessageSource)),
+    ("content", "string"),
+    ("input_method", "dictionary"),
+    ("template_id", "dictionary"),
+    ("detected_intent", _enum_values(IntentCategory)),
+    ("detected_emotion", _enum_values(EmotionCategory)),
+    ("detected_urgency", _enum_values(UrgencyLevel)),
+    ("detection_version", "dictionary"),
+    ("needs_human_review", "bool"),
+    ("content_length", "int"),
+]
+
+
+def _message_row(message: ConversationMessage) -> Tuple[Any, ...]:
+    """訊息 → 欄位值（順序同 MESSAGE_COLUMNS）"""
+    return (
+        message.message_id,
+        message.session_id,
+        message.patient_id,
+        message.timestamp,
+        message.role.value,
+        message.source.value,
+        message.content,
+        message.input_method,
+        message.template_id,
+        message.detected_intent.value,
+        message.detected_emotion.value,
+        message.detected_urgency.value,
+        message.detection_version,
+        message.needs_human_review,
+        len(message.content),
+    )
+
+
+class ColumnBuilder:
+    """逐列加入，分塊產生 NumPy 陣列"""
+
+    def __init__(self, columns: List[Tuple[str, Any]] = MESSAGE_COLUMNS):
+        self.columns = columns
+        self.dictionaries: Dict[str, DictionaryColumn] = {}
+        self._buffers: List[Any] = []
+        for name, kind in columns:
+            if isinstance(kind, list):
+                column = self.dictionaries[name] = DictionaryColumn(kind)
+            elif kind == "dictionary":
+                column = self.dictionaries[name] = DictionaryColumn()
+            else:
+                column = []
+            self._buffers.append(column)
+        self.rows = 0
+
+    def append(self, row: Tuple[Any, ...]):
+        for buffer, value in zip(self._buffers, row):
+            buffer.append(value)
+        self.rows += 1
+
+    def take(self) -> Dict[str, Any]:
+        """
+        取出目前累積的列
+
+        Returns:
+            欄位名稱 → 陣列（字典欄位為 int32 代碼；字串欄位為 Python 字串列表）
+        """
+        chunk: Dict[str, Any] = {}
+        for i, (name, kind) in enumerate(self.columns):
+            buffer = self._buffers[i]
+            if isinstance(buffer, DictionaryColumn):
+                chunk[name] = buffer.take()
+                continue
+            if kind == "timestamp":
+                chunk[name] = np.array(buffer, dtype="datetime64[us]")
+            elif kind == "bool":
+                chunk[name] = np.array(buffer, dtype=np.bool_)
+            elif kind == "int":
+                chunk[name] = np.array(buffer, dtype=np.int64)
+            else:
+                chunk[name] = buffer
+            self._buffers[i] = []
+        self.rows = 0
+        return chunk
+
+
+def iter_message_rows(
+    store,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    include_ai_responses: bool = False
+) -> Iterator[Tuple[Any, ...]]:
+    """依日期索引逐筆讀取訊息（一次只持有一筆訊息物件）"""
+    roles = None if include_ai_responses else [MessageRole.PATIENT.value]
+    for message_id in store.iter_message_ids(start_date, end_date, roles):
+        message = store.messages.get(message_id)
+        if message is not None:
+            yield _message_row(message)
+
+
+# ============================================
+# 寫出
+# ============================================
+
+def _arrow_column(kind: Any, values: Any, categories: Optional[List[Any]]):
+    if categories is not None:
+        codes = pa.array(values, mask=values < 0)
+        # 動態類別固定為字串型別，各 row group 的結構才會一致（即使某塊全為 None）
+        dictionary = pa.array(categories, type=pa.string()) if kind == "dictionary" else pa.array(categories)
+        return pa.DictionaryArray.from_arrays(codes, dictionary)
+    if kind == "string":
+        return pa.array(values, type=pa.string())
+    return pa.array(values)
+
+
+def write_parquet(rows: Iterable[Tuple[Any, ...]], path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> int:
+    """逐塊寫出 Parquet（每塊一個 row group），回傳筆數"""
+    if not PARQUET_ENABLED:
+        raise RuntimeError("未安裝 pyarrow，無法寫出 Parquet")
+
+    builder = ColumnBuilder()
+    writer = None
+    count = 0
+
+    def flush():
+        nonlocal writer
+        chunk = builder.take()
+        arrays = [
+            _arrow_column(kind, chunk[name], _categories(builder, name))
+            for name, kind in builder.columns
+        ]
+        table = pa.Table.from_arrays(arrays, names=[name for name, _ in builder.columns])
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema, compression="zstd")
+        writer.write_table(table)
+
+    try:
+        for row in rows:
+            builder.append(row)
+            count += 1
+            if builder.rows >= chunk_rows:
+                flush()
+        if builder.rows or writer is None:
+            flush()
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def _categories(builder: ColumnBuilder, name: str) -> Optional[List[Any]]:
+    column = builder.dictionaries.get(name)
+    return list(column.categories) if column is not None else None
+
+
+def _encode_strings(chunks: List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """字串欄位 → (UTF-8 位元組, 位移)，與 Arrow 字串欄位相同的排列方式"""
+    encoded = [value.encode("utf-8") for chunk in chunks for value in chunk]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def write_npz(rows: Iterable[Tuple[Any, ...]], path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> int:
+    """
+    寫出壓縮的 NumPy .npz，回傳筆數
+
+    字典欄位存 <欄位>（int32 代碼）與 <欄位>__categories；
+    字串欄位存 <欄位>__data（UTF-8）與 <欄位>__offsets。
+    """
+    builder = ColumnBuilder()
+    chunks: Dict[str, List[Any]] = {name: [] for name, _ in builder.columns}
+    count = 0
+
+    for row in rows:
+        builder.append(row)
+        count += 1
+        if builder.rows >= chunk_rows:
+            for name, values in builder.take().items():
+                chunks[name].append(values)
+    for name, values in builder.take().items():
+        chunks[name].append(values)
+
+    arrays: Dict[str, np.ndarray] = {"__format__": np.array([NPZ_FORMAT_VERSION])}
+    for name, kind in builder.columns:
+        if kind == "string":
+            arrays[f"{name}__data"], arrays[f"{name}__offsets"] = _encode_strings(chunks[name])
+            continue
+        arrays[name] = np.concatenate(chunks[name])
+        categories = _categories(builder, name)
+        if categories is not None:
+            arrays[f"{name}__categories"] = np.array(categories) if categories else np.array([], dtype=str)
+
+    np.savez_compressed(path, **arrays)
+    return count
+
+
+def read_npz_columns(path: str, decode: bool = True) -> Dict[str, np.ndarray]:
+    """
+    讀回 write_npz 的檔案
+
+    Args:
+        decode: 字典欄位轉回原值（None 仍為 None）；False 時保留整數代碼
+
+    Returns:
+        欄位名稱 → 陣列（可直接 pandas.DataFrame(...)）
+    """
+    columns: Dict[str, np.ndarray] = {}
+    with np.load(path, allow_pickle=False) as data:
+        for name, kind in MESSAGE_COLUMNS:
+            if kind == "string":
+                raw = data[f"{name}__data"].tobytes()
+                offsets = data[f"{name}__offsets"].tolist()
+                column = np.empty(len(offsets) - 1, dtype=object)
+                column[:] = [raw[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+                columns[name] = column
+                continue
+
+            values = data[name]
+            categories_key = f"{name}__categories"
+            if decode and categories_key in data:
+                categories = np.append(data[categories_key].astype(object), None)
+                values = categories[values]   # 代碼 -1 對到最後的 None
+            columns[name] = values
+    return columns
+
+
+def export_messages_columnar(
+    store=None,
+    directory: str = ".",
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    include_ai_responses: bool = False,
+    fmt: str = "auto"
+) -> Tuple[str, int]:
+    """
+    匯出對話訊息為欄式檔案
+
+    Args:
+        store: ConversationStore（預設為全域實例）
+        fmt: "parquet"、"npz"，或 "auto"（有 pyarrow 時用 Parquet）
+
+    Returns:
+        (檔案路徑, 筆數)
+    """
+    if store is None:
+        from conversation_store import get_conversation_store
+        store = get_conversation_store()
+
+    if fmt == "auto":
+        fmt = "parquet" if PARQUET_ENABLED else "npz"
+    if fmt not in ("parquet", "npz"):
+        raise ValueError(f"不支援的匯出格式: {fmt}")
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"conversation_messages_{datetime.now().strftime('%Y%m%d')}.{fmt}")
+    rows = iter_message_rows(store, start_date, end_date, include_ai_responses)
+
+    if fmt == "parquet":
+        return path, write_parquet(rows, path)
+    return path, write_npz(rows, path)
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="匯出對話訊息（欄式格式）")
+    parser.add_argument("directory", help="輸出目錄")
+    parser.add_argument("--start", type=date.fromisoformat, default=None, help="起始日期 YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, default=None, help="結束日期 YYYY-MM-DD")
+    parser.add_argument("--include-ai", action="store_true", help="一併匯出 AI / 系統訊息")
+    parser.add_argument("--format", default="auto", choices=["auto", "parquet", "npz"])
+    args = parser.parse_args()
+
+    path, count = export_messages_columnar(
+        directory=args.directory,
+        start_date=args.start,
+        end_date=args.end,
+        include_ai_responses=args.include_ai,
+        fmt=args.format
+    )
+    print(f"已匯出 {count} 筆：{path}")
+
+
+if __name__ == "__main__":
+    main()
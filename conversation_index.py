@@ -0,0 +1,243 @@
+"""
+AI-CARE Lung - 對話次要索引模組
+==============================
+功能：
+1. 病人 → 訊息ID（依角色分組）
+2. 日期 → 訊息ID（依日期排序的分桶，支援區間查詢）
+3. 角色 → 訊息ID
+4. 病人 → 會話ID、病人 → 開放式回應ID
+5. 病人對話統計（訊息數、字數、意圖 / 情緒分布）隨寫入累加
+
+索引在寫入時同步維護，查詢成本只與回傳筆數有關，
+不會隨整體資料量線性變慢。
+
+共用部分（日期、角色）與病人部分（其餘）分開維護：對話儲存以全域鎖保護前者，
+以病人分片鎖保護後者，不同分片的病人寫入時不互相等待。
+
+三軍總醫院 數位醫療中心
+"""
+
+import heapq
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass, field, asdict
+from datetime import date
+from typing import Dict, List, Optional, Any, Iterator, Callable
+
+from models import ConversationMessage, ConversationSession, OpenEndedResponse, MessageRole
+
+
+@dataclass
+class PatientAggregate:
+    """單一病人的對話統計（只計病人訊息）"""
+    total_messages: int = 0
+    total_words: int = 0
+    intent_distribution: Dict[str, int] = field(default_factory=dict)
+    emotion_distribution: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, words: int, intent: str, emotion: str):
+        self.total_messages += 1
+        self.total_words += words
+        self.intent_distribution[intent] = self.intent_distribution.get(intent, 0) + 1
+        self.emotion_distribution[emotion] = self.emotion_distribution.get(emotion, 0) + 1
+
+    def relabel(self, old_intent: str, old_emotion: str, new_intent: str, new_emotion: str):
+        """預設標註更新後調整分布"""
+        _move(self.intent_distribution, old_intent, new_intent)
+        _move(self.emotion_distribution, old_emotion, new_emotion)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PatientAggregate":
+        return cls(**data)
+
+
+def _move(distribution: Dict[str, int], old: str, new: str):
+    if old == new:
+        return
+    remaining = distribution.get(old, 0) - 1
+    if remaining > 0:
+        distribution[old] = remaining
+    else:
+        distribution.pop(old, None)
+    distribution[new] = distribution.get(new, 0) + 1
+
+
+def message_words(message: ConversationMessage) -> int:
+    """統計用字數（以空白分詞）"""
+    return len(message.content.split())
+
+
+class ConversationIndexes:
+    """
+    對話次要索引
+
+    add_message = add_shared_message（日期、角色）+ add_patient_message（病人訊息、統計）；
+    add_session / add_response / relabel_message 只動到單一病人的資料。
+    """
+
+    def __init__(self):
+        # (病人ID, 角色) → 訊息ID
+        self.patient_role: Dict[str, Dict[str, List[str]]] = {}
+        # 日期 → 角色 → 訊息ID
+        self.date_role: Dict[date, Dict[str, List[str]]] = {}
+        self._dates: List[date] = []
+        # 角色 → 訊息ID
+        self.role_messages: Dict[str, List[str]] = {}
+        # 病人 → 會話ID / 開放式回應ID
+        self.patient_sessions: Dict[str, List[str]] = {}
+        self.patient_responses: Dict[str, List[str]] = {}
+        # 病人 → 對話統計
+        self.patient_stats: Dict[str, PatientAggregate] = {}
+
+    # ============================================
+    # 維護
+    # ============================================
+
+    def add_message(self, message: ConversationMessage):
+        self.add_shared_message(message)
+        self.add_patient_message(message)
+
+    def add_shared_message(self, message: ConversationMessage):
+        """日期與角色索引（所有病人共用）"""
+        message_id, role = message.message_id, message.role.value
+        msg_date = message.timestamp.date()
+
+        buckets = self.date_role.get(msg_date)
+        if buckets is None:
+            buckets = self.date_role[msg_date] = {}
+            insort(self._dates, msg_date)
+        buckets.setdefault(role, []).append(message_id)
+
+        self.role_messages.setdefault(role, []).append(message_id)
+
+    def add_patient_message(self, message: ConversationMessage):
+        """病人的訊息索引與統計"""
+        self.patient_role.setdefault(message.patient_id, {}).setdefault(
+            message.role.value, []
+        ).append(message.message_id)
+        if message.role == MessageRole.PATIENT:
+            self.aggregate(message.patient_id).add(
+                message_words(message),
+                message.detected_intent.value,
+                message.detected_emotion.value
+            )
+
+    def relabel_message(self, patient_id: str, old_labels: tuple, new_labels: tuple):
+        """
+        病人訊息的預設標註變動
+
+        Args:
+            old_labels / new_labels: (intent, emotion) 字串值
+        """
+        if old_labels != new_labels:
+            self.aggregate(patient_id).relabel(*old_labels, *new_labels)
+
+    def aggregate(self, patient_id: str) -> PatientAggregate:
+        stats = self.patient_stats.get(patient_id)
+        if stats is None:
+            stats = self.patient_stats[patient_id] = PatientAggregate()
+        return stats
+
+    def add_session(self, session: ConversationSession):
+        self.patient_sessions.setdefault(session.patient_id, []).append(session.session_id)
+
+    def add_response(self, response: OpenEndedResponse):
+        self.patient_responses.setdefault(response.patient_id, []).append(response.response_id)
+
+    # ============================================
+    # 查詢
+    # ============================================
+
+    def patient_message_ids(self, patient_id: str, role: Optional[str] = None) -> List[str]:
+        """病人的訊息ID（可限定角色）"""
+        by_role = self.patient_role.get(patient_id, {})
+        if role is not None:
+            return list(by_role.get(role, []))
+        return [mid for ids in by_role.values() for mid in ids]
+
+    def iter_date_range(
+        self,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        roles: Optional[List[str]] = None,
+        key: Optional[Callable[[str], Any]] = None
+    ) -> Iterator[str]:
+        """
+        依日期順序列出區間內的訊息ID（可限定角色）
+
+        同一天有多個角色時，以 key（訊息ID → 排序值，例如訊息時間）合併各角色的串列；
+        未提供 key 時同一天內依角色分組。
+        """
+        lo = bisect_left(self._dates, start_date) if start_date else 0
+        hi = bisect_right(self._dates, end_date) if end_date else len(self._dates)
+
+        for msg_date in self._dates[lo:hi]:
+            buckets = self.date_role[msg_date]
+            streams = [buckets[role] for role in (roles if roles is not None else list(buckets)) if role in buckets]
+            if key is not None and len(streams) > 1:
+                # 各角色串列已依寫入順序（即時間）排列
+                yield from heapq.merge(*streams, key=key)
+            else:
+                for stream in streams:
+                    yield from stream
+
+    def role_message_ids(self, role: str) -> List[str]:
+        return list(self.role_messages.get(role, []))
+
+    def role_count(self, role: str) -> int:
+        return len(self.role_messages.get(role, []))
+
+    def patient_session_ids(self, patient_id: str) -> List[str]:
+        return list(self.patient_sessions.get(patient_id, []))
+
+    def patient_response_ids(self, patient_id: str) -> List[str]:
+        return list(self.patient_responses.get(patient_id, []))
+
+    @property
+    def dates(self) -> List[date]:
+        return list(self._dates)
+
+    # ============================================
+    # 快照
+    # ============================================
+
+    def export_state(self) -> Dict[str, Any]:
+        """快照用（複製 ID 串列，之後可在鎖外序列化）"""
+        def copy_roles(by_role: Dict[str, List[str]]) -> Dict[str, List[str]]:
+            return {role: list(values) for role, values in by_role.items()}
+
+        return {
+            "patient_role": {pid: copy_roles(by_role) for pid, by_role in self.patient_role.items()},
+            "date_role": {d.isoformat(): copy_roles(buckets) for d, buckets in self.date_role.items()},
+            "role_messages": copy_roles(self.role_messages),
+            "patient_sessions": copy_roles(self.patient_sessions),
+            "patient_responses": copy_roles(self.patient_responses),
+            "patient_stats": {pid: asdict(stats) for pid, stats in self.patient_stats.items()}
+        }
+
+    def restore_state(self, state: Dict[str, Any], canonical: Optional[Callable[[str], str]] = None):
+        """
+        由快照還原
+
+        Args:
+            canonical: 訊息ID → 共用字串物件（避免每個索引各自持有一份 ID 字串）
+        """
+        def ids(values: List[str]) -> List[str]:
+            return [canonical(v) for v in values] if canonical else values
+
+        self.patient_role = {
+            patient_id: {role: ids(values) for role, values in by_role.items()}
+            for patient_id, by_role in state.get("patient_role", {}).items()
+        }
+        self.date_role = {
+            date.fromisoformat(d): {role: ids(values) for role, values in buckets.items()}
+            for d, buckets in state.get("date_role", {}).items()
+        }
+        self._dates = sorted(self.date_role)
+        self.role_messages = {
+            role: ids(values) for role, values in state.get("role_messages", {}).items()
+        }
+        self.patient_sessions = state.get("patient_sessions", {})
+        self.patient_responses = state.get("patient_responses", {})
+        self.patient_stats = {
+            pid: PatientAggregate.from_dict(data) for pid, data in state.get("patient_stats", {}).items()
+        }
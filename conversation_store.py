@@ -6,23 +6,420 @@ AI-CARE Lung 病人端 - 對話儲存與分析模組
 2. 對話會話管理
 3. 簡易 NLP 前處理（為未來標註準備）
 4. 資料匯出（供標註團隊使用）
+5. 附加式日誌持久化（重啟後自動重播），記憶體只保留有限工作集
+6. 病人 / 日期 / 角色次要索引（統計與區間匯出不需全表掃描）
+7. 已結束會話依 LRU 與位元組預算移出記憶體（壓縮檔，需要時讀回）
+8. 多使用者並行：依病人分片的鎖（病人索引、統計、會話內容、活躍會話），
+   全域鎖只涵蓋日誌附加與共用索引（每個 Streamlit 工作階段各自的會話互不干擾）
+9. 非同步偵測：病人訊息先寫入，偵測由背景執行緒補上（緊急訊息走快速路徑）
+10. 分層抽樣標註批次（例如意圖 × 緊急程度平衡，排除已標註訊息）
+11. 近似重複群集（MinHash / LSH），匯出與抽樣可每群只取一筆
+12. 全文檢索（中文二元組倒排索引，支援布林查詢與日期 / 病人篩選）
+13. 標註回匯：依 message_id 批次合併多位標註者的人工標註
+14. 症狀 / 部位 / 嚴重程度實體片段（含否定），匯出時可預填 annotated_entities
 
 三軍總醫院 數位醫療中心
 """
 
+import atexit
+import gzip
 import json
+import os
+import random
 import re
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from enum import Enum
 from datetime import datetime, date
-from typing import Dict, List, Optional, Any, Tuple
+from typing import Dict, List, Optional, Any, Tuple, Callable, Iterator, Iterable, Set
 from dataclasses import dataclass, asdict
-import uuid
+import zlib
 
 from models import (
     ConversationMessage, ConversationSession, OpenEndedResponse,
     MessageRole, MessageSource, IntentCategory, EmotionCategory, UrgencyLevel,
     generate_message_id, generate_session_id, generate_response_id,
-    SYMPTOM_DEFINITIONS, SymptomType
+    LOCAL_DATA_DIR
 )
+from segment_log import SegmentLog, LogPosition, encode_record
+from conversation_index import ConversationIndexes, PatientAggregate, message_words
+from keyword_matcher import keyword_matcher
+from text_classifier import detect, DETECTION_VERSION
+from stratified_sampler import StratifiedReservoir
+from near_duplicates import NearDuplicateIndex
+from fulltext_index import FullTextIndex, ParsedQuery, KIND_MESSAGE, KIND_RESPONSE, KIND_NAMES
+from annotation_import import merge_annotator_labels, entities_fingerprint
+from entity_extractor import entity_extractor
+
+# ============================================
+# 儲存設定
+# ============================================
+
+# 對話日誌位置
+CONVERSATION_LOG_DIR = os.path.join(LOCAL_DATA_DIR, "conversation_log")
+
+# 記憶體中最多保留的訊息 / 開放式回應物件數（其餘需要時從日誌讀回）
+DEFAULT_MAX_CACHED_RECORDS = 50000
+
+# 每寫入多少筆紀錄建立一次快照檢查點
+DEFAULT_CHECKPOINT_EVERY = 10000
+
+# 已結束會話在記憶體中的位元組預算（超過時寫成壓縮檔移出記憶體）
+DEFAULT_SESSION_CACHE_BYTES = 32 * 1024 * 1024
+
+# 會話物件大小估計：固定部分 + 每個訊息 ID 參照
+SESSION_BASE_BYTES = 512
+SESSION_BYTES_PER_MESSAGE = 8
+
+# 病人分片數（鎖分段）
+DEFAULT_SHARD_COUNT = 16
+
+# 日誌紀錄類型
+RECORD_SESSION = "session"
+RECORD_SESSION_END = "session_end"
+RECORD_MESSAGE = "message"
+RECORD_MESSAGE_UPDATE = "message_update"
+RECORD_RESPONSE = "response"
+
+
+class LogBackedTable:
+    """
+    以日誌為後盾的紀錄表
+    
+    - 所有鍵與其日誌位置常駐記憶體（索引很小）
+    - 物件本身只保留最近使用的 max_cached 筆（LRU），其餘需要時再從日誌讀回
+    - 沒有日誌時退化為一般字典（全部保留在記憶體）
+    
+    讀取也會調整 LRU 順序，所以表格自帶一把鎖；呼叫端不持有儲存的全域鎖也能安全讀取。
+    """
+    
+    def __init__(
+        self,
+        decode: Callable[[Dict[str, Any]], Any],
+        log: Optional[SegmentLog] = None,
+        max_cached: Optional[int] = DEFAULT_MAX_CACHED_RECORDS
+    ):
+        self._decode = decode
+        self._log = log
+        self._max_cached = max_cached if log is not None else None
+        self._locations: Dict[str, Optional[LogPosition]] = {}
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.RLock()
+    
+    def put(self, key: str, obj: Any, position: Optional[LogPosition]):
+        """新增或更新一筆（物件放入快取）"""
+        with self._lock:
+            self._locations[key] = position
+            self._cache[key] = obj
+            self._cache.move_to_end(key)
+            self._evict()
+    
+    def put_location(self, key: str, position: LogPosition):
+        """只記錄位置（重播時使用，不載入物件）"""
+        with self._lock:
+            self._locations[key] = position
+            self._cache.pop(key, None)
+    
+    def location(self, key: str) -> Optional[LogPosition]:
+        with self._lock:
+            return self._locations.get(key)
+    
+    def _evict(self):
+        if self._max_cached is None:
+            return
+        while len(self._cache) > self._max_cached:
+            self._cache.popitem(last=False)
+    
+    def __getitem__(self, key: str) -> Any:
+        with self._lock:
+            obj = self._cache.get(key)
+            if obj is not None:
+                self._cache.move_to_end(key)
+                return obj
+            
+            position = self._locations[key]  # 不存在時 KeyError
+            if position is None or self._log is None:
+                raise KeyError(key)
+            
+            obj = self._decode(self._log.read_at(position)["d"])
+            self._cache[key] = obj
+            self._evict()
+            return obj
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._locations
+    
+    def __len__(self) -> int:
+        return len(self._locations)
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+    
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._locations)
+    
+    def values(self) -> Iterator[Any]:
+        """依寫入順序逐筆取得物件（未快取者從日誌讀回）"""
+        for key in self.keys():
+            yield self[key]
+    
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for key in self.keys():
+            yield key, self[key]
+    
+    @property
+    def cached_count(self) -> int:
+        return len(self._cache)
+    
+    def sample_cached(self, k: int, rng: random.Random) -> List[Any]:
+        """隨機取快取中的物件（估計記憶體用量用，不影響 LRU 順序）"""
+        with self._lock:
+            cached = list(self._cache.values())
+        return rng.sample(cached, min(k, len(cached)))
+    
+    def sample_keys(self, k: int, rng: random.Random) -> List[Tuple[str, Optional[LogPosition]]]:
+        """隨機取鍵與位置（估計位置索引大小用）"""
+        with self._lock:
+            keys = list(self._locations)
+            return [(key, self._locations[key]) for key in rng.sample(keys, min(k, len(keys)))]
+    
+    def export_locations(self) -> List[List[Any]]:
+        """快照用：[[key, 分段, 位移], ...]"""
+        with self._lock:
+            return [[key, pos[0], pos[1]] for key, pos in self._locations.items() if pos is not None]
+    
+    def restore_locations(self, entries: List[List[Any]]) -> Dict[str, str]:
+        """
+        還原位置
+        
+        Returns:
+            鍵字串對照（還原其他結構時用來共用同一個字串物件）
+        """
+        keys = {}
+        with self._lock:
+            for key, segment_no, offset in entries:
+                self._locations[key] = (segment_no, offset)
+                keys[key] = key
+        return keys
+
+
+class SessionTable:
+    """
+    會話表
+    
+    - 進行中會話常駐記憶體
+    - 已結束會話依最近存取排序（LRU），超過位元組預算時寫成壓縮檔並移出記憶體
+    - 被移出的會話在下次存取時才讀回（例如匯出會話摘要、取得會話訊息）
+    - 沒有 spill_dir 時全部保留在記憶體
+    
+    會話內容有變動時須呼叫 put()，移出時才會重新寫檔。
+    表格結構（LRU、移出）由自帶的鎖保護；會話物件內容由該病人的分片鎖保護。
+    """
+    
+    def __init__(self, spill_dir: Optional[str] = None, max_bytes: int = DEFAULT_SESSION_CACHE_BYTES):
+        self.spill_dir = spill_dir
+        self.max_bytes = max_bytes
+        
+        self._order: Dict[str, None] = {}                       # 所有會話 ID（建立順序）
+        self._active: Dict[str, ConversationSession] = {}       # 進行中會話
+        self._ended: "OrderedDict[str, ConversationSession]" = OrderedDict()  # 記憶體中的已結束會話
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._spilled: set = set()   # 只存在磁碟上的會話
+        self._dirty: set = set()     # 記憶體中有變動、尚未寫檔的已結束會話
+        self._lock = threading.RLock()
+        
+        # 統計
+        self.spill_count = 0
+        self.load_count = 0
+    
+    # ============================================
+    # 磁碟檔案
+    # ============================================
+    
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, session_id[-2:], f"{session_id}.json.gz")
+    
+    def _write(self, session: ConversationSession):
+        path = self._path(session.session_id)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(gzip.compress(
+                    json.dumps(session.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                ))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def _read(self, session_id: str) -> ConversationSession:
+        with open(self._path(session_id), "rb") as f:
+            return ConversationSession.from_dict(json.loads(gzip.decompress(f.read())))
+    
+    # ============================================
+    # 記憶體預算
+    # ============================================
+    
+    @staticmethod
+    def _estimate_bytes(session: ConversationSession) -> int:
+        return SESSION_BASE_BYTES + SESSION_BYTES_PER_MESSAGE * len(session.message_ids)
+    
+    def _track(self, session: ConversationSession):
+        """放入已結束會話 LRU 並更新大小"""
+        session_id = session.session_id
+        self._ended[session_id] = session
+        self._ended.move_to_end(session_id)
+        size = self._estimate_bytes(session)
+        self._bytes += size - self._sizes.get(session_id, 0)
+        self._sizes[session_id] = size
+    
+    def _untrack(self, session_id: str):
+        self._ended.pop(session_id, None)
+        self._bytes -= self._sizes.pop(session_id, 0)
+    
+    def _evict(self):
+        if self.spill_dir is None:
+            return
+        while self._bytes > self.max_bytes and len(self._ended) > 1:
+            session_id, session = next(iter(self._ended.items()))
+            if session_id in self._dirty or not os.path.exists(self._path(session_id)):
+                self._write(session)
+                self._dirty.discard(session_id)
+            self._untrack(session_id)
+            self._spilled.add(session_id)
+            self.spill_count += 1
+    
+    # ============================================
+    # 存取
+    # ============================================
+    
+    def put(self, session: ConversationSession):
+        """新增會話，或在會話內容變動後登記"""
+        session_id = session.session_id
+        with self._lock:
+            self._order[session_id] = None
+            self._spilled.discard(session_id)
+            
+            if session.is_completed:
+                self._active.pop(session_id, None)
+                self._dirty.add(session_id)
+                self._track(session)
+                self._evict()
+            else:
+                self._untrack(session_id)
+                self._active[session_id] = session
+    
+    def __getitem__(self, session_id: str) -> ConversationSession:
+        with self._lock:
+            session = self._active.get(session_id)
+            if session is not None:
+                return session
+            
+            session = self._ended.get(session_id)
+            if session is not None:
+                self._ended.move_to_end(session_id)
+                return session
+            
+            if session_id not in self._spilled:
+                raise KeyError(session_id)
+            
+            # 從磁碟讀回（檔案保留，未變動時再次移出不需重寫）
+            session = self._read(session_id)
+            self._spilled.discard(session_id)
+            self._track(session)
+            self.load_count += 1
+            self._evict()
+            return session
+    
+    def get(self, session_id: str, default: Any = None) -> Any:
+        try:
+            return self[session_id]
+        except KeyError:
+            return default
+    
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._order
+    
+    def __len__(self) -> int:
+        return len(self._order)
+    
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._order)
+    
+    def values(self) -> Iterator[ConversationSession]:
+        """依建立順序逐一取得會話（已移出者從磁碟讀回）"""
+        for session_id in self.keys():
+            yield self[session_id]
+    
+    # ============================================
+    # 統計 / 快照
+    # ============================================
+    
+    @property
+    def resident_count(self) -> int:
+        return len(self._active) + len(self._ended)
+    
+    @property
+    def spilled_count(self) -> int:
+        return len(self._spilled)
+    
+    @property
+    def resident_bytes(self) -> int:
+        """記憶體中已結束會話的估計大小"""
+        return self._bytes
+    
+    def export_state(self) -> List[Any]:
+        """快照用：記憶體中的會話存完整內容，已移出者只存 ID"""
+        entries = []
+        with self._lock:
+            for session_id in self._order:
+                if session_id in self._spilled:
+                    entries.append(session_id)
+                else:
+                    entries.append((self._active.get(session_id) or self._ended[session_id]).to_dict())
+        return entries
+    
+    def restore_state(self, entries: List[Any], canonical: Callable[[str], str]):
+        """由快照還原（已移出的會話只登記 ID，檔案不存在者略過）"""
+        for entry in entries:
+            if isinstance(entry, str):
+                if self.spill_dir is not None and os.path.exists(self._path(entry)):
+                    self._order[entry] = None
+                    self._spilled.add(entry)
+                continue
+            session = ConversationSession.from_dict(entry)
+            session.message_ids = [canonical(mid) for mid in session.message_ids]
+            self.put(session)
+
+
+class PatientShard:
+    """
+    病人分片：同一分片的病人共用一把鎖，並各自記錄活躍會話
+
+    分片鎖保護該分片病人的狀態：活躍會話、會話內容、病人索引與對話統計。
+    不同分片的病人只在附加日誌與更新共用索引時（全域鎖）互相等待。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # 病人ID → 活躍會話ID
+        self.active: Dict[str, str] = {}
 
 
 class ConversationStore:
@@ -33,52 +430,405 @@ class ConversationStore:
     - 建立和管理對話會話
     - 分離儲存病人輸入和 AI 回應
     - 匯出標註資料
+    
+    有指定 storage 時，每次寫入都附加到分段日誌；啟動時載入快照並重播之後的紀錄。
+    訊息只在 LRU 工作集中保留最近使用的部分；已結束會話超過位元組預算時
+    寫成壓縮檔移出記憶體，長時間執行時只有進行中的對話常駐。
+    
+    並行（鎖分段）：
+    - 分片鎖：病人狀態（活躍會話、會話內容、病人索引與統計）
+    - 全域鎖：日誌附加、日期 / 角色索引、近似重複與全文索引（文件編號須依日誌順序）
+    - 紀錄表與會話表各自有鎖，讀取不需持有上述任何鎖
+    偵測與 JSON 編碼都在鎖外完成。鎖的取得順序固定為「分片鎖（依編號）→ 全域鎖」；
+    檢查點持有所有分片鎖與全域鎖，快照與日誌位置一致。
     """
     
-    def __init__(self):
-        # 記憶體儲存（實際部署時改為資料庫）
-        self.sessions: Dict[str, ConversationSession] = {}
-        self.messages: Dict[str, ConversationMessage] = {}
-        self.open_ended_responses: Dict[str, OpenEndedResponse] = {}
+    def __init__(
+        self,
+        storage: Optional[SegmentLog] = None,
+        max_cached_records: int = DEFAULT_MAX_CACHED_RECORDS,
+        checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY,
+        max_session_bytes: int = DEFAULT_SESSION_CACHE_BYTES,
+        shard_count: int = DEFAULT_SHARD_COUNT
+    ):
+        self.storage = storage
+        self.checkpoint_every = checkpoint_every
+        self._lock = threading.RLock()
+        self._records_since_checkpoint = 0
+        # 背景檢查點（同時最多一個）
+        self._checkpoint_thread: Optional[threading.Thread] = None
+        
+        self.sessions = SessionTable(
+            os.path.join(storage.directory, "sessions") if storage is not None else None,
+            max_session_bytes
+        )
+        self.messages = LogBackedTable(ConversationMessage.from_dict, storage, max_cached_records)
+        self.open_ended_responses = LogBackedTable(OpenEndedResponse.from_dict, storage, max_cached_records)
+        self.indexes = ConversationIndexes()
+        # 病人訊息與開放式回應的近似重複群集
+        self.near_duplicates = NearDuplicateIndex()
+        # 病人訊息與開放式回應的全文檢索
+        self.fulltext = FullTextIndex()
+        
+        # 病人分片（活躍會話依病人記錄，不再是全域單一值）
+        self._shards = [PatientShard() for _ in range(max(1, shard_count))]
         
-        # 當前活躍會話
-        self.active_session_id: Optional[str] = None
+        # 背景偵測（enable_async_detection 啟用後才有）
+        self.detection_pool = None
+        
+        if storage is not None:
+            self._recover()
+    
+    # ============================================
+    # 持久化
+    # ============================================
+    
+    def _append_line(self, line: Optional[bytes]) -> Optional[LogPosition]:
+        """寫入已在鎖外編碼的日誌行（須持有全域鎖）"""
+        if self.storage is None:
+            return None
+        
+        position = self.storage.append_encoded([line])[0]
+        self._records_since_checkpoint += 1
+        
+        return position
+    
+    def _encode(self, record_type: str, data: Dict[str, Any]) -> Optional[bytes]:
+        """在鎖外先編碼日誌行；無 storage 時不編碼"""
+        if self.storage is None:
+            return None
+        return encode_record({"t": record_type, "d": data})
+    
+    def _append_many(self, record_type: str, datas: List[Dict[str, Any]]) -> List[Optional[LogPosition]]:
+        """批次寫入日誌"""
+        if self.storage is None:
+            return [None] * len(datas)
+        
+        positions = self.storage.append_many([{"t": record_type, "d": data} for data in datas])
+        self._records_since_checkpoint += len(datas)
+        
+        return positions
+    
+    def _maybe_checkpoint(self):
+        """
+        累積足夠紀錄後在背景建立檢查點（須持有所有分片鎖與 _lock，見 _checkpoint_if_due）
+
+        鎖內只同步日誌並複製狀態；序列化、壓縮與寫檔在背景執行緒進行，不卡住其他對話
+        """
+        if self.storage is None or self._records_since_checkpoint < self.checkpoint_every:
+            return
+        if self._checkpoint_thread is not None and self._checkpoint_thread.is_alive():
+            return
+        state, position = self._capture_checkpoint()
+        self._checkpoint_thread = threading.Thread(
+            target=self._write_checkpoint, args=(self.storage, state, position),
+            name="store-checkpoint", daemon=True
+        )
+        self._checkpoint_thread.start()
+    
+    def _capture_checkpoint(self) -> Tuple[Dict[str, Any], LogPosition]:
+        """鎖內：同步日誌並取得快照狀態（各結構皆為複本）與涵蓋位置"""
+        self.storage.sync()
+        position = self.storage.position
+        state = self._snapshot_state()
+        self._records_since_checkpoint = 0
+        return state, position
+    
+    @staticmethod
+    def _write_checkpoint(storage: SegmentLog, state: Dict[str, Any], position: LogPosition):
+        try:
+            storage.write_snapshot(state, position)
+        except Exception as e:   # 寫入失敗只影響下次啟動速度，下一個檢查點會再寫
+            print(f"[conversation_store] 檢查點寫入失敗：{e}", file=sys.stderr)
+    
+    def _wait_checkpoint(self):
+        thread = self._checkpoint_thread
+        if thread is not None:
+            thread.join()
+            self._checkpoint_thread = None
+    
+    def _recover(self):
+        """啟動時還原：載入快照，再重播快照之後的紀錄"""
+        state, position = self.storage.load_snapshot()
+        if state:
+            self._restore_state(state)
+        
+        for record_position, record in self.storage.replay(position):
+            self._apply_record(record, record_position)
+    
+    def _apply_record(self, record: Dict[str, Any], position: LogPosition):
+        """重播單筆日誌紀錄"""
+        record_type, data = record["t"], record["d"]
+        
+        if record_type == RECORD_SESSION:
+            session = ConversationSession.from_dict(data)
+            self.sessions.put(session)
+            self.indexes.add_session(session)
+            self._shard(session.patient_id).active[session.patient_id] = session.session_id
+        
+        elif record_type == RECORD_SESSION_END:
+            session = self.sessions.get(data["session_id"])
+            if session:
+                session.end_time = datetime.fromisoformat(data["end_time"])
+                session.is_completed = True
+                session.completion_type = data.get("completion_type")
+                self.sessions.put(session)
+                self._clear_active(session)
+        
+        elif record_type == RECORD_MESSAGE:
+            # 只記錄位置與 ID，訊息物件需要時才從日誌讀回
+            message = ConversationMessage.from_dict(data)
+            self.messages.put_location(message.message_id, position)
+            self.indexes.add_message(message)
+            if message.role == MessageRole.PATIENT:
+                self.near_duplicates.add(message.message_id, message.content)
+                self._index_text(message.message_id, KIND_MESSAGE, message.patient_id,
+                                 message.timestamp.date(), message.content)
+            session = self.sessions.get(message.session_id)
+            if session:
+                session.add_message(message)
+                self.sessions.put(session)
+        
+        elif record_type == RECORD_MESSAGE_UPDATE:
+            # 訊息內容更新：移動位置；病人訊息的標註變動同步到統計
+            previous = self.messages.get(data["message_id"])
+            if previous is not None and previous.role == MessageRole.PATIENT:
+                self.indexes.relabel_message(
+                    previous.patient_id,
+                    (previous.detected_intent.value, previous.detected_emotion.value),
+                    (data.get("detected_intent"), data.get("detected_emotion"))
+                )
+            self.messages.put_location(data["message_id"], position)
+        
+        elif record_type == RECORD_RESPONSE:
+            self.open_ended_responses.put_location(data["response_id"], position)
+            response = OpenEndedResponse.from_dict(data)
+            self.indexes.add_response(response)
+            self.near_duplicates.add(response.response_id, response.response_text)
+            self._index_text(response.response_id, KIND_RESPONSE, response.patient_id,
+                             response.response_time.date(), response.response_text)
+    
+    def _snapshot_state(self) -> Dict[str, Any]:
+        return {
+            "sessions": self.sessions.export_state(),
+            "messages": self.messages.export_locations(),
+            "responses": self.open_ended_responses.export_locations(),
+            "indexes": self.indexes.export_state(),
+            "near_duplicates": self.near_duplicates.export_state(),
+            "fulltext": self.fulltext.export_state(),
+            "active_sessions": {
+                patient_id: session_id
+                for shard in self._shards
+                for patient_id, session_id in shard.active.items()
+            }
+        }
+    
+    def _restore_state(self, state: Dict[str, Any]):
+        message_keys = self.messages.restore_locations(state.get("messages", []))
+        canonical = lambda key: message_keys.get(key, key)
+        self.open_ended_responses.restore_locations(state.get("responses", []))
+        
+        self.sessions.restore_state(state.get("sessions", []), canonical)
+        
+        if "indexes" in state:
+            self.indexes.restore_state(state["indexes"], canonical)
+            if "patient_stats" not in state["indexes"]:
+                self.indexes.patient_stats = self._compute_aggregates()
+        else:
+            self._rebuild_indexes()
+        
+        if not self.near_duplicates.restore_state(state.get("near_duplicates", {})):
+            self._rebuild_near_duplicates()
+        if not self.fulltext.restore_state(state.get("fulltext", {})):
+            self._rebuild_fulltext()
+        
+        for patient_id, session_id in state.get("active_sessions", {}).items():
+            self._shard(patient_id).active[patient_id] = session_id
+        
+        # 舊版快照只有單一活躍會話
+        legacy_active = self.sessions.get(state["active_session_id"]) if state.get("active_session_id") else None
+        if legacy_active is not None and not legacy_active.is_completed:
+            self._shard(legacy_active.patient_id).active[legacy_active.patient_id] = legacy_active.session_id
+    
+    def _rebuild_indexes(self):
+        """舊版快照沒有索引時，從現有紀錄重建"""
+        self.indexes = ConversationIndexes()
+        for session in self.sessions.values():
+            self.indexes.add_session(session)
+        for message in self.messages.values():
+            self.indexes.add_message(message)
+        for response in self.open_ended_responses.values():
+            self.indexes.add_response(response)
+    
+    def _rebuild_near_duplicates(self):
+        """舊版快照或參數變更時，從現有紀錄重建近似重複群集"""
+        self.near_duplicates = NearDuplicateIndex()
+        for message in self.messages.values():
+            if message.role == MessageRole.PATIENT:
+                self.near_duplicates.add(message.message_id, message.content)
+        for response in self.open_ended_responses.values():
+            self.near_duplicates.add(response.response_id, response.response_text)
+    
+    def _rebuild_fulltext(self):
+        """舊版快照沒有全文索引時，依寫入順序重建"""
+        self.fulltext = FullTextIndex()
+        documents = []
+        for message in self.messages.values():
+            if message.role == MessageRole.PATIENT:
+                documents.append((message.timestamp, message.message_id, KIND_MESSAGE,
+                                  message.patient_id, message.content))
+        for response in self.open_ended_responses.values():
+            documents.append((response.response_time, response.response_id, KIND_RESPONSE,
+                              response.patient_id, response.response_text))
+        documents.sort(key=lambda document: document[0])
+        for timestamp, doc_id, kind, patient_id, text in documents:
+            self._index_text(doc_id, kind, patient_id, timestamp.date(), text)
+    
+    def _index_text(self, doc_id: str, kind: int, patient_id: str, doc_date: date, text: str,
+                    terms: Optional[Set[str]] = None):
+        if terms is None:
+            terms = self.fulltext.terms(text)
+        self.fulltext.add(doc_id, kind, patient_id, doc_date, len(text), terms)
+    
+    def checkpoint(self):
+        """立即建立快照檢查點（加快下次啟動）；先等背景檢查點完成，序列化在鎖外進行"""
+        if self.storage is None:
+            return
+        self._wait_checkpoint()
+        with self._all_patient_locks(), self._lock:
+            state, position = self._capture_checkpoint()
+        self.storage.write_snapshot(state, position)
+    
+    def enable_async_detection(self, **options):
+        """
+        啟用背景偵測：病人訊息寫入後才排入偵測，不在呼叫端執行偵測器
+        
+        Args:
+            options: 傳給 DetectionWorkerPool（workers、batch_size、max_batch_delay 等）
+        
+        緊急訊息的升級通知用 pool.add_escalation_handler 註冊處理器；
+        全域儲存（get_conversation_store）預設註冊 EscalationRecorder。
+        """
+        from detection_worker import DetectionWorkerPool
+        
+        if self.detection_pool is None:
+            self.detection_pool = DetectionWorkerPool(self, **options)
+        return self.detection_pool
+    
+    def close(self):
+        """停止背景偵測、建立檢查點並關閉日誌"""
+        if self.detection_pool is not None:
+            self.detection_pool.close()
+            self.detection_pool = None
+        if self.storage is None:
+            return
+        self.checkpoint()
+        self.storage.close()
+        self.storage = None
     
     # ============================================
     # 會話管理
     # ============================================
     
+    def _shard_index(self, patient_id: str) -> int:
+        """病人 → 分片編號（穩定雜湊，與行程無關）"""
+        return zlib.crc32(patient_id.encode("utf-8")) % len(self._shards)
+    
+    def _shard(self, patient_id: str) -> PatientShard:
+        return self._shards[self._shard_index(patient_id)]
+    
+    @contextmanager
+    def _patient_locks(self, patient_ids: Iterable[str]):
+        """依分片編號順序取得多位病人的分片鎖（批次寫回時使用）"""
+        with ExitStack() as stack:
+            for index in sorted({self._shard_index(pid) for pid in patient_ids}):
+                stack.enter_context(self._shards[index].lock)
+            yield
+    
+    @contextmanager
+    def _all_patient_locks(self):
+        """取得所有分片鎖（檢查點與全體一致性檢查）"""
+        with ExitStack() as stack:
+            for shard in self._shards:
+                stack.enter_context(shard.lock)
+            yield
+    
+    def _clear_active(self, session: ConversationSession):
+        shard = self._shard(session.patient_id)
+        if shard.active.get(session.patient_id) == session.session_id:
+            del shard.active[session.patient_id]
+    
     def start_session(self, patient_id: str, session_type: str = "daily_report") -> ConversationSession:
-        """開始新的對話會話"""
+        """
+        開始新的對話會話
+        
+        回傳的 session_id 應由呼叫端（每個 Streamlit 工作階段）保存並在記錄訊息時傳入；
+        未傳入時才使用該病人最近開始的會話。
+        """
         session = ConversationSession(
             session_id=generate_session_id(),
             patient_id=patient_id,
             start_time=datetime.now(),
             session_type=session_type
         )
+        line = self._encode(RECORD_SESSION, session.to_dict())
         
-        self.sessions[session.session_id] = session
-        self.active_session_id = session.session_id
+        shard = self._shard(patient_id)
+        with shard.lock:
+            with self._lock:
+                self._append_line(line)
+            self.sessions.put(session)
+            self.indexes.add_session(session)
+            shard.active[patient_id] = session.session_id
         
+        self._checkpoint_if_due()
         return session
     
     def end_session(self, session_id: str, completion_type: str = "completed"):
         """結束對話會話"""
-        if session_id in self.sessions:
-            session = self.sessions[session_id]
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        
+        shard = self._shard(session.patient_id)
+        with shard.lock:
+            session = self.sessions.get(session_id)
             session.end_time = datetime.now()
             session.is_completed = True
             session.completion_type = completion_type
-            
-            if self.active_session_id == session_id:
-                self.active_session_id = None
+            line = self._encode(RECORD_SESSION_END, {
+                "session_id": session_id,
+                "end_time": session.end_time.isoformat(),
+                "completion_type": completion_type
+            })
+            with self._lock:
+                self._append_line(line)
+            self.sessions.put(session)
+            self._clear_active(session)
+        
+        self._checkpoint_if_due()
     
-    def get_current_session(self) -> Optional[ConversationSession]:
-        """取得當前活躍會話"""
-        if self.active_session_id:
-            return self.sessions.get(self.active_session_id)
+    def get_current_session(self, patient_id: str) -> Optional[ConversationSession]:
+        """取得病人當前活躍會話"""
+        shard = self._shard(patient_id)
+        with shard.lock:
+            session_id = shard.active.get(patient_id)
+        if session_id:
+            return self.sessions.get(session_id)
         return None
     
+    def active_session_id(self, patient_id: str) -> Optional[str]:
+        """病人當前活躍會話ID"""
+        shard = self._shard(patient_id)
+        with shard.lock:
+            return shard.active.get(patient_id)
+    
+    def _checkpoint_if_due(self):
+        """檢查是否需要建立檢查點（呼叫端不可持有任何分片鎖或全域鎖）"""
+        if self.storage is not None and self._records_since_checkpoint >= self.checkpoint_every:
+            with self._all_patient_locks(), self._lock:
+                self._maybe_checkpoint()
+    
     # ============================================
     # 訊息管理
     # ============================================
@@ -94,15 +844,30 @@ class ConversationStore:
         """
         新增病人訊息
         
-        這是最有價值的資料，完整保存原始輸入
+        這是最有價值的資料，完整保存原始輸入。
+        
+        啟用背景偵測（enable_async_detection）時：
+        - 回傳的訊息帶預設標註（OTHER / NEUTRAL / NORMAL，detection_version 為 None），
+          不是偵測結果；需要標註的呼叫端請自行呼叫 detect(content)，或等背景寫回後再讀取訊息
+        - 每則訊息寫入兩筆日誌記錄：先寫 message，偵測完成後再寫一筆 message_update
+        - 緊急訊息由偵測池通知升級處理器（佇列滿載改為同步偵測時也一樣）
         """
         if session_id is None:
-            session_id = self.active_session_id
+            session_id = self.active_session_id(patient_id)
+        
+        pool = self.detection_pool
+        deferred = pool is not None and pool.has_capacity()
         
-        # 自動偵測意圖和情緒
-        detected_intent = self._detect_intent(content)
-        detected_emotion = self._detect_emotion(content)
-        detected_urgency = self._detect_urgency(content)
+        if deferred:
+            detected_intent, detected_emotion, detected_urgency = (
+                IntentCategory.OTHER, EmotionCategory.NEUTRAL, UrgencyLevel.NORMAL
+            )
+        else:
+            # 自動偵測意圖和情緒（分類模型 + 關鍵字規則）
+            detection = detect(content)
+            detected_intent = detection.intent
+            detected_emotion = detection.emotion
+            detected_urgency = detection.urgency
         
         message = ConversationMessage(
             message_id=generate_message_id(),
@@ -116,14 +881,15 @@ class ConversationStore:
             detected_intent=detected_intent,
             detected_emotion=detected_emotion,
             detected_urgency=detected_urgency,
+            detection_version=None if deferred else DETECTION_VERSION,
             needs_human_review=detected_urgency == UrgencyLevel.EMERGENCY
         )
         
-        self.messages[message.message_id] = message
-        
-        # 加入會話
-        if session_id and session_id in self.sessions:
-            self.sessions[session_id].add_message(message)
+        self._store_message(message)
+        if deferred:
+            pool.submit(message)
+        elif pool is not None and message.needs_human_review:
+            pool.escalate_inline(message)
         
         return message
     
@@ -142,7 +908,7 @@ class ConversationStore:
         記錄回應來源，區分 AI 生成 vs 專家範本
         """
         if session_id is None:
-            session_id = self.active_session_id
+            session_id = self.active_session_id(patient_id)
         
         message = ConversationMessage(
             message_id=generate_message_id(),
@@ -155,14 +921,193 @@ class ConversationStore:
             ai_model=ai_model
         )
         
-        self.messages[message.message_id] = message
-        
-        # 加入會話
-        if session_id and session_id in self.sessions:
-            self.sessions[session_id].add_message(message)
+        self._store_message(message)
         
         return message
     
+    def _store_message(self, message: ConversationMessage):
+        """寫入日誌並加入會話（編碼與簽章在鎖外完成）"""
+        line = self._encode(RECORD_MESSAGE, message.to_dict())
+        is_patient = message.role == MessageRole.PATIENT
+        signature = self.near_duplicates.signature(message.content) if is_patient else None
+        terms = self.fulltext.terms(message.content) if is_patient else None
+        
+        with self._shard(message.patient_id).lock:
+            with self._lock:
+                position = self._append_line(line)
+                self.messages.put(message.message_id, message, position)
+                self.indexes.add_shared_message(message)
+                if signature is not None:
+                    self.near_duplicates.add(message.message_id, signature=signature)
+                if is_patient:
+                    self._index_text(message.message_id, KIND_MESSAGE, message.patient_id,
+                                     message.timestamp.date(), message.content, terms)
+            
+            # 病人索引與會話（只需分片鎖；會話屬於同一位病人）
+            self.indexes.add_patient_message(message)
+            session = self.sessions.get(message.session_id)
+            if session:
+                session.add_message(message)
+                self.sessions.put(session)
+        
+        self._checkpoint_if_due()
+
+    def update_detections(
+        self,
+        results: List[Tuple[str, str, str, int, bool]],
+        version: str
+    ) -> int:
+        """
+        批次寫回預設標註（重新標註工作使用）
+        
+        Args:
+            results: [(message_id, intent, emotion, urgency, needs_human_review), ...]
+            version: 規則 / 模型版本
+        
+        Returns:
+            標註有變動的訊息數
+        """
+        changed = 0
+        # 先讀出訊息以得知涉及的病人（紀錄表自帶鎖），再依序取得分片鎖 → 全域鎖
+        messages = {message_id: self.messages.get(message_id) for message_id, *_ in results}
+        patient_ids = {m.patient_id for m in messages.values() if m is not None}
+        with self._patient_locks(patient_ids), self._lock:
+            updated = []
+            for message_id, intent, emotion, urgency, needs_review in results:
+                message = messages[message_id]
+                if message is None:
+                    continue
+                
+                new_labels = (IntentCategory(intent), EmotionCategory(emotion), UrgencyLevel(urgency))
+                if new_labels != (message.detected_intent, message.detected_emotion, message.detected_urgency):
+                    changed += 1
+                if message.role == MessageRole.PATIENT:
+                    self.indexes.relabel_message(
+                        message.patient_id,
+                        (message.detected_intent.value, message.detected_emotion.value),
+                        (intent, emotion)
+                    )
+                
+                message.detected_intent, message.detected_emotion, message.detected_urgency = new_labels
+                message.needs_human_review = message.needs_human_review or needs_review
+                message.detection_version = version
+                updated.append(message)
+            
+            # 日誌一次寫入整批新版本
+            positions = self._append_many(RECORD_MESSAGE_UPDATE, [m.to_dict() for m in updated])
+            for message, position in zip(updated, positions):
+                self.messages.put(message.message_id, message, position)
+        
+        self._checkpoint_if_due()
+        return changed
+    
+    def merge_annotations(
+        self,
+        labels: Dict[str, Dict[str, Dict[str, Any]]]
+    ) -> Tuple[int, List[str], List[Dict[str, Any]]]:
+        """
+        批次合併人工標註（標註回匯使用，見 annotation_import.py）
+
+        依日誌位置順序讀取訊息（循序讀檔）；不在每批之後建立檢查點，
+        由呼叫端在全部合併完成後呼叫 checkpoint()。
+
+        Args:
+            labels: message_id → 標註者 → 標籤（{"intent", "emotion", "urgency", "entities", "time"}）
+
+        Returns:
+            (寫回的訊息數, 找不到的 message_id, 標註者衝突 [{"message_id", "field", "labels"}, ...])
+        """
+        import_time = datetime.now().isoformat()
+        unknown, conflicts = [], []
+        with self._lock:
+            updated = []
+            ordered = sorted(labels, key=lambda mid: self.messages.location(mid) or (-1, -1))
+            for message_id in ordered:
+                new_labels = labels[message_id]
+                message = self.messages.get(message_id)
+                if message is None:
+                    unknown.append(message_id)
+                    continue
+
+                message.annotations, message_conflicts = merge_annotator_labels(
+                    message.annotations, new_labels, import_time
+                )
+                for conflict in message_conflicts:
+                    conflict["message_id"] = message_id
+                    conflicts.append(conflict)
+                updated.append(message)
+
+            # 日誌一次寫入整批新版本
+            positions = self._append_many(RECORD_MESSAGE_UPDATE, [m.to_dict() for m in updated])
+            for message, position in zip(updated, positions):
+                self.messages.put(message.message_id, message, position)
+
+        return len(updated), unknown, conflicts
+
+    def iter_annotator_labels(self) -> Iterator[Tuple[str, Dict[str, Dict[str, Any]]]]:
+        """逐筆產生已回匯標註的病人訊息：(message_id, 標註者 → 標籤)"""
+        for message_id in self.indexes.role_message_ids(MessageRole.PATIENT.value):
+            message = self.messages.get(message_id)
+            if message is not None and message.annotator_labels:
+                yield message_id, message.annotator_labels
+
+    def write_message_updates(
+        self,
+        updates: List[Tuple[str, str, bytes]],
+        label_changes: Optional[List[Tuple[str, Tuple[str, str], Tuple[str, str]]]] = None
+    ) -> int:
+        """
+        批次寫入已編碼的訊息新版本（重新標註工作使用）
+        
+        編碼在子行程完成，主行程只負責附加日誌與更新位置。
+        
+        Args:
+            updates: [(message_id, session_id, 訊息字典的精簡 JSON UTF-8), ...]
+            label_changes: 病人訊息的標註變動 [(patient_id, (舊意圖, 舊情緒), (新意圖, 新情緒)), ...]
+        
+        Returns:
+            寫入筆數
+        """
+        if self.storage is None:
+            raise RuntimeError("沒有日誌儲存，請改用 update_detections")
+        
+        prefix = b'{"t":"' + RECORD_MESSAGE_UPDATE.encode("utf-8") + b'","d":'
+        label_changes = label_changes or []
+        with self._patient_locks(pid for pid, _, _ in label_changes), self._lock:
+            positions = self.storage.append_encoded([prefix + payload + b"}\n" for _, _, payload in updates])
+            self._records_since_checkpoint += len(updates)
+            
+            for (message_id, _, _), position in zip(updates, positions):
+                self.messages.put_location(message_id, position)
+            for patient_id, old_labels, new_labels in label_changes:
+                self.indexes.relabel_message(patient_id, old_labels, new_labels)
+        
+        self._checkpoint_if_due()
+        return len(updates)
+    
+    def get_patient_messages(self, patient_id: str, role: Optional[MessageRole] = None) -> List[ConversationMessage]:
+        """取得病人的訊息（依寫入順序）"""
+        with self._shard(patient_id).lock:
+            message_ids = self.indexes.patient_message_ids(patient_id, role.value if role else None)
+        messages = [self.messages[mid] for mid in message_ids]
+        if role is None:
+            messages.sort(key=lambda m: m.timestamp)
+        return messages
+
+    def get_session_messages(self, session_id: str) -> List[ConversationMessage]:
+        """取得會話的所有訊息（已結束會話也可取得）"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return []
+        with self._shard(session.patient_id).lock:
+            message_ids = list(session.message_ids)
+        return [self.messages[mid] for mid in message_ids]
+    
+    def get_patient_session_ids(self, patient_id: str) -> List[str]:
+        """取得病人的會話 ID（依開始順序）"""
+        with self._shard(patient_id).lock:
+            return list(self.indexes.patient_sessions.get(patient_id, []))
+
     # ============================================
     # 開放式問題回應
     # ============================================
@@ -180,8 +1125,9 @@ class ConversationStore:
         """新增開放式問題回應"""
         
         # 自動偵測症狀關鍵字
-        detected_symptoms = self._extract_symptoms(response_text)
-        detected_emotion = self._detect_emotion(response_text).value
+        detection = detect(response_text)
+        detected_symptoms = detection.symptoms
+        detected_emotion = detection.emotion.value
         
         response = OpenEndedResponse(
             response_id=generate_response_id(),
@@ -195,9 +1141,22 @@ class ConversationStore:
             detected_symptoms=detected_symptoms,
             detected_emotion=detected_emotion
         )
+        signature = self.near_duplicates.signature(response_text)
+        terms = self.fulltext.terms(response_text)
+        
+        line = self._encode(RECORD_RESPONSE, response.to_dict())
         
-        self.open_ended_responses[response.response_id] = response
+        with self._shard(patient_id).lock:
+            with self._lock:
+                position = self._append_line(line)
+                self.open_ended_responses.put(response.response_id, response, position)
+                if signature is not None:
+                    self.near_duplicates.add(response.response_id, signature=signature)
+                self._index_text(response.response_id, KIND_RESPONSE, response.patient_id,
+                                 response.response_time.date(), response_text, terms)
+            self.indexes.add_response(response)
         
+        self._checkpoint_if_due()
         return response
     
     # ============================================
@@ -208,172 +1167,218 @@ class ConversationStore:
         """
         簡易意圖偵測
         
-        注意：這是規則式偵測，僅作為預設值
+        注意：這是分類模型 / 規則式偵測，僅作為預設值
         最終需要人工標註確認
         """
-        text_lower = text.lower()
-        
-        # 緊急關鍵字
-        emergency_keywords = ["很痛", "非常痛", "受不了", "喘不過氣", "發燒", "出血", "緊急", "救命"]
-        if any(kw in text for kw in emergency_keywords):
-            return IntentCategory.EMERGENCY
-        
-        # 症狀回報
-        symptom_keywords = ["分", "今天", "昨天", "這幾天"]
-        if any(kw in text for kw in symptom_keywords):
-            return IntentCategory.SYMPTOM_REPORT
-        
-        # 症狀諮詢
-        inquiry_keywords = ["正常嗎", "會不會", "是不是", "怎麼辦", "該怎麼"]
-        if any(kw in text for kw in inquiry_keywords):
-            return IntentCategory.SYMPTOM_INQUIRY
-        
-        # 藥物問題
-        medication_keywords = ["藥", "吃藥", "止痛", "副作用"]
-        if any(kw in text for kw in medication_keywords):
-            return IntentCategory.MEDICATION_QUESTION
-        
-        # 生活建議
-        lifestyle_keywords = ["可以", "能不能", "運動", "洗澡", "工作", "開車"]
-        if any(kw in text for kw in lifestyle_keywords):
-            return IntentCategory.LIFESTYLE_ADVICE
-        
-        # 情緒表達
-        emotion_keywords = ["擔心", "害怕", "焦慮", "難過", "開心", "謝謝"]
-        if any(kw in text for kw in emotion_keywords):
-            return IntentCategory.EMOTIONAL_EXPRESSION
-        
-        # 感謝
-        if "謝" in text or "感謝" in text:
-            return IntentCategory.GRATITUDE
-        
-        # 打招呼
-        greeting_keywords = ["你好", "早安", "午安", "晚安", "嗨"]
-        if any(kw in text for kw in greeting_keywords):
-            return IntentCategory.GREETING
-        
-        return IntentCategory.OTHER
+        return detect(text).intent
     
     def _detect_emotion(self, text: str) -> EmotionCategory:
         """
         簡易情緒偵測
         
-        注意：這是規則式偵測，僅作為預設值
+        注意：這是分類模型 / 規則式偵測，僅作為預設值
         """
-        # 焦慮/擔心
-        anxious_keywords = ["擔心", "害怕", "焦慮", "緊張", "不安", "恐懼"]
-        if any(kw in text for kw in anxious_keywords):
-            return EmotionCategory.ANXIOUS
-        
-        # 低落/沮喪
-        depressed_keywords = ["難過", "沮喪", "低落", "憂鬱", "不想", "沒意思"]
-        if any(kw in text for kw in depressed_keywords):
-            return EmotionCategory.DEPRESSED
-        
-        # 正向
-        positive_keywords = ["謝謝", "感謝", "開心", "高興", "好多了", "進步"]
-        if any(kw in text for kw in positive_keywords):
-            return EmotionCategory.POSITIVE
-        
-        # 憤怒
-        angry_keywords = ["生氣", "憤怒", "不滿", "抱怨", "受不了"]
-        if any(kw in text for kw in angry_keywords):
-            return EmotionCategory.ANGRY
-        
-        return EmotionCategory.NEUTRAL
+        return detect(text).emotion
     
     def _detect_urgency(self, text: str) -> UrgencyLevel:
         """簡易緊急程度偵測"""
-        # 緊急
-        emergency_keywords = ["非常痛", "劇痛", "喘不過氣", "發高燒", "大量出血", "昏倒", "意識"]
-        if any(kw in text for kw in emergency_keywords):
-            return UrgencyLevel.EMERGENCY
-        
-        # 重要
-        important_keywords = ["很痛", "發燒", "出血", "嚴重", "惡化", "加重"]
-        if any(kw in text for kw in important_keywords):
-            return UrgencyLevel.IMPORTANT
-        
-        # 一般
-        return UrgencyLevel.NORMAL
+        return keyword_matcher.detect_urgency(text)
     
     def _extract_symptoms(self, text: str) -> List[str]:
         """提取症狀關鍵字"""
-        detected = []
-        
-        for symptom_type, definition in SYMPTOM_DEFINITIONS.items():
-            keywords = definition.get("keywords", [])
-            for keyword in keywords:
-                if keyword in text:
-                    detected.append(symptom_type.value)
-                    break
-        
-        return detected
+        return keyword_matcher.extract_symptoms(text)
+    
+    def _extract_entities(self, text: str) -> List[Dict[str, Any]]:
+        """提取症狀 / 部位 / 嚴重程度片段（annotated_entities 格式）"""
+        return entity_extractor.extract_entities(text)
     
     # ============================================
     # 資料匯出（供標註團隊使用）
     # ============================================
     
-    def export_for_annotation(
+    def iter_message_ids(
         self,
         start_date: Optional[date] = None,
         end_date: Optional[date] = None,
-        include_ai_responses: bool = False
-    ) -> List[Dict[str, Any]]:
+        roles: Optional[List[str]] = None
+    ) -> Iterator[str]:
+        """依時間順序列出區間內的訊息ID（多個角色時依訊息時間交錯合併）"""
+        return self.indexes.iter_date_range(start_date, end_date, roles, key=self._message_timestamp)
+    
+    def _message_timestamp(self, message_id: str) -> datetime:
+        # 讀入的訊息會留在快取，呼叫端接著讀取同一筆時不再讀檔
+        return self.messages[message_id].timestamp
+    
+    def iter_annotation_export(
+        self,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        include_ai_responses: bool = False,
+        collapse_duplicates: bool = False,
+        prefill_entities: bool = False
+    ) -> Iterator[Dict[str, Any]]:
         """
-        匯出標註資料
+        逐筆產生標註資料
         
-        預設只匯出病人輸入，供標註團隊使用
+        預設只匯出病人輸入，供標註團隊使用（依日期索引只讀取區間內的訊息）。
+        一次只持有一筆，匯出量再大記憶體用量也固定。
+        collapse_duplicates=True 時每個近似重複群集只匯出第一筆，並附上群集大小。
+        prefill_entities=True 時尚未標註實體的病人訊息預填擷取出的症狀片段。
         """
-        export_data = []
+        # 只匯出病人訊息
+        roles = None if include_ai_responses else [MessageRole.PATIENT.value]
+        seen_clusters: Set[str] = set()
         
-        for message in self.messages.values():
-            # 只匯出病人訊息
-            if not include_ai_responses and message.role != MessageRole.PATIENT:
+        for message_id in self.iter_message_ids(start_date, end_date, roles):
+            if collapse_duplicates and self._seen_cluster(message_id, seen_clusters):
                 continue
+            message = self.messages[message_id]
             
-            # 日期過濾
-            msg_date = message.timestamp.date()
-            if start_date and msg_date < start_date:
-                continue
-            if end_date and msg_date > end_date:
-                continue
+            record = self._annotation_record(message, prefill_entities)
+            if collapse_duplicates:
+                record["duplicate_count"] = self.near_duplicates.cluster_size(
+                    self.near_duplicates.cluster_of(message_id)
+                )
+            yield record
+    
+    def _seen_cluster(self, doc_id: str, seen_clusters: Set[str]) -> bool:
+        """群集已出現過則回傳 True；否則記錄下來"""
+        cluster_id = self.near_duplicates.cluster_of(doc_id)
+        if cluster_id in seen_clusters:
+            return True
+        seen_clusters.add(cluster_id)
+        return False
+    
+    @staticmethod
+    def _annotation_record(message: ConversationMessage, prefill_entities: bool = False) -> Dict[str, Any]:
+        """訊息 → 標註資料格式"""
+        record = {
+            "message_id": message.message_id,
+            "patient_id": message.patient_id,
+            "timestamp": message.timestamp.isoformat(),
+            "content": message.content,
+            "raw_input": message.raw_input,
+            "input_method": message.input_method,
             
-            export_item = {
-                "message_id": message.message_id,
-                "patient_id": message.patient_id,
-                "timestamp": message.timestamp.isoformat(),
-                "content": message.content,
-                "raw_input": message.raw_input,
-                "input_method": message.input_method,
-                
-                # 預設標註（供參考）
-                "auto_detected_intent": message.detected_intent.value,
-                "auto_detected_emotion": message.detected_emotion.value,
-                "auto_detected_urgency": message.detected_urgency.value,
-                
-                # 人工標註欄位（待填寫）
-                "annotated_intent": message.annotated_intent,
-                "annotated_emotion": message.annotated_emotion,
-                "annotated_urgency": message.annotated_urgency,
-                "annotated_entities": message.annotated_entities,
-                "annotator_id": None,
-                "annotation_time": None
-            }
+            # 預設標註（供參考）
+            "auto_detected_intent": message.detected_intent.value,
+            "auto_detected_emotion": message.detected_emotion.value,
+            "auto_detected_urgency": message.detected_urgency.value,
             
-            export_data.append(export_item)
+            # 目前的多數決（唯讀參考；回匯時不讀取，避免算成本次標註者的標籤）
+            "consensus_intent": message.annotated_intent,
+            "consensus_emotion": message.annotated_emotion,
+            "consensus_urgency": message.annotated_urgency,
+            "consensus_entities": message.annotated_entities,
+            
+            # 人工標註欄位（待填寫）
+            "annotated_intent": None,
+            "annotated_emotion": None,
+            "annotated_urgency": None,
+            "annotated_entities": None,
+            "annotator_id": None,
+            "annotation_time": None
+        }
+        
+        # 預填的實體附上指紋；交回時內容未變即不算人工標註（見 annotation_import.parse_label）
+        if prefill_entities and message.annotated_entities is None and message.role == MessageRole.PATIENT:
+            entities = entity_extractor.extract_entities(message.content)
+            if entities:
+                record["annotated_entities"] = entities
+                record["entities_prefilled"] = True
+                record["entities_prefill_hash"] = entities_fingerprint(entities)
+        return record
+    
+    def sample_for_annotation(
+        self,
+        n: int,
+        strata: Tuple[str, ...] = ("detected_intent", "detected_urgency"),
+        seed: int = 0,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        exclude_annotated: bool = True,
+        collapse_duplicates: bool = False,
+        prefill_entities: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        分層抽樣標註批次
+        
+        單次串流掃描病人訊息，每個分層做水庫抽樣後平均分配 n 筆
+        （樣本不足的分層把名額讓給其他分層）。同一份資料與同一 seed 結果相同；
+        換 seed 即可抽下一批。
+        
+        Args:
+            n: 批次大小
+            strata: 分層依據的訊息欄位（列舉欄位取其值）
+            seed: 亂數種子
+            exclude_annotated: 排除已有人工標註的訊息
+            collapse_duplicates: 每個近似重複群集只取第一筆未排除的訊息（不佔用其他重複句的名額）
+            prefill_entities: 預填擷取出的症狀實體片段
+        
+        Returns:
+            標註資料（格式同 iter_annotation_export），依分層排列
+        """
+        reservoir = StratifiedReservoir(n, seed)
+        roles = [MessageRole.PATIENT.value]
+        seen_clusters: Set[str] = set()
+        
+        for message_id in self.iter_message_ids(start_date, end_date, roles):
+            message = self.messages[message_id]
+            # 先排除已標註的訊息，群集改由第一筆未標註的重複句代表
+            if exclude_annotated and message.annotations:
+                continue
+            if collapse_duplicates and self._seen_cluster(message_id, seen_clusters):
+                continue
+            key = tuple(_field_value(getattr(message, name)) for name in strata)
+            reservoir.add(key, message_id)
+        
+        records = []
+        for message_ids in reservoir.sample(n).values():
+            for message_id in message_ids:
+                message = self.messages[message_id]
+                records.append(self._annotation_record(message, prefill_entities))
+        return records
+    
+    def export_for_annotation(
+        self,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        include_ai_responses: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        匯出標註資料
         
-        return export_data
+        預設只匯出病人輸入，供標註團隊使用；大量資料請改用 iter_annotation_export
+        """
+        return list(self.iter_annotation_export(start_date, end_date, include_ai_responses))
+    
+    def iter_open_ended_export(self, collapse_duplicates: bool = False) -> Iterator[Dict[str, Any]]:
+        """逐筆產生開放式回應標註資料（可每個近似重複群集只取第一筆）"""
+        seen_clusters: Set[str] = set()
+        for response_id in self.open_ended_responses.keys():
+            if collapse_duplicates and self._seen_cluster(response_id, seen_clusters):
+                continue
+            response = self.open_ended_responses[response_id]
+            record = response.to_dict()
+            if collapse_duplicates:
+                record["duplicate_count"] = self.near_duplicates.cluster_size(
+                    self.near_duplicates.cluster_of(response_id)
+                )
+            yield record
     
     def export_open_ended_for_annotation(self) -> List[Dict[str, Any]]:
         """匯出開放式回應供標註"""
-        return [resp.to_dict() for resp in self.open_ended_responses.values()]
+        return list(self.iter_open_ended_export())
     
     def export_sessions_summary(self) -> List[Dict[str, Any]]:
-        """匯出會話摘要"""
+        """匯出會話摘要（已移出記憶體的會話逐一讀回）"""
         summaries = []
         
-        for session in self.sessions.values():
+        for session_id in self.sessions.keys():
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue
+            
             summary = {
                 "session_id": session.session_id,
                 "patient_id": session.patient_id,
@@ -393,59 +1398,175 @@ class ConversationStore:
         
         return summaries
     
+    # ============================================
+    # 全文檢索
+    # ============================================
+    
+    def search(
+        self,
+        query: str,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        patient_id: Optional[str] = None,
+        kind: Optional[str] = None,
+        limit: int = 50
+    ) -> Dict[str, Any]:
+        """
+        搜尋病人訊息與開放式回應
+        
+        Args:
+            query: 空白分隔為 AND，「OR」分隔子句，「-詞」排除（例如「咳血 OR 血痰 -沒有」）
+            kind: "message"、"response" 或 None（兩者）
+            limit: 回傳筆數
+        
+        Returns:
+            {"candidates": 索引候選數, "results": [{"id", "kind", "patient_id", "time", "text", "score"}, ...]}
+            候選經子字串確認後才列入結果（排除二元組都出現但不相連的情況）
+        """
+        parsed = ParsedQuery(query)
+        with self._lock:
+            docs, scores = self.fulltext.search(
+                parsed, start_date, end_date, patient_id,
+                KIND_NAMES[kind] if kind is not None else None
+            )
+        
+        results = []
+        for doc, score in zip(docs.tolist(), scores.tolist()):
+            with self._lock:
+                doc_id, doc_kind = self.fulltext.doc(doc)
+                if doc_kind == KIND_MESSAGE:
+                    message = self.messages[doc_id]
+                    text, pid, timestamp = message.content, message.patient_id, message.timestamp
+                else:
+                    response = self.open_ended_responses[doc_id]
+                    text, pid, timestamp = response.response_text, response.patient_id, response.response_time
+            if not parsed.matches(text):
+                continue
+            results.append({
+                "id": doc_id,
+                "kind": "message" if doc_kind == KIND_MESSAGE else "response",
+                "patient_id": pid,
+                "time": timestamp.isoformat(),
+                "text": text,
+                "score": round(score, 4)
+            })
+            if len(results) >= limit:
+                break
+        
+        return {"candidates": len(docs), "results": results}
+    
     # ============================================
     # 統計分析
     # ============================================
     
     def get_patient_stats(self, patient_id: str) -> Dict[str, Any]:
-        """取得病人對話統計"""
-        patient_messages = [
-            m for m in self.messages.values()
-            if m.patient_id == patient_id and m.role == MessageRole.PATIENT
-        ]
-        
-        patient_sessions = [
-            s for s in self.sessions.values()
-            if s.patient_id == patient_id
-        ]
-        
-        # 計算統計
-        total_messages = len(patient_messages)
-        total_words = sum(len(m.content.split()) for m in patient_messages)
-        
-        # 意圖分布
-        intent_distribution = {}
-        for m in patient_messages:
-            intent = m.detected_intent.value
-            intent_distribution[intent] = intent_distribution.get(intent, 0) + 1
-        
-        # 情緒分布
-        emotion_distribution = {}
-        for m in patient_messages:
-            emotion = m.detected_emotion.value
-            emotion_distribution[emotion] = emotion_distribution.get(emotion, 0) + 1
+        """取得病人對話統計（讀取寫入時累加的統計，不掃描訊息）"""
+        with self._shard(patient_id).lock:
+            stats = self.indexes.patient_stats.get(patient_id) or PatientAggregate()
+            total_sessions = len(self.indexes.patient_sessions.get(patient_id, []))
+            total_responses = len(self.indexes.patient_responses.get(patient_id, []))
+            
+            return {
+                "patient_id": patient_id,
+                "total_sessions": total_sessions,
+                "total_messages": stats.total_messages,
+                "total_words": stats.total_words,
+                "avg_words_per_message": (
+                    stats.total_words / stats.total_messages if stats.total_messages > 0 else 0
+                ),
+                "intent_distribution": dict(stats.intent_distribution),
+                "emotion_distribution": dict(stats.emotion_distribution),
+                "open_ended_responses": total_responses
+            }
+    
+    def _compute_aggregates(self) -> Dict[str, PatientAggregate]:
+        """掃描全部病人訊息重新計算統計"""
+        aggregates: Dict[str, PatientAggregate] = {}
+        for message in self.messages.values():
+            if message.role != MessageRole.PATIENT:
+                continue
+            stats = aggregates.get(message.patient_id)
+            if stats is None:
+                stats = aggregates[message.patient_id] = PatientAggregate()
+            stats.add(message_words(message), message.detected_intent.value, message.detected_emotion.value)
+        return aggregates
+    
+    def check_aggregates(self, repair: bool = False) -> List[Dict[str, Any]]:
+        """
+        一致性檢查：由原始訊息與回應重新計算統計，與累加結果比對
         
-        return {
-            "patient_id": patient_id,
-            "total_sessions": len(patient_sessions),
-            "total_messages": total_messages,
-            "total_words": total_words,
-            "avg_words_per_message": total_words / total_messages if total_messages > 0 else 0,
-            "intent_distribution": intent_distribution,
-            "emotion_distribution": emotion_distribution,
-            "open_ended_responses": len([
-                r for r in self.open_ended_responses.values()
-                if r.patient_id == patient_id
-            ])
-        }
+        Args:
+            repair: 有差異時以重新計算的結果取代
+        
+        Returns:
+            差異列表 [{"patient_id", "field", "expected", "actual"}, ...]
+        """
+        with self._all_patient_locks(), self._lock:
+            expected = self._compute_aggregates()
+            response_ids: Dict[str, List[str]] = {}
+            for response in self.open_ended_responses.values():
+                response_ids.setdefault(response.patient_id, []).append(response.response_id)
+            
+            diffs = []
+            empty = PatientAggregate()
+            for patient_id in sorted(set(expected) | set(self.indexes.patient_stats)):
+                rebuilt = asdict(expected.get(patient_id, empty))
+                actual = asdict(self.indexes.patient_stats.get(patient_id, empty))
+                for name, value in rebuilt.items():
+                    if actual[name] != value:
+                        diffs.append({
+                            "patient_id": patient_id, "field": name,
+                            "expected": value, "actual": actual[name]
+                        })
+            
+            for patient_id in sorted(set(response_ids) | set(self.indexes.patient_responses)):
+                value = len(response_ids.get(patient_id, []))
+                actual = len(self.indexes.patient_responses.get(patient_id, []))
+                if actual != value:
+                    diffs.append({
+                        "patient_id": patient_id, "field": "open_ended_responses",
+                        "expected": value, "actual": actual
+                    })
+            
+            if repair and diffs:
+                self.indexes.patient_stats = expected
+                self.indexes.patient_responses = response_ids
+            
+            return diffs
+
+
+def _field_value(value: Any) -> Any:
+    """分層鍵：列舉取其值"""
+    return value.value if isinstance(value, Enum) else value
 
 
 # ============================================
 # 全域實例
 # ============================================
 
-# 建立全域對話儲存器
-conversation_store = ConversationStore()
+_conversation_store: Optional[ConversationStore] = None
+_conversation_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    取得全域對話儲存器（資料寫入本地日誌，重啟後自動還原）
+
+    第一次呼叫時才開啟日誌、重播並啟動背景偵測（緊急訊息記錄到升級紀錄檔）；
+    只匯入本模組不會建立 local_data/。
+    日誌目錄已由其他行程開啟時拋出 LogLockedError。
+    """
+    from detection_worker import EscalationRecorder
+    
+    global _conversation_store
+    with _conversation_store_lock:
+        if _conversation_store is None:
+            store = ConversationStore(storage=SegmentLog(CONVERSATION_LOG_DIR))
+            pool = store.enable_async_detection()
+            pool.add_escalation_handler(EscalationRecorder())
+            atexit.register(store.close)
+            _conversation_store = store
+        return _conversation_store
 
 
 # ============================================
@@ -456,14 +1577,16 @@ def log_patient_input(
     patient_id: str,
     content: str,
     input_method: str = "text",
-    raw_input: Optional[str] = None
+    raw_input: Optional[str] = None,
+    session_id: Optional[str] = None
 ) -> ConversationMessage:
-    """記錄病人輸入的便利函數"""
-    return conversation_store.add_patient_message(
+    """記錄病人輸入的便利函數（session_id 由呼叫端的工作階段提供）"""
+    return get_conversation_store().add_patient_message(
         patient_id=patient_id,
         content=content,
         input_method=input_method,
-        raw_input=raw_input
+        raw_input=raw_input,
+        session_id=session_id
     )
 
 
@@ -471,14 +1594,16 @@ def log_ai_response(
     patient_id: str,
     content: str,
     source: MessageSource = MessageSource.AI_GENERATED,
-    template_id: Optional[str] = None
+    template_id: Optional[str] = None,
+    session_id: Optional[str] = None
 ) -> ConversationMessage:
-    """記錄 AI 回應的便利函數"""
-    return conversation_store.add_ai_message(
+    """記錄 AI 回應的便利函數（session_id 由呼叫端的工作階段提供）"""
+    return get_conversation_store().add_ai_message(
         patient_id=patient_id,
         content=content,
         source=source,
-        template_id=template_id
+        template_id=template_id,
+        session_id=session_id
     )
 
 
@@ -491,7 +1616,7 @@ def log_open_ended_response(
     response_text: str
 ) -> OpenEndedResponse:
     """記錄開放式回應的便利函數"""
-    return conversation_store.add_open_ended_response(
+    return get_conversation_store().add_open_ended_response(
         patient_id=patient_id,
         report_id=report_id,
         question_id=question_id,
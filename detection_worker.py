@@ -0,0 +1,286 @@
+"""
+AI-CARE Lung - 非同步訊息偵測模組
+================================
+功能：
+1. 病人訊息先寫入（預設標註待補），意圖 / 情緒 / 緊急程度偵測交由背景執行緒
+2. 一般結果累積成批次寫回（達到批次大小或最長延遲即寫入）
+3. 緊急結果不等批次，立即寫回並通知升級處理器（needs_human_review）
+4. 佇列有上限：滿載時退回同步偵測，升級通知的延遲有上界
+5. 升級紀錄寫入本地 JSONL（EscalationRecorder），供個管師檢視
+
+偵測器變慢（規則變多、改用模型）時，只影響背景執行緒，不拖慢對話畫面重新執行。
+行程在結果寫回前中止時，訊息保留 detection_version = None，
+執行 relabel_pipeline.py 即會補上。
+
+三軍總醫院 數位醫療中心
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple, Callable, Deque, Dict, Any
+
+from models import ConversationMessage, UrgencyLevel, LOCAL_DATA_DIR
+from keyword_matcher import DetectionResult
+from text_classifier import DETECTION_VERSION, detect
+
+# ============================================
+# 設定
+# ============================================
+
+DEFAULT_WORKERS = 2
+
+# 佇列上限：超過時在呼叫端同步偵測（背壓）
+DEFAULT_MAX_PENDING = 1000
+
+# 一般結果的寫回批次
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_MAX_BATCH_DELAY = 0.5
+
+# 最近升級紀錄保留筆數
+RECENT_ESCALATIONS = 100
+
+# 升級紀錄檔（每筆一行 JSON）
+ESCALATION_LOG_PATH = os.path.join(LOCAL_DATA_DIR, "escalations", "escalations.jsonl")
+
+# 佇列項目：(message_id, patient_id, session_id, 內容, 加入時間)
+_Item = Tuple[str, str, str, str, float]
+
+# 寫回格式與 ConversationStore.update_detections 相同
+_Result = Tuple[str, str, str, int, bool]
+
+
+@dataclass
+class Escalation:
+    """需要人工檢視的緊急訊息"""
+    message_id: str
+    patient_id: str
+    session_id: str
+    urgency: UrgencyLevel
+    queued_at: float
+    detected_at: float
+
+    @property
+    def delay(self) -> float:
+        """從訊息寫入到完成偵測的秒數"""
+        return self.detected_at - self.queued_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "message_id": self.message_id,
+            "patient_id": self.patient_id,
+            "session_id": self.session_id,
+            "urgency": self.urgency.value,
+            "delay_seconds": round(self.delay, 3),
+            "recorded_at": datetime.now().isoformat()
+        }
+
+
+EscalationHandler = Callable[[Escalation], None]
+
+
+class EscalationRecorder:
+    """
+    升級處理器：把緊急訊息附加到 JSONL 檔，供個管師檢視
+
+    寫入失敗只記下錯誤次數，不讓例外中止背景執行緒。
+    """
+
+    def __init__(self, path: str = ESCALATION_LOG_PATH):
+        self.path = path
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, escalation: Escalation):
+        line = json.dumps(escalation.to_dict(), ensure_ascii=False)
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError:
+                self.failures += 1
+
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """最近的升級紀錄（新到舊）"""
+        with self._lock:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    lines = deque(f, maxlen=limit)
+            except FileNotFoundError:
+                return []
+        records = []
+        for line in reversed(lines):
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return records
+
+
+class DetectionWorkerPool:
+    """
+    背景偵測執行緒池
+
+    結果經由 store.update_detections 寫回（同時更新日誌、訊息物件與病人統計）。
+    """
+
+    def __init__(
+        self,
+        store,
+        detector: Callable[[str], DetectionResult] = detect,
+        version: str = DETECTION_VERSION,
+        workers: int = DEFAULT_WORKERS,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_batch_delay: float = DEFAULT_MAX_BATCH_DELAY
+    ):
+        self.store = store
+        self.detector = detector
+        self.version = version
+        self.batch_size = batch_size
+        self.max_batch_delay = max_batch_delay
+
+        self._queue: "queue.Queue[Optional[_Item]]" = queue.Queue(maxsize=max_pending)
+        self._batch: List[_Result] = []
+        self._batch_started = 0.0
+        self._batch_lock = threading.Lock()
+        self._handlers: List[EscalationHandler] = []
+        self._closed = False
+
+        # 統計
+        self.processed = 0
+        self.inline_count = 0
+        self.escalated = 0
+        self.max_escalation_delay = 0.0
+        self.recent_escalations: Deque[Escalation] = deque(maxlen=RECENT_ESCALATIONS)
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f"detection-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # ============================================
+    # 提交
+    # ============================================
+
+    def has_capacity(self) -> bool:
+        """佇列未滿（滿載時呼叫端應直接同步偵測）"""
+        return not self._closed and not self._queue.full()
+
+    def submit(self, message: ConversationMessage):
+        """排入偵測；佇列剛好滿載時改在目前執行緒處理"""
+        item = (message.message_id, message.patient_id, message.session_id, message.content, time.monotonic())
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.inline_count += 1
+            self._process(item)
+            self._flush_batch()
+
+    def add_escalation_handler(self, handler: EscalationHandler):
+        """註冊升級處理器（於背景執行緒呼叫，須自行處理例外與執行緒安全）"""
+        self._handlers.append(handler)
+
+    def escalate_inline(self, message: ConversationMessage):
+        """佇列滿載、呼叫端已同步偵測出緊急訊息時，照樣通知升級處理器"""
+        now = time.monotonic()
+        self._escalate(Escalation(
+            message.message_id, message.patient_id, message.session_id, message.detected_urgency, now, now
+        ))
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    # ============================================
+    # 背景處理
+    # ============================================
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.max_batch_delay)
+            except queue.Empty:
+                self._flush_batch(only_if_due=True)
+                continue
+
+            try:
+                if item is None:
+                    return
+                self._process(item)
+                self._flush_batch(only_if_due=True)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, item: _Item):
+        message_id, patient_id, session_id, content, queued_at = item
+        detection = self.detector(content)
+        emergency = detection.urgency == UrgencyLevel.EMERGENCY
+        result = (
+            message_id,
+            detection.intent.value,
+            detection.emotion.value,
+            detection.urgency.value,
+            emergency
+        )
+        if not emergency:
+            with self._batch_lock:
+                self.processed += 1
+                if not self._batch:
+                    self._batch_started = time.monotonic()
+                self._batch.append(result)
+            return
+
+        # 快速路徑：立即寫回並通知
+        self.store.update_detections([result], self.version)
+        with self._batch_lock:
+            self.processed += 1
+        self._escalate(Escalation(message_id, patient_id, session_id, detection.urgency, queued_at, time.monotonic()))
+
+    def _escalate(self, escalation: Escalation):
+        with self._batch_lock:
+            self.escalated += 1
+            self.max_escalation_delay = max(self.max_escalation_delay, escalation.delay)
+            self.recent_escalations.append(escalation)
+        for handler in self._handlers:
+            handler(escalation)
+
+    def _flush_batch(self, only_if_due: bool = False):
+        with self._batch_lock:
+            if not self._batch:
+                return
+            if only_if_due and (
+                len(self._batch) < self.batch_size
+                and time.monotonic() - self._batch_started < self.max_batch_delay
+            ):
+                return
+            batch, self._batch = self._batch, []
+        self.store.update_detections(batch, self.version)
+
+    # ============================================
+    # 同步與關閉
+    # ============================================
+
+    def flush(self):
+        """等待佇列清空並寫回所有結果"""
+        self._queue.join()
+        self._flush_batch()
+
+    def close(self):
+        """處理完剩餘項目後停止執行緒"""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._flush_batch()
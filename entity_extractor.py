@@ -0,0 +1,199 @@
+"""
+AI-CARE Lung - 症狀實體擷取模組
+==============================
+功能：
+1. 症狀（SYMPTOM_DEFINITIONS 關鍵字）、身體部位、嚴重程度詞彙編成單一 Aho–Corasick 自動機
+2. 單次掃描取得所有命中位置，重疊時取最左、最長（例如「咳嗽」優先於「咳」、「胸悶」優先於「胸」）；
+   緊鄰的同標籤片段合併為一個（「疼」+「痛」→ pain「疼痛」）
+3. 否定視窗：症狀前方數字以內有否定詞（「沒有痛」、「不會喘」）即標記 negated；
+   標點或轉折詞（「但」、「不過」）會截斷否定範圍
+4. 輸出 (start, end, label) 片段，可直接預填 annotated_entities，標註者只需修正
+
+    沒有咳嗽，但傷口很痛 → cough[2:4] negated、body_location[6:8]、severity[8:9]、pain[9:10]
+
+三軍總醫院 數位醫療中心
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Any, Tuple
+
+from models import SYMPTOM_DEFINITIONS
+from keyword_matcher import KeywordAutomaton
+
+# ============================================
+# 詞彙表
+# ============================================
+
+BODY_LOCATION_LABEL = "body_location"
+SEVERITY_LABEL = "severity"
+
+BODY_LOCATIONS = [
+    "傷口", "胸", "胸口", "胸部", "背", "背部", "肩", "肩膀", "手臂", "腋下", "肋骨",
+    "腰", "肚子", "腹部", "胃", "頭", "喉嚨", "脖子", "腳", "腿",
+    "左邊", "右邊", "左側", "右側", "引流管",
+]
+
+SEVERITY_TERMS = [
+    "有點", "一點", "一點點", "稍微", "輕微", "還好",
+    "很", "非常", "超級", "特別", "劇烈", "嚴重", "厲害", "受不了",
+] + [f"{score}分" for score in range(11)]
+
+# 否定詞
+NEGATION_CUES = ["沒有", "沒", "無", "不", "不會", "未", "沒什麼", "從沒"]
+
+# 轉折詞：截斷否定範圍
+CLAUSE_BREAKS = ["但", "但是", "可是", "不過", "只是"]
+
+# 含否定字但不是否定的詞（比否定詞長，最長比對時優先）
+NON_NEGATIONS = ["不舒服", "不知道", "不確定", "不一定", "不錯"]
+
+# 截斷否定範圍的標點
+_BREAK_CHARS = set("，。,.!！?？;；、\n")
+
+# 否定詞與症狀之間最多幾個字（不含其他實體，例如「沒有咳嗽和喘」的「喘」仍屬否定）
+DEFAULT_NEGATION_WINDOW = 4
+
+# 詞彙種類（相同位置與長度時，數字小者優先；例如「傷口」視為部位而非疼痛）
+_KIND_BODY, _KIND_SEVERITY, _KIND_SYMPTOM = 0, 1, 2
+_KIND_NEGATION, _KIND_BREAK, _KIND_NON_NEGATION = 3, 4, 5
+_ENTITY_KINDS = (_KIND_BODY, _KIND_SEVERITY, _KIND_SYMPTOM)
+
+
+@dataclass
+class EntitySpan:
+    """擷取出的實體片段（end 為開區間）"""
+    start: int
+    end: int
+    label: str
+    text: str
+    negated: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        """annotated_entities 格式"""
+        return {
+            "start": self.start,
+            "end": self.end,
+            "label": self.label,
+            "text": self.text,
+            "negated": self.negated,
+        }
+
+
+class EntityExtractor:
+    """
+    症狀 / 部位 / 嚴重程度片段擷取
+
+    每個詞彙配一個標籤編號，編號 → (長度, 種類, 實體標籤)；
+    掃描得到結束位置後回推起點。
+    """
+
+    def __init__(
+        self,
+        symptom_keywords: Dict[str, List[str]],
+        body_locations: List[str] = BODY_LOCATIONS,
+        severity_terms: List[str] = SEVERITY_TERMS,
+        negation_window: int = DEFAULT_NEGATION_WINDOW
+    ):
+        self.negation_window = negation_window
+        self._automaton = KeywordAutomaton()
+        self._terms: List[Tuple[int, int, str]] = []
+
+        lexicons = [(_KIND_BODY, BODY_LOCATION_LABEL, body_locations)]
+        lexicons.append((_KIND_SEVERITY, SEVERITY_LABEL, severity_terms))
+        lexicons.extend((_KIND_SYMPTOM, label, keywords) for label, keywords in symptom_keywords.items())
+        lexicons.append((_KIND_NEGATION, "", NEGATION_CUES))
+        lexicons.append((_KIND_BREAK, "", CLAUSE_BREAKS))
+        lexicons.append((_KIND_NON_NEGATION, "", NON_NEGATIONS))
+
+        for kind, label, words in lexicons:
+            for word in words:
+                term_id = len(self._terms)
+                self._terms.append((len(word), kind, label))
+                self._automaton.add(word, term_id)
+        self._automaton.build()
+
+    @staticmethod
+    def _select(candidates: List[Tuple[int, int, int, str]]) -> List[Tuple[int, int, int, str]]:
+        """最左、最長、不重疊（candidates: (start, end, kind, label)）"""
+        candidates.sort(key=lambda c: (c[0], c[0] - c[1], c[2]))
+        selected = []
+        last_end = 0
+        for candidate in candidates:
+            if candidate[0] >= last_end:
+                selected.append(candidate)
+                last_end = candidate[1]
+        return selected
+
+    @staticmethod
+    def _merge_adjacent(entities: List[Tuple[int, int, int, str]]) -> List[Tuple[int, int, int, str]]:
+        """緊鄰（中間沒有其他字）且標籤相同的片段合併，例如「疼痛」不拆成兩個 pain"""
+        merged = []
+        for candidate in entities:
+            if merged and merged[-1][1] == candidate[0] and merged[-1][2:] == candidate[2:]:
+                merged[-1] = (merged[-1][0], candidate[1], candidate[2], candidate[3])
+            else:
+                merged.append(candidate)
+        return merged
+
+    def extract(self, text: str, include_negated: bool = True) -> List[EntitySpan]:
+        """
+        擷取實體片段（依位置排序）
+
+        Args:
+            include_negated: 是否保留被否定的症狀（標記 negated=True）
+        """
+        entities, markers = [], []
+        terms = self._terms
+        for end, term_id in self._automaton.finditer(text):
+            length, kind, label = terms[term_id]
+            candidate = (end - length, end, kind, label)
+            (entities if kind in _ENTITY_KINDS else markers).append(candidate)
+        if not entities:
+            return []
+
+        entities = self._merge_adjacent(self._select(entities))
+        # 落在實體內的否定字不算（例如「沒胃口」、「睡不著」）
+        covered = set()
+        for start, end, _, _ in entities:
+            covered.update(range(start, end))
+        markers = [m for m in self._select(markers) if m[0] not in covered]
+
+        spans = []
+        for start, end, kind, label in entities:
+            negated = kind == _KIND_SYMPTOM and self._is_negated(text, start, markers, covered)
+            if negated and not include_negated:
+                continue
+            spans.append(EntitySpan(start, end, label, text[start:end], negated))
+        return spans
+
+    def _is_negated(self, text: str, start: int, markers: List[Tuple[int, int, int, str]], covered: set) -> bool:
+        # 症狀前方最近的否定詞 / 轉折詞
+        nearest = None
+        for marker in markers:
+            if marker[1] > start:
+                break
+            nearest = marker
+        if nearest is None or nearest[2] != _KIND_NEGATION:
+            return False
+
+        gap = 0
+        for i in range(nearest[1], start):
+            if text[i] in _BREAK_CHARS:
+                return False
+            if i not in covered:
+                gap += 1
+        return gap <= self.negation_window
+
+    def extract_entities(self, text: str, include_negated: bool = True) -> List[Dict[str, Any]]:
+        """annotated_entities 格式的預填實體"""
+        return [span.to_dict() for span in self.extract(text, include_negated)]
+
+
+# ============================================
+# 全域實例（匯入時建立）
+# ============================================
+
+entity_extractor = EntityExtractor({
+    symptom_type.value: definition.get("keywords", [])
+    for symptom_type, definition in SYMPTOM_DEFINITIONS.items()
+})
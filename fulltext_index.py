@@ -0,0 +1,326 @@
+"""
+AI-CARE Lung - 全文檢索索引模組
+==============================
+功能：
+1. 中文字元二元組（bigram）倒排索引，病人訊息與開放式回應寫入時增量維護
+2. 倒排串列為遞增的 uint32 陣列（array 模組，每筆 4 位元組），查詢時以 NumPy 交集 / 聯集
+3. 布林查詢：空白分隔為 AND、OR 分隔子句、-詞 排除（套用到所有子句）；
+   索引只能精確排除一、兩個字的詞，較長的排除詞留給呼叫端的子字串比對（ParsedQuery.matches）
+4. 日期區間、病人、資料類型篩選；依詞彙稀有度與文字長度排序
+
+    咳血                  含「咳血」
+    傷口 紅腫             同時含「傷口」與「紅腫」
+    咳血 OR 血痰 -沒有    含「咳血」或「血痰」，但不含「沒有」
+
+三軍總醫院 數位醫療中心
+"""
+
+import base64
+import math
+import re
+import unicodedata
+from array import array
+from datetime import date
+from typing import Dict, List, Optional, Any, Set, Tuple
+
+import numpy as np
+
+# ============================================
+# 設定
+# ============================================
+
+# 資料類型代碼
+KIND_MESSAGE = 0
+KIND_RESPONSE = 1
+KIND_NAMES = {"message": KIND_MESSAGE, "response": KIND_RESPONSE}
+
+# 長度欄位上限（array 'H'）
+_MAX_LENGTH = 65535
+
+_SPLIT = re.compile(r"[^\w]+")
+
+
+def normalize_query_text(text: str) -> str:
+    """全形轉半形、轉小寫（索引與查詢使用相同規則）"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def _segments(text: str) -> List[str]:
+    """依空白與標點切段（二元組不跨段）"""
+    return [segment for segment in _SPLIT.split(normalize_query_text(text)) if segment]
+
+
+class ParsedQuery:
+    """
+    解析後的布林查詢
+
+    clauses: 子句列表（每個子句為須同時包含的詞），子句之間為 OR
+    exclude: 排除的詞（不論寫在哪個子句都套用到整個查詢）
+    """
+
+    def __init__(self, query: str):
+        self.clauses: List[List[str]] = []
+        self.exclude: List[str] = []
+        for clause_text in re.split(r"\s+OR\s+", query.strip()):
+            include = []
+            for token in clause_text.split():
+                if token.startswith("-") and len(token) > 1:
+                    self.exclude.append(token[1:])
+                else:
+                    include.append(token)
+            if include:
+                self.clauses.append(include)
+
+    def matches(self, text: str) -> bool:
+        """以子字串比對確認文字符合查詢（排除二元組剛好都出現但不相連的情況）"""
+        normalized = "".join(_segments(text))
+        if any("".join(_segments(term)) in normalized for term in self.exclude):
+            return False
+        return any(
+            all("".join(_segments(term)) in normalized for term in include)
+            for include in self.clauses
+        )
+
+
+class FullTextIndex:
+    """
+    二元組倒排索引
+
+    文件依加入順序編號，因此倒排串列天然遞增，新增只需 append。
+    單字查詢以「含該字的所有二元組」聯集處理，不另外建立單字索引。
+    """
+
+    def __init__(self):
+        self._doc_ids: List[str] = []
+        self._kinds = array("b")
+        self._dates = array("i")        # date.toordinal()
+        self._patients = array("i")     # 病人代碼
+        self._lengths = array("H")
+        self._patient_codes: Dict[str, int] = {}
+
+        self._postings: Dict[str, array] = {}
+        # 字 → 含該字的二元組（單字查詢用）
+        self._char_terms: Dict[str, Set[str]] = {}
+
+    # ============================================
+    # 建立
+    # ============================================
+
+    @staticmethod
+    def terms(text: str) -> Set[str]:
+        """文字 → 索引詞（各段的二元組；單字段落保留該字）"""
+        terms: Set[str] = set()
+        for segment in _segments(text):
+            if len(segment) == 1:
+                terms.add(segment)
+            else:
+                terms.update(segment[i:i + 2] for i in range(len(segment) - 1))
+        return terms
+
+    def add(self, doc_id: str, kind: int, patient_id: str, doc_date: date, length: int, terms: Set[str]):
+        """
+        加入文件（詞彙可先在鎖外以 terms() 算好）
+
+        文件須依寫入順序加入，倒排串列才會保持遞增
+        """
+        doc = len(self._doc_ids)
+        self._doc_ids.append(doc_id)
+        self._kinds.append(kind)
+        self._dates.append(doc_date.toordinal())
+        self._patients.append(self._patient_code(patient_id))
+        self._lengths.append(min(length, _MAX_LENGTH))
+
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = array("I")
+                for ch in set(term):
+                    self._char_terms.setdefault(ch, set()).add(term)
+            posting.append(doc)
+
+    def _patient_code(self, patient_id: str) -> int:
+        code = self._patient_codes.get(patient_id)
+        if code is None:
+            code = self._patient_codes[patient_id] = len(self._patient_codes)
+        return code
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+    @property
+    def term_count(self) -> int:
+        return len(self._postings)
+
+    def approx_bytes(self) -> int:
+        """估計記憶體用量（倒排串列 + 文件欄位 + 詞彙字典；不含文件ID字串本身，與訊息表共用）"""
+        postings = sum(p.buffer_info()[1] * p.itemsize + 80 for p in self._postings.values())
+        columns = sum(
+            values.buffer_info()[1] * values.itemsize
+            for values in (self._kinds, self._dates, self._patients, self._lengths)
+        )
+        # 詞彙字串 + 字典項目；文件ID 串列每筆一個指標
+        terms = len(self._postings) * (80 + 32)
+        return postings + columns + terms + len(self._doc_ids) * 8
+
+    # ============================================
+    # 查詢
+    # ============================================
+
+    def _posting(self, term: str) -> np.ndarray:
+        posting = self._postings.get(term)
+        if posting is None:
+            return np.empty(0, dtype=np.uint32)
+        # 複製一份：array 之後還會 append，不能被 NumPy 檢視持有
+        return np.frombuffer(posting, dtype=np.uint32).copy()
+
+    def _segment_docs(self, segment: str) -> np.ndarray:
+        if len(segment) == 1:
+            # 以點陣圖聯集（含該字的二元組可能很多，避免排序）
+            mark = np.zeros(len(self._doc_ids), dtype=bool)
+            for term in self._char_terms.get(segment, ()):
+                mark[np.frombuffer(self._postings[term], dtype=np.uint32)] = True
+            return np.flatnonzero(mark).astype(np.uint32)
+
+        bigrams = sorted(
+            {segment[i:i + 2] for i in range(len(segment) - 1)},
+            key=lambda term: len(self._postings.get(term, ()))
+        )
+        docs = self._posting(bigrams[0])
+        for term in bigrams[1:]:
+            if not len(docs):
+                break
+            docs = np.intersect1d(docs, self._posting(term), assume_unique=True)
+        return docs
+
+    def term_docs(self, term: str) -> np.ndarray:
+        """含該詞的候選文件（遞增；各段所有二元組都出現即列入）"""
+        docs = None
+        for segment in _segments(term):
+            segment_docs = self._segment_docs(segment)
+            docs = segment_docs if docs is None else np.intersect1d(docs, segment_docs, assume_unique=True)
+        return docs if docs is not None else np.empty(0, dtype=np.uint32)
+
+    @staticmethod
+    def is_exact(term: str) -> bool:
+        """
+        term_docs 是否恰為含該詞的文件
+
+        一、兩個字的詞直接對應單字 / 二元組倒排串列；更長的詞只保證所有二元組都出現
+        （「沒有發冷」會包含「沒有發燒但有發冷」），只能當候選，不能拿來排除。
+        """
+        segments = _segments(term)
+        return len(segments) == 1 and len(segments[0]) <= 2
+
+    def search(
+        self,
+        query: ParsedQuery,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        patient_id: Optional[str] = None,
+        kind: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        布林查詢並排序
+
+        排除詞只有一、兩個字時在索引中扣除；較長的排除詞不扣除，由呼叫端以 ParsedQuery.matches 確認。
+
+        Returns:
+            (文件編號, 分數)，依分數由高到低、同分時新的在前
+        """
+        total = max(len(self._doc_ids), 1)
+        docs_parts, score_parts = [], []
+
+        excluded = [self.term_docs(term) for term in query.exclude if self.is_exact(term)]
+
+        for include in query.clauses:
+            term_docs = sorted((self.term_docs(term) for term in include), key=len)
+            docs = term_docs[0]
+            for other in term_docs[1:]:
+                docs = np.intersect1d(docs, other, assume_unique=True)
+            for other in excluded:
+                if len(docs):
+                    docs = np.setdiff1d(docs, other, assume_unique=True)
+            if not len(docs):
+                continue
+            # 越少見的詞權重越高
+            weight = sum(math.log(1 + total / max(len(d), 1)) for d in term_docs)
+            docs_parts.append(docs)
+            score_parts.append(np.full(len(docs), weight))
+
+        if not docs_parts:
+            return np.empty(0, dtype=np.uint32), np.empty(0)
+
+        docs = np.concatenate(docs_parts)
+        scores = np.concatenate(score_parts)
+        if len(docs_parts) > 1:
+            # 同一文件符合多個子句時分數相加
+            docs, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=scores)
+
+        mask = np.ones(len(docs), dtype=bool)
+        if start_date is not None or end_date is not None:
+            dates = np.frombuffer(self._dates, dtype=np.int32)[docs]
+            if start_date is not None:
+                mask &= dates >= start_date.toordinal()
+            if end_date is not None:
+                mask &= dates <= end_date.toordinal()
+        if patient_id is not None:
+            code = self._patient_codes.get(patient_id, -1)
+            mask &= np.frombuffer(self._patients, dtype=np.int32)[docs] == code
+        if kind is not None:
+            mask &= np.frombuffer(self._kinds, dtype=np.int8)[docs] == kind
+        docs, scores = docs[mask], scores[mask]
+
+        # 短文字中出現的詞較集中，分數較高
+        lengths = np.frombuffer(self._lengths, dtype=np.uint16)[docs].astype(np.float64)
+        scores = scores / (1.0 + np.log1p(lengths))
+
+        order = np.lexsort((-docs.astype(np.int64), -scores))
+        return docs[order], scores[order]
+
+    def doc(self, doc: int) -> Tuple[str, int]:
+        """文件編號 → (文件ID, 類型)"""
+        return self._doc_ids[doc], self._kinds[doc]
+
+    # ============================================
+    # 快照
+    # ============================================
+
+    def export_state(self) -> Dict[str, Any]:
+        def encode(values: array) -> str:
+            return base64.b64encode(values.tobytes()).decode("ascii")
+
+        return {
+            "doc_ids": list(self._doc_ids),
+            "kinds": encode(self._kinds),
+            "dates": encode(self._dates),
+            "patients": encode(self._patients),
+            "lengths": encode(self._lengths),
+            "patient_ids": list(self._patient_codes),
+            "postings": {term: encode(posting) for term, posting in self._postings.items()},
+        }
+
+    def restore_state(self, state: Dict[str, Any]) -> bool:
+        """由快照還原；沒有索引資料時回傳 False（呼叫端應改為重建）"""
+        if "doc_ids" not in state:
+            return False
+
+        def decode(typecode: str, encoded: str) -> array:
+            values = array(typecode)
+            values.frombytes(base64.b64decode(encoded))
+            return values
+
+        self._doc_ids = list(state["doc_ids"])
+        self._kinds = decode("b", state["kinds"])
+        self._dates = decode("i", state["dates"])
+        self._patients = decode("i", state["patients"])
+        self._lengths = decode("H", state["lengths"])
+        self._patient_codes = {patient_id: i for i, patient_id in enumerate(state["patient_ids"])}
+
+        self._postings = {}
+        self._char_terms = {}
+        for term, encoded in state["postings"].items():
+            self._postings[term] = decode("I", encoded)
+            for ch in set(term):
+                self._char_terms.setdefault(ch, set()).add(term)
+        return True
@@ -20,6 +20,12 @@ import json
 import hashlib
 from typing import Optional, Dict, List, Any, Tuple
 
+from sheet_schema import (
+    PATIENTS_SCHEMA, REPORTS_SCHEMA, CONVERSATIONS_SCHEMA, ACHIEVEMENTS_SCHEMA,
+    ALERTS_SCHEMA, ALL_SCHEMAS, SCORE_KEYS, LayoutCache, migrate_worksheet
+)
+from blob_store import get_blob_store, split_content
+
 # ============================================
 # Google Sheet 連接設定
 # ============================================
@@ -31,10 +37,14 @@ SCOPES = [
 ]
 
 # 工作表名稱
-SHEET_PATIENTS = "病人資料"
-SHEET_REPORTS = "症狀回報"
-SHEET_CONVERSATIONS = "對話記錄"
-SHEET_ACHIEVEMENTS = "成就記錄"
+SHEET_PATIENTS = PATIENTS_SCHEMA.name
+SHEET_REPORTS = REPORTS_SCHEMA.name
+SHEET_CONVERSATIONS = CONVERSATIONS_SCHEMA.name
+SHEET_ACHIEVEMENTS = ACHIEVEMENTS_SCHEMA.name
+SHEET_ALERTS = ALERTS_SCHEMA.name
+
+# 工作表版面快取（欄位位置由標題列決定；寫入前以 for_write 核對標題列）
+layout_cache = LayoutCache()
 
 
 def get_google_client():
@@ -87,46 +97,18 @@ def init_spreadsheet():
         return False
     
     try:
-        existing_sheets = [ws.title for ws in spreadsheet.worksheets()]
-        
-        # 病人資料表
-        if SHEET_PATIENTS not in existing_sheets:
-            ws = spreadsheet.add_worksheet(title=SHEET_PATIENTS, rows=1000, cols=20)
-            ws.append_row([
-                "病人ID", "姓名", "性別", "年齡", "生日", 
-                "手機號碼", "手術日期", "手術類型", "癌症分期",
-                "密碼雜湊", "註冊時間", "最後登入", "狀態"
-            ])
-        
-        # 症狀回報表
-        if SHEET_REPORTS not in existing_sheets:
-            ws = spreadsheet.add_worksheet(title=SHEET_REPORTS, rows=10000, cols=30)
-            ws.append_row([
-                "回報ID", "病人ID", "回報日期", "回報時間", "回報方式",
-                "疼痛分數", "疲勞分數", "呼吸困難分數", "咳嗽分數", 
-                "睡眠分數", "食慾分數", "心情分數",
-                "疼痛描述", "疲勞描述", "呼吸困難描述", "咳嗽描述",
-                "睡眠描述", "食慾描述", "心情描述",
-                "開放式回答1", "開放式回答2", "額外備註",
-                "平均分數", "最高分數項目", "建立時間"
-            ])
-        
-        # 對話記錄表
-        if SHEET_CONVERSATIONS not in existing_sheets:
-            ws = spreadsheet.add_worksheet(title=SHEET_CONVERSATIONS, rows=50000, cols=15)
-            ws.append_row([
-                "訊息ID", "會話ID", "病人ID", "角色", "內容",
-                "訊息來源", "輸入方式", "範本ID",
-                "偵測意圖", "偵測情緒", "時間戳記"
-            ])
-        
-        # 成就記錄表
-        if SHEET_ACHIEVEMENTS not in existing_sheets:
-            ws = spreadsheet.add_worksheet(title=SHEET_ACHIEVEMENTS, rows=5000, cols=10)
-            ws.append_row([
-                "記錄ID", "病人ID", "成就ID", "成就名稱", 
-                "解鎖日期", "獲得積分"
-            ])
+        existing_sheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+        
+        for schema in ALL_SCHEMAS:
+            if schema.name not in existing_sheets:
+                # 建立新工作表
+                ws = spreadsheet.add_worksheet(title=schema.name, rows=schema.rows, cols=schema.cols)
+                ws.append_row(schema.header)
+            else:
+                # 既有工作表：驗證標題列並補上新欄位
+                migrate_worksheet(existing_sheets[schema.name], schema)
+        
+        layout_cache.invalidate()
         
         return True
     
@@ -156,6 +138,12 @@ def verify_password(password: str, hashed: str) -> bool:
 class PatientManager:
     """病人資料管理"""
     
+    # 可由 update_patient 修改的欄位
+    UPDATABLE_FIELDS = (
+        "name", "gender", "age", "birthday", "phone",
+        "surgery_date", "surgery_type", "cancer_stage"
+    )
+    
     def __init__(self):
         self.spreadsheet = get_spreadsheet()
     
@@ -192,28 +180,30 @@ class PatientManager:
             return False, "無法連接資料庫"
         
         try:
+            layout = layout_cache.for_write(ws, PATIENTS_SCHEMA)
+            
             # 檢查病人ID是否已存在
-            existing = ws.findall(patient_id, in_column=1)
+            existing = ws.findall(patient_id, in_column=layout.column("patient_id"))
             if existing:
                 return False, "此病歷號已註冊"
             
             # 新增病人資料
             now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ws.append_row([
-                patient_id,
-                name,
-                gender,
-                age,
-                birthday,
-                phone,
-                surgery_date,
-                surgery_type,
-                cancer_stage,
-                hash_password(password),
-                now,  # 註冊時間
-                now,  # 最後登入
-                "active"  # 狀態
-            ])
+            ws.append_row(layout.encode({
+                "patient_id": patient_id,
+                "name": name,
+                "gender": gender,
+                "age": age,
+                "birthday": birthday,
+                "phone": phone,
+                "surgery_date": surgery_date,
+                "surgery_type": surgery_type,
+                "cancer_stage": cancer_stage,
+                "password_hash": hash_password(password),
+                "registered_at": now,
+                "last_login": now,
+                "status": "active"
+            }))
             
             return True, "註冊成功！"
         
@@ -232,37 +222,38 @@ class PatientManager:
             return False, None
         
         try:
+            layout = layout_cache.for_write(ws, PATIENTS_SCHEMA)
+            
             # 尋找病人
-            cell = ws.find(patient_id, in_column=1)
+            cell = ws.find(patient_id, in_column=layout.column("patient_id"))
             if not cell:
                 return False, None
             
             # 取得該行資料
-            row = ws.row_values(cell.row)
+            record = layout.decode(ws.row_values(cell.row))
             
             # 驗證密碼
-            stored_hash = row[9] if len(row) > 9 else ""
-            if not verify_password(password, stored_hash):
+            if not verify_password(password, record["password_hash"]):
                 return False, None
             
             # 更新最後登入時間
-            ws.update_cell(cell.row, 12, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            ws.update_cell(cell.row, layout.column("last_login"), datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
             
             # 計算術後天數
-            surgery_date = datetime.strptime(row[6], "%Y-%m-%d").date() if row[6] else date.today()
+            surgery_date = datetime.strptime(record["surgery_date"], "%Y-%m-%d").date() if record["surgery_date"] else date.today()
             post_op_day = (date.today() - surgery_date).days
             
             # 回傳病人資料
             patient_data = {
-                "id": row[0],
-                "name": row[1],
-                "gender": row[2],
-                "age": int(row[3]) if row[3] else 0,
-                "birthday": row[4],
-                "phone": row[5],
+                "id": record["patient_id"],
+                "name": record["name"],
+                "gender": record["gender"],
+                "age": record["age"],
+                "birthday": record["birthday"],
+                "phone": record["phone"],
                 "surgery_date": surgery_date,
-                "surgery_type": row[7],
-                "cancer_stage": row[8],
+                "surgery_type": record["surgery_type"],
+                "cancer_stage": record["cancer_stage"],
                 "post_op_day": post_op_day
             }
             
@@ -279,23 +270,25 @@ class PatientManager:
             return None
         
         try:
-            cell = ws.find(patient_id, in_column=1)
+            layout = layout_cache.get(ws, PATIENTS_SCHEMA)
+            
+            cell = ws.find(patient_id, in_column=layout.column("patient_id"))
             if not cell:
                 return None
             
-            row = ws.row_values(cell.row)
+            record = layout.decode(ws.row_values(cell.row))
             
-            surgery_date = datetime.strptime(row[6], "%Y-%m-%d").date() if row[6] else date.today()
+            surgery_date = datetime.strptime(record["surgery_date"], "%Y-%m-%d").date() if record["surgery_date"] else date.today()
             post_op_day = (date.today() - surgery_date).days
             
             return {
-                "id": row[0],
-                "name": row[1],
-                "gender": row[2],
-                "age": int(row[3]) if row[3] else 0,
+                "id": record["patient_id"],
+                "name": record["name"],
+                "gender": record["gender"],
+                "age": record["age"],
                 "surgery_date": surgery_date,
-                "surgery_type": row[7],
-                "cancer_stage": row[8],
+                "surgery_type": record["surgery_type"],
+                "cancer_stage": record["cancer_stage"],
                 "post_op_day": post_op_day
             }
         except:
@@ -308,20 +301,15 @@ class PatientManager:
             return False
         
         try:
-            cell = ws.find(patient_id, in_column=1)
+            layout = layout_cache.for_write(ws, PATIENTS_SCHEMA)
+            
+            cell = ws.find(patient_id, in_column=layout.column("patient_id"))
             if not cell:
                 return False
             
-            # 欄位對應
-            column_map = {
-                "name": 2, "gender": 3, "age": 4, "birthday": 5,
-                "phone": 6, "surgery_date": 7, "surgery_type": 8, 
-                "cancer_stage": 9
-            }
-            
             for field, value in updates.items():
-                if field in column_map:
-                    ws.update_cell(cell.row, column_map[field], value)
+                if field in self.UPDATABLE_FIELDS:
+                    ws.update_cell(cell.row, layout.column(field), value)
             
             return True
         except:
@@ -332,6 +320,11 @@ class PatientManager:
 # 症狀回報管理
 # ============================================
 
+def _display_scores(record: Dict[str, Any]) -> Dict[str, int]:
+    """畫面顯示用的症狀分數（未填的分數以 0 顯示；研究匯出保留 None）"""
+    return {key: record[key] or 0 for key in SCORE_KEYS}
+
+
 class ReportManager:
     """症狀回報管理"""
     
@@ -386,33 +379,24 @@ class ReportManager:
             # 找出最高分項目
             max_symptom = max(scores, key=scores.get) if scores else ""
             
-            row_data = [
-                report_id,
-                patient_id,
-                now.strftime("%Y-%m-%d"),
-                now.strftime("%H:%M:%S"),
-                method,
-                scores.get("pain", 0),
-                scores.get("fatigue", 0),
-                scores.get("dyspnea", 0),
-                scores.get("cough", 0),
-                scores.get("sleep", 0),
-                scores.get("appetite", 0),
-                scores.get("mood", 0),
-                descriptions.get("pain", ""),
-                descriptions.get("fatigue", ""),
-                descriptions.get("dyspnea", ""),
-                descriptions.get("cough", ""),
-                descriptions.get("sleep", ""),
-                descriptions.get("appetite", ""),
-                descriptions.get("mood", ""),
-                open_ended[0] if len(open_ended) > 0 else "",
-                open_ended[1] if len(open_ended) > 1 else "",
-                descriptions.get("additional", ""),
-                round(avg_score, 2),
-                max_symptom,
-                now.strftime("%Y-%m-%d %H:%M:%S")
-            ]
+            record = {
+                "report_id": report_id,
+                "patient_id": patient_id,
+                "report_date": now.strftime("%Y-%m-%d"),
+                "report_time": now.strftime("%H:%M:%S"),
+                "method": method,
+                "open_ended_1": open_ended[0] if len(open_ended) > 0 else "",
+                "open_ended_2": open_ended[1] if len(open_ended) > 1 else "",
+                "additional_notes": descriptions.get("additional", ""),
+                "avg_score": round(avg_score, 2),
+                "max_symptom": max_symptom,
+                "created_at": now.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            for key in SCORE_KEYS:
+                record[key] = scores.get(key, 0)
+                record[f"{key}_description"] = descriptions.get(key, "")
+            
+            row_data = layout_cache.for_write(ws, REPORTS_SCHEMA).encode(record)
             
             ws.append_row(row_data)
             
@@ -422,6 +406,40 @@ class ReportManager:
             st.error(f"儲存回報失敗: {e}")
             return False, ""
     
+    def save_anomaly_alerts(self, patient_id: str, report_id: str, anomalies: List[Any]) -> bool:
+        """
+        將偏離個人基準的症狀寫入異常警示工作表（個管師由此追蹤處理）
+        
+        Args:
+            anomalies: anomaly_detector.ScoreAnomaly 列表
+        
+        Returns:
+            是否成功寫入
+        """
+        if not anomalies or not self.spreadsheet:
+            return False
+        
+        try:
+            ws = self.spreadsheet.worksheet(SHEET_ALERTS)
+            layout = layout_cache.for_write(ws, ALERTS_SCHEMA)
+            now = datetime.now()
+            
+            rows = []
+            for i, anomaly in enumerate(anomalies):
+                record = anomaly.to_dict()
+                record.update({
+                    "alert_id": f"ALT_{now.strftime('%Y%m%d%H%M%S%f')}_{i}",
+                    "report_id": report_id,
+                    "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+                    "status": "open"
+                })
+                rows.append(layout.encode(record))
+            
+            ws.append_rows(rows)
+            return True
+        except:
+            return False
+    
     def get_today_report(self, patient_id: str) -> Optional[Dict]:
         """取得今日回報"""
         ws = self._get_reports_sheet()
@@ -431,25 +449,14 @@ class ReportManager:
         try:
             today = datetime.now().strftime("%Y-%m-%d")
             
-            # 取得所有資料
-            records = ws.get_all_records()
-            
-            for record in records:
-                if record.get("病人ID") == patient_id and record.get("回報日期") == today:
+            for record in self._iter_patient_records(ws, patient_id):
+                if record["report_date"] == today:
                     return {
-                        "report_id": record.get("回報ID"),
-                        "date": record.get("回報日期"),
-                        "time": record.get("回報時間"),
-                        "method": record.get("回報方式"),
-                        "scores": {
-                            "pain": record.get("疼痛分數", 0),
-                            "fatigue": record.get("疲勞分數", 0),
-                            "dyspnea": record.get("呼吸困難分數", 0),
-                            "cough": record.get("咳嗽分數", 0),
-                            "sleep": record.get("睡眠分數", 0),
-                            "appetite": record.get("食慾分數", 0),
-                            "mood": record.get("心情分數", 0)
-                        }
+                        "report_id": record["report_id"],
+                        "date": record["report_date"],
+                        "time": record["report_time"],
+                        "method": record["method"],
+                        "scores": _display_scores(record)
                     }
             
             return None
@@ -463,28 +470,19 @@ class ReportManager:
             return []
         
         try:
-            records = ws.get_all_records()
             patient_reports = []
             
             cutoff_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
             
-            for record in records:
-                if record.get("病人ID") == patient_id and record.get("回報日期", "") >= cutoff_date:
+            for record in self._iter_patient_records(ws, patient_id):
+                if record["report_date"] >= cutoff_date:
                     patient_reports.append({
-                        "report_id": record.get("回報ID"),
-                        "date": record.get("回報日期"),
-                        "time": record.get("回報時間"),
-                        "method": record.get("回報方式"),
-                        "scores": {
-                            "pain": record.get("疼痛分數", 0),
-                            "fatigue": record.get("疲勞分數", 0),
-                            "dyspnea": record.get("呼吸困難分數", 0),
-                            "cough": record.get("咳嗽分數", 0),
-                            "sleep": record.get("睡眠分數", 0),
-                            "appetite": record.get("食慾分數", 0),
-                            "mood": record.get("心情分數", 0)
-                        },
-                        "avg_score": record.get("平均分數", 0)
+                        "report_id": record["report_id"],
+                        "date": record["report_date"],
+                        "time": record["report_time"],
+                        "method": record["method"],
+                        "scores": _display_scores(record),
+                        "avg_score": record["avg_score"] or 0
                     })
             
             # 按日期排序（最新在前）
@@ -494,6 +492,19 @@ class ReportManager:
         except:
             return []
     
+    def _iter_patient_records(self, ws, patient_id: str):
+        """
+        逐列找出某病人的回報
+        
+        先以病人ID欄位位置比對，只解碼符合的列
+        """
+        layout = layout_cache.get(ws, REPORTS_SCHEMA)
+        id_index = layout.index("patient_id")
+        
+        for row in ws.get_all_values()[1:]:
+            if len(row) > id_index and row[id_index] == patient_id:
+                yield layout.decode(row)
+    
     def get_compliance_stats(self, patient_id: str, surgery_date: date) -> Dict:
         """計算順從度統計"""
         reports = self.get_patient_reports(patient_id, days=90)
@@ -591,23 +602,70 @@ class ConversationManager:
             now = datetime.now()
             message_id = f"MSG_{now.strftime('%Y%m%d%H%M%S%f')}"
             
-            ws.append_row([
-                message_id,
-                session_id,
-                patient_id,
-                role,
-                content[:500],  # 限制長度
-                source,
-                input_method,
-                template_id,
-                intent,
-                emotion,
-                now.strftime("%Y-%m-%d %H:%M:%S")
-            ])
+            layout = layout_cache.for_write(ws, CONVERSATIONS_SCHEMA)
+            if "content_hash" in layout.missing:
+                # 舊版工作表：先補上內容雜湊欄位，避免長內容找不回來
+                layout = migrate_worksheet(ws, CONVERSATIONS_SCHEMA)
+                layout_cache.invalidate()
+            
+            # 長內容完整存到本地內容儲存，工作表只保留預覽與雜湊
+            preview, content_hash = split_content(content, get_blob_store())
+            
+            ws.append_row(layout.encode({
+                "message_id": message_id,
+                "session_id": session_id,
+                "patient_id": patient_id,
+                "role": role,
+                "content": preview,
+                "content_hash": content_hash,
+                "source": source,
+                "input_method": input_method,
+                "template_id": template_id,
+                "intent": intent,
+                "emotion": emotion,
+                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S")
+            }))
             
             return True
         except:
             return False
+    
+    def get_session_messages(self, session_id: str, full_content: bool = False) -> List[Dict]:
+        """
+        取得會話的所有訊息
+        
+        Args:
+            full_content: 是否從內容儲存載入完整長內容（預設只回傳預覽）
+        """
+        ws = self._get_conversations_sheet()
+        if not ws:
+            return []
+        
+        try:
+            layout = layout_cache.get(ws, CONVERSATIONS_SCHEMA)
+            session_index = layout.index("session_id")
+            
+            messages = []
+            for row in ws.get_all_values()[1:]:
+                if len(row) > session_index and row[session_index] == session_id:
+                    record = layout.decode(row)
+                    if full_content:
+                        record["content"] = self.load_full_content(record)
+                    messages.append(record)
+            
+            return messages
+        except:
+            return []
+    
+    @staticmethod
+    def load_full_content(record: Dict) -> str:
+        """取得訊息完整內容（有雜湊時從內容儲存讀取）"""
+        content_hash = record.get("content_hash")
+        if content_hash:
+            full_text = get_blob_store().get(content_hash)
+            if full_text is not None:
+                return full_text
+        return record.get("content", "")
 
 
 # ============================================
@@ -648,16 +706,18 @@ class AchievementManager:
             return []
         
         try:
-            records = ws.get_all_records()
+            layout = layout_cache.get(ws, ACHIEVEMENTS_SCHEMA)
+            id_index = layout.index("patient_id")
             unlocked = []
             
-            for record in records:
-                if record.get("病人ID") == patient_id:
+            for row in ws.get_all_values()[1:]:
+                if len(row) > id_index and row[id_index] == patient_id:
+                    record = layout.decode(row)
                     unlocked.append({
-                        "id": record.get("成就ID"),
-                        "name": record.get("成就名稱"),
-                        "date": record.get("解鎖日期"),
-                        "points": record.get("獲得積分")
+                        "id": record["achievement_id"],
+                        "name": record["achievement_name"],
+                        "date": record["unlock_date"],
+                        "points": record["points"]
                     })
             
             return unlocked
@@ -700,14 +760,14 @@ class AchievementManager:
                     now = datetime.now()
                     record_id = f"ACH_{patient_id}_{achievement_id}_{now.strftime('%Y%m%d')}"
                     
-                    ws.append_row([
-                        record_id,
-                        patient_id,
-                        achievement_id,
-                        achievement["name"],
-                        now.strftime("%Y-%m-%d"),
-                        achievement["points"]
-                    ])
+                    ws.append_row(layout_cache.for_write(ws, ACHIEVEMENTS_SCHEMA).encode({
+                        "record_id": record_id,
+                        "patient_id": patient_id,
+                        "achievement_id": achievement_id,
+                        "achievement_name": achievement["name"],
+                        "unlock_date": now.strftime("%Y-%m-%d"),
+                        "points": achievement["points"]
+                    }))
                     
                     new_unlocks.append({
                         "id": achievement_id,
@@ -0,0 +1,261 @@
+"""
+AI-CARE Lung - 關鍵字比對模組
+============================
+功能：
+1. 意圖、情緒、緊急程度、症狀關鍵字規則表（單一來源）
+2. Aho–Corasick 自動機：匯入時建立一次，單次掃描找出所有類別命中
+3. 優先順序解析：依規則表順序取第一個命中的類別（與原規則式偵測結果一致）
+
+三軍總醫院 數位醫療中心
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Any, Tuple, Set, Iterable, Iterator
+
+from models import (
+    IntentCategory, EmotionCategory, UrgencyLevel, SYMPTOM_DEFINITIONS
+)
+
+# 規則版本：修改下方規則表時請一併更新，重新標註工作會據此找出過期的預設標註
+DETECTION_VERSION = "keywords-1"
+
+# ============================================
+# 規則表（順序即優先順序）
+# ============================================
+
+INTENT_RULES: List[Tuple[IntentCategory, List[str]]] = [
+    # 緊急關鍵字
+    (IntentCategory.EMERGENCY, ["很痛", "非常痛", "受不了", "喘不過氣", "發燒", "出血", "緊急", "救命"]),
+    # 症狀回報
+    (IntentCategory.SYMPTOM_REPORT, ["分", "今天", "昨天", "這幾天"]),
+    # 症狀諮詢
+    (IntentCategory.SYMPTOM_INQUIRY, ["正常嗎", "會不會", "是不是", "怎麼辦", "該怎麼"]),
+    # 藥物問題
+    (IntentCategory.MEDICATION_QUESTION, ["藥", "吃藥", "止痛", "副作用"]),
+    # 生活建議
+    (IntentCategory.LIFESTYLE_ADVICE, ["可以", "能不能", "運動", "洗澡", "工作", "開車"]),
+    # 情緒表達
+    (IntentCategory.EMOTIONAL_EXPRESSION, ["擔心", "害怕", "焦慮", "難過", "開心", "謝謝"]),
+    # 感謝
+    (IntentCategory.GRATITUDE, ["謝", "感謝"]),
+    # 打招呼
+    (IntentCategory.GREETING, ["你好", "早安", "午安", "晚安", "嗨"]),
+]
+
+EMOTION_RULES: List[Tuple[EmotionCategory, List[str]]] = [
+    # 焦慮/擔心
+    (EmotionCategory.ANXIOUS, ["擔心", "害怕", "焦慮", "緊張", "不安", "恐懼"]),
+    # 低落/沮喪
+    (EmotionCategory.DEPRESSED, ["難過", "沮喪", "低落", "憂鬱", "不想", "沒意思"]),
+    # 正向
+    (EmotionCategory.POSITIVE, ["謝謝", "感謝", "開心", "高興", "好多了", "進步"]),
+    # 憤怒
+    (EmotionCategory.ANGRY, ["生氣", "憤怒", "不滿", "抱怨", "受不了"]),
+]
+
+URGENCY_RULES: List[Tuple[UrgencyLevel, List[str]]] = [
+    # 緊急
+    (UrgencyLevel.EMERGENCY, ["非常痛", "劇痛", "喘不過氣", "發高燒", "大量出血", "昏倒", "意識"]),
+    # 重要
+    (UrgencyLevel.IMPORTANT, ["很痛", "發燒", "出血", "嚴重", "惡化", "加重"]),
+]
+
+# 症狀：依 SYMPTOM_DEFINITIONS 順序，全部命中都回傳
+SYMPTOM_RULES: List[Tuple[str, List[str]]] = [
+    (symptom_type.value, definition.get("keywords", []))
+    for symptom_type, definition in SYMPTOM_DEFINITIONS.items()
+]
+
+
+# ============================================
+# Aho–Corasick 自動機
+# ============================================
+
+class KeywordAutomaton:
+    """
+    多關鍵字自動機
+
+    每個關鍵字對應一組整數標籤；scan() 一次掃過文字，
+    回傳所有命中關鍵字的標籤集合（重疊、包含關係都會找到）。
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[int, ...]] = [()]
+        self._built = False
+
+    def add(self, keyword: str, label: int):
+        if self._built:
+            raise RuntimeError("自動機已建立，無法再新增關鍵字")
+        if not keyword:
+            return
+
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            node = nxt
+
+        if label not in self._output[node]:
+            self._output[node] = self._output[node] + (label,)
+
+    def build(self):
+        """以廣度優先建立失敗連結，並合併後綴節點的輸出"""
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+
+                inherited = self._output[self._fail[child]]
+                if inherited:
+                    merged = self._output[child] + tuple(
+                        label for label in inherited if label not in self._output[child]
+                    )
+                    self._output[child] = merged
+
+        # 展開為確定性轉移表：掃描時每個字元只需一次字典查詢
+        for node in queue:
+            fail_row = self._goto[self._fail[node]]
+            row = self._goto[node]
+            for ch, target in fail_row.items():
+                row.setdefault(ch, target)
+
+        self._built = True
+
+    def scan(self, text: str) -> Set[int]:
+        """單次掃描，回傳命中標籤"""
+        goto, output = self._goto, self._output
+        hits: Set[int] = set()
+        node = 0
+        for ch in text:
+            node = goto[node].get(ch, 0)
+            if output[node]:
+                hits.update(output[node])
+        return hits
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, int]]:
+        """單次掃描，逐一產生 (命中結束位置, 標籤)；結束位置不含該字元（end 為開區間）"""
+        goto, output = self._goto, self._output
+        node = 0
+        for i, ch in enumerate(text):
+            node = goto[node].get(ch, 0)
+            for label in output[node]:
+                yield i + 1, label
+
+
+# ============================================
+# 規則比對
+# ============================================
+
+@dataclass
+class DetectionResult:
+    """單次掃描的偵測結果"""
+    intent: IntentCategory
+    emotion: EmotionCategory
+    urgency: UrgencyLevel
+    symptoms: List[str]
+
+
+class KeywordMatcher:
+    """
+    規則式偵測器
+
+    所有規則表的每一條規則依表內順序配一個遞增的全域編號，
+    因此「表內最小命中編號」就是原本 if 串列第一個成立的規則。
+    """
+
+    def __init__(self, tables: Dict[str, List[Tuple[Any, List[str]]]]):
+        self._automaton = KeywordAutomaton()
+        self._rule_values: List[Any] = []
+        self._rule_tables: List[str] = []
+
+        for name, rules in tables.items():
+            for value, keywords in rules:
+                label = len(self._rule_values)
+                self._rule_values.append(value)
+                self._rule_tables.append(name)
+                for keyword in keywords:
+                    self._automaton.add(keyword, label)
+
+        self._automaton.build()
+
+    def scan(self, text: str) -> Set[int]:
+        return self._automaton.scan(text)
+
+    def resolve(self, hits: Iterable[int]) -> Dict[str, List[Any]]:
+        """命中標籤 → 各表命中類別（依規則表順序，第一個即優先順序最高者）"""
+        values, tables = self._rule_values, self._rule_tables
+        resolved: Dict[str, List[Any]] = {}
+        for label in sorted(hits):
+            table = tables[label]
+            if table in resolved:
+                resolved[table].append(values[label])
+            else:
+                resolved[table] = [values[label]]
+        return resolved
+
+    def first(self, text: str, table: str, default: Any) -> Any:
+        """表內優先順序最高的命中類別"""
+        matched = self.resolve(self.scan(text)).get(table)
+        return matched[0] if matched else default
+
+    def detect(self, text: str) -> DetectionResult:
+        """一次掃描同時取得意圖、情緒、緊急程度與症狀"""
+        hits = self.scan(text)
+        if not hits:
+            return DetectionResult(IntentCategory.OTHER, EmotionCategory.NEUTRAL, UrgencyLevel.NORMAL, [])
+
+        resolved = self.resolve(hits)
+        intent = resolved.get("intent")
+        emotion = resolved.get("emotion")
+        urgency = resolved.get("urgency")
+        return DetectionResult(
+            intent=intent[0] if intent else IntentCategory.OTHER,
+            emotion=emotion[0] if emotion else EmotionCategory.NEUTRAL,
+            urgency=urgency[0] if urgency else UrgencyLevel.NORMAL,
+            symptoms=resolved.get("symptom", [])
+        )
+
+    def detect_intent(self, text: str) -> IntentCategory:
+        return self.first(text, "intent", IntentCategory.OTHER)
+
+    def detect_emotion(self, text: str) -> EmotionCategory:
+        return self.first(text, "emotion", EmotionCategory.NEUTRAL)
+
+    def detect_urgency(self, text: str) -> UrgencyLevel:
+        return self.first(text, "urgency", UrgencyLevel.NORMAL)
+
+    def extract_symptoms(self, text: str) -> List[str]:
+        return self.resolve(self.scan(text)).get("symptom", [])
+
+
+# ============================================
+# 全域實例（匯入時建立）
+# ============================================
+
+keyword_matcher = KeywordMatcher({
+    "intent": INTENT_RULES,
+    "emotion": EMOTION_RULES,
+    "urgency": URGENCY_RULES,
+    "symptom": SYMPTOM_RULES,
+})
+
+
+def detect(text: str) -> DetectionResult:
+    """模組層級偵測函數（可傳入子行程）"""
+    return keyword_matcher.detect(text)
@@ -14,8 +14,13 @@ from dataclasses import dataclass, field
 from datetime import datetime, date
 from typing import Optional, Dict, List, Any
 from enum import Enum
+import os
+import sys
 import uuid
 
+# 大量建立的紀錄類別使用 __slots__（Python 3.10 以上才支援 dataclass slots）
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
 # ============================================
 # 列舉類型
 # ============================================
@@ -110,12 +115,46 @@ class UrgencyLevel(Enum):
 # 新增：對話訊息類別
 # ============================================
 
-@dataclass
+# 人工標註欄位：多數訊息尚未標註，只在有值時才配置字典
+ANNOTATION_FIELDS = (
+    "annotated_intent",      # Optional[str]
+    "annotated_emotion",     # Optional[str]
+    "annotated_urgency",     # Optional[int]
+    "annotated_entities",    # Optional[List[Dict]]，NER 標註
+    "annotator_id",          # Optional[str]
+    "annotation_time",       # Optional[datetime]
+    "response_quality_score",  # Optional[int]，1-5 分
+    "annotator_labels",      # Optional[Dict[str, Dict]]，各標註者的原始標籤（多人標註時）
+)
+
+
+def _annotation_property(name: str) -> property:
+    """以屬性存取稀疏標註欄位"""
+    def getter(self):
+        return self.annotations.get(name) if self.annotations else None
+    
+    def setter(self, value):
+        if value is None:
+            if self.annotations:
+                self.annotations.pop(name, None)
+                if not self.annotations:
+                    self.annotations = None
+            return
+        if self.annotations is None:
+            self.annotations = {}
+        self.annotations[name] = value
+    
+    return property(getter, setter)
+
+
+@dataclass(**DATACLASS_SLOTS)
 class ConversationMessage:
     """
     對話訊息 - 分離儲存病人輸入和 AI 回應
     
-    這是為了未來 NLP 訓練準備的核心資料結構
+    這是為了未來 NLP 訓練準備的核心資料結構。
+    訊息量大，因此使用 __slots__、病人 / 會話 ID 字串共用（intern），
+    人工標註欄位只在有值時配置。
     """
     message_id: str
     session_id: str
@@ -141,19 +180,29 @@ class ConversationMessage:
     detected_intent: IntentCategory = IntentCategory.UNKNOWN
     detected_emotion: EmotionCategory = EmotionCategory.UNKNOWN
     detected_urgency: UrgencyLevel = UrgencyLevel.NORMAL
+    detection_version: Optional[str] = None  # 產生預設標註的規則 / 模型版本
     
-    # 人工標註欄位（供標註團隊使用）
-    annotated_intent: Optional[str] = None
-    annotated_emotion: Optional[str] = None
-    annotated_urgency: Optional[int] = None
-    annotated_entities: Optional[List[Dict]] = None  # NER 標註
-    annotator_id: Optional[str] = None
-    annotation_time: Optional[datetime] = None
-    
-    # 品質評分（供標註團隊使用）
-    response_quality_score: Optional[int] = None  # 1-5 分
     needs_human_review: bool = False
     
+    # 人工標註 / 品質評分（供標註團隊使用，欄位見 ANNOTATION_FIELDS）
+    annotations: Optional[Dict[str, Any]] = None
+    
+    annotated_intent = _annotation_property("annotated_intent")
+    annotated_emotion = _annotation_property("annotated_emotion")
+    annotated_urgency = _annotation_property("annotated_urgency")
+    annotated_entities = _annotation_property("annotated_entities")
+    annotator_id = _annotation_property("annotator_id")
+    annotation_time = _annotation_property("annotation_time")
+    response_quality_score = _annotation_property("response_quality_score")
+    annotator_labels = _annotation_property("annotator_labels")
+    
+    def __post_init__(self):
+        # 同一病人 / 會話的大量訊息共用同一個 ID 字串
+        self.patient_id = sys.intern(self.patient_id)
+        self.session_id = sys.intern(self.session_id)
+        if self.raw_input is not None and self.raw_input == self.content:
+            self.raw_input = self.content
+    
     def to_dict(self) -> Dict[str, Any]:
         """轉換為字典（用於儲存）"""
         return {
@@ -171,6 +220,7 @@ class ConversationMessage:
             "detected_intent": self.detected_intent.value,
             "detected_emotion": self.detected_emotion.value,
             "detected_urgency": self.detected_urgency.value,
+            "detection_version": self.detection_version,
             "annotated_intent": self.annotated_intent,
             "annotated_emotion": self.annotated_emotion,
             "annotated_urgency": self.annotated_urgency,
@@ -178,14 +228,47 @@ class ConversationMessage:
             "annotator_id": self.annotator_id,
             "annotation_time": self.annotation_time.isoformat() if self.annotation_time else None,
             "response_quality_score": self.response_quality_score,
+            "annotator_labels": self.annotator_labels,
             "needs_human_review": self.needs_human_review
         }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ConversationMessage":
+        """由字典還原（to_dict 的反向）"""
+        annotations = {
+            name: data[name] for name in ANNOTATION_FIELDS
+            if data.get(name) is not None
+        }
+        if "annotation_time" in annotations:
+            annotations["annotation_time"] = datetime.fromisoformat(annotations["annotation_time"])
+        
+        return cls(
+            message_id=data["message_id"],
+            session_id=data.get("session_id", ""),
+            patient_id=data["patient_id"],
+            role=MessageRole(data["role"]),
+            content=data.get("content", ""),
+            source=MessageSource(data["source"]),
+            timestamp=datetime.fromisoformat(data["timestamp"]),
+            input_method=data.get("input_method"),
+            raw_input=data.get("raw_input"),
+            template_id=data.get("template_id"),
+            ai_model=data.get("ai_model"),
+            detected_intent=IntentCategory(data.get("detected_intent", "unknown")),
+            detected_emotion=EmotionCategory(data.get("detected_emotion", "unknown")),
+            detected_urgency=UrgencyLevel(data.get("detected_urgency", UrgencyLevel.NORMAL.value)),
+            detection_version=data.get("detection_version"),
+            needs_human_review=data.get("needs_human_review", False),
+            annotations=annotations or None
+        )
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class ConversationSession:
     """
     對話會話 - 記錄一次完整的對話過程
+    
+    只保存訊息 ID，訊息物件由對話儲存統一管理
     """
     session_id: str
     patient_id: str
@@ -195,8 +278,8 @@ class ConversationSession:
     # 會話類型
     session_type: str = "daily_report"  # daily_report, inquiry, follow_up
     
-    # 訊息列表
-    messages: List[ConversationMessage] = field(default_factory=list)
+    # 訊息 ID 列表（依時間順序）
+    message_ids: List[str] = field(default_factory=list)
     
     # 會話狀態
     is_completed: bool = False
@@ -212,7 +295,7 @@ class ConversationSession:
     
     def add_message(self, message: ConversationMessage):
         """新增訊息並更新統計"""
-        self.messages.append(message)
+        self.message_ids.append(message.message_id)
         
         if message.role == MessageRole.PATIENT:
             self.total_patient_messages += 1
@@ -228,7 +311,7 @@ class ConversationSession:
             "start_time": self.start_time.isoformat(),
             "end_time": self.end_time.isoformat() if self.end_time else None,
             "session_type": self.session_type,
-            "messages": [m.to_dict() for m in self.messages],
+            "message_ids": list(self.message_ids),
             "is_completed": self.is_completed,
             "completion_type": self.completion_type,
             "total_patient_messages": self.total_patient_messages,
@@ -236,6 +319,29 @@ class ConversationSession:
             "total_words_patient": self.total_words_patient,
             "linked_report_id": self.linked_report_id
         }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ConversationSession":
+        """由字典還原"""
+        end_time = data.get("end_time")
+        # 舊版資料的 messages 可能是訊息 ID 或完整訊息字典
+        message_ids = data.get("message_ids") or [
+            m if isinstance(m, str) else m["message_id"] for m in data.get("messages", [])
+        ]
+        return cls(
+            session_id=sys.intern(data["session_id"]),
+            patient_id=sys.intern(data["patient_id"]),
+            start_time=datetime.fromisoformat(data["start_time"]),
+            end_time=datetime.fromisoformat(end_time) if end_time else None,
+            session_type=data.get("session_type", "daily_report"),
+            is_completed=data.get("is_completed", False),
+            completion_type=data.get("completion_type"),
+            total_patient_messages=data.get("total_patient_messages", 0),
+            total_ai_messages=data.get("total_ai_messages", 0),
+            total_words_patient=data.get("total_words_patient", 0),
+            linked_report_id=data.get("linked_report_id"),
+            message_ids=list(message_ids)
+        )
 
 
 # ============================================
@@ -302,6 +408,26 @@ class OpenEndedResponse:
             "annotated_entities": self.annotated_entities,
             "annotation_notes": self.annotation_notes
         }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "OpenEndedResponse":
+        """由字典還原"""
+        return cls(
+            response_id=data["response_id"],
+            patient_id=data["patient_id"],
+            report_id=data.get("report_id", ""),
+            question_id=data.get("question_id", ""),
+            question_text=data.get("question_text", ""),
+            question_category=data.get("question_category", ""),
+            response_text=data.get("response_text", ""),
+            response_time=datetime.fromisoformat(data["response_time"]),
+            input_method=data.get("input_method", "text"),
+            detected_symptoms=data.get("detected_symptoms") or [],
+            detected_severity=data.get("detected_severity"),
+            detected_emotion=data.get("detected_emotion"),
+            annotated_entities=data.get("annotated_entities"),
+            annotation_notes=data.get("annotation_notes")
+        )
 
 
 # ============================================
@@ -787,6 +913,14 @@ SYMPTOM_DEFINITIONS = {
 }
 
 
+# ============================================
+# 本地資料目錄
+# ============================================
+
+# 狀態檔、快取等本地資料的存放位置（可用環境變數 AICARE_DATA_DIR 覆寫）
+LOCAL_DATA_DIR = os.environ.get("AICARE_DATA_DIR", "local_data")
+
+
 # ============================================
 # 輔助函數
 # ============================================
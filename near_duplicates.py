@@ -0,0 +1,245 @@
+"""
+AI-CARE Lung - 近似重複偵測模組
+==============================
+功能：
+1. 文字正規化（全形 / 半形、大小寫、空白與標點、語助詞）後切成字元 shingle
+2. MinHash 簽章（NumPy 向量化）估計 Jaccard 相似度
+3. 必須相同的特徵：否定詞與數字不同的文字不會歸為同一群
+   （「沒有發燒」與「有發燒」、「不會喘」與「會喘」、「5分」與「6分」各自成群）
+4. LSH 分段（banding）：寫入時只比對同一桶內的群集代表，不需兩兩比較
+5. 增量維護群集（「5分」、「5 分」、「5分。」、「大概5分吧」歸為同一群），匯出與抽樣可只取每群一筆
+
+只保留群集代表的簽章，重複越多記憶體越省。
+
+三軍總醫院 數位醫療中心
+"""
+
+import base64
+import re
+import unicodedata
+import zlib
+from typing import Dict, List, Optional, Any, Set
+
+import numpy as np
+
+# ============================================
+# 設定
+# ============================================
+
+# 簽章長度 = 分段數 × 每段列數
+DEFAULT_NUM_PERM = 64
+DEFAULT_BANDS = 16
+
+# 估計 Jaccard 相似度達此門檻才歸為同一群
+DEFAULT_THRESHOLD = 0.7
+
+# 字元 shingle 長度（中文短句以 2 字為宜）
+DEFAULT_SHINGLE_SIZE = 2
+
+# 必須相同的特徵規則版本（修改下方詞表時請更新，快照會據此重建）
+FEATURES_VERSION = 1
+
+# 否定字：出現與否（及哪幾個）必須相同才可能同群
+NEGATION_CHARS = "沒無不未別非否免"
+
+# 語助詞與模糊量詞：不影響語意，切 shingle 前移除（較長者在前）
+FILLER_WORDS = ["差不多", "大概", "大約", "應該", "左右", "吧", "啦", "喔", "哦", "呢", "啊", "耶", "欸", "嗯"]
+
+_DIGITS = re.compile(r"\d+")
+_FILLERS = re.compile("|".join(FILLER_WORDS))
+
+# 雜湊參數取 32 位元以內，a·x + b 不會超出 uint64
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def normalize_text(text: str) -> str:
+    """全形轉半形、轉小寫，並去除空白、標點與符號"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in "PZSC")
+
+
+def polarity_key(normalized: str) -> str:
+    """必須相同的特徵：出現的否定字與數字（例如「沒有痛 3分」→「沒|3」）"""
+    negations = "".join(sorted(set(ch for ch in normalized if ch in NEGATION_CHARS)))
+    return negations + "|" + ",".join(_DIGITS.findall(normalized))
+
+
+class NearDuplicateIndex:
+    """
+    MinHash / LSH 近似重複索引
+
+    文件ID → 群集ID（群集ID 為該群第一筆文件的 ID）；
+    每個分段的桶只記錄群集代表，比對時以代表的簽章估計相似度。
+    簽章的每個值都與必須相同特徵的雜湊做 XOR：特徵相同時相等關係不變，
+    特徵不同時幾乎不會有相同的值，因此不會落入同一桶、估計相似度也接近 0。
+    """
+
+    def __init__(
+        self,
+        num_perm: int = DEFAULT_NUM_PERM,
+        bands: int = DEFAULT_BANDS,
+        threshold: float = DEFAULT_THRESHOLD,
+        shingle_size: int = DEFAULT_SHINGLE_SIZE,
+        seed: int = 1
+    ):
+        if num_perm % bands:
+            raise ValueError("簽章長度必須是分段數的整數倍")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+        # 文件 → 群集（只記錄非代表的文件；代表對應到自己）
+        self._cluster_of: Dict[str, str] = {}
+        self._sizes: Dict[str, int] = {}
+        # 群集代表 → 簽章
+        self._signatures: Dict[str, np.ndarray] = {}
+        # 每個分段：分段值 → 群集代表
+        self._buckets: List[Dict[bytes, str]] = [{} for _ in range(bands)]
+
+    # ============================================
+    # 簽章
+    # ============================================
+
+    def shingles(self, text: str) -> Set[str]:
+        normalized = _FILLERS.sub("", normalize_text(text))
+        k = self.shingle_size
+        if len(normalized) <= k:
+            return {normalized} if normalized else set()
+        return {normalized[i:i + k] for i in range(len(normalized) - k + 1)}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash 簽章（uint32 陣列）；文字正規化後為空時回傳 None"""
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME & _MAX_HASH
+        key = zlib.crc32(polarity_key(normalize_text(text)).encode("utf-8"))
+        return permuted.min(axis=1).astype(np.uint32) ^ np.uint32(key)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        rows = self.rows
+        return [signature[i * rows:(i + 1) * rows].tobytes() for i in range(self.bands)]
+
+    # ============================================
+    # 維護
+    # ============================================
+
+    def add(self, doc_id: str, text: Optional[str] = None, signature: Optional[np.ndarray] = None) -> str:
+        """
+        加入文件，回傳所屬群集ID
+
+        簽章可先在鎖外以 signature() 算好再傳入
+        """
+        if signature is None and text is not None:
+            signature = self.signature(text)
+        if signature is None:
+            return doc_id
+
+        keys = self._band_keys(signature)
+        best, best_score = None, self.threshold
+        checked = set()
+        for band, key in enumerate(keys):
+            candidate = self._buckets[band].get(key)
+            if candidate is None or candidate in checked:
+                continue
+            checked.add(candidate)
+            score = float(np.mean(self._signatures[candidate] == signature))
+            if score >= best_score:
+                best, best_score = candidate, score
+
+        if best is None:
+            self._signatures[doc_id] = signature
+            self._sizes[doc_id] = 1
+            for band, key in enumerate(keys):
+                self._buckets[band].setdefault(key, doc_id)
+            return doc_id
+
+        self._cluster_of[doc_id] = best
+        self._sizes[best] += 1
+        return best
+
+    # ============================================
+    # 查詢
+    # ============================================
+
+    def cluster_of(self, doc_id: str) -> str:
+        """群集ID（未建索引或不屬於其他群集的文件為自己）"""
+        return self._cluster_of.get(doc_id, doc_id)
+
+    def cluster_size(self, cluster_id: str) -> int:
+        return self._sizes.get(cluster_id, 1)
+
+    def is_duplicate(self, doc_id: str) -> bool:
+        """是否為某群集中的非代表文件"""
+        return doc_id in self._cluster_of
+
+    def __len__(self) -> int:
+        return len(self._signatures) + len(self._cluster_of)
+
+    @property
+    def cluster_count(self) -> int:
+        return len(self._signatures)
+
+    def approx_bytes(self) -> int:
+        """估計記憶體用量（簽章 + 分段桶 + 成員對照；字典項目以每筆約 100 位元組估計）"""
+        signatures = len(self._signatures) * (self.num_perm * 4 + 112 + 100)
+        buckets = sum(len(bucket) for bucket in self._buckets) * (self.rows * 4 + 33 + 100)
+        members = len(self._cluster_of) * 100 + len(self._sizes) * 100
+        return signatures + buckets + members
+
+    def largest_clusters(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """文件數最多的群集"""
+        ranked = sorted(self._sizes.items(), key=lambda item: -item[1])[:limit]
+        return [{"cluster_id": cluster_id, "size": size} for cluster_id, size in ranked if size > 1]
+
+    # ============================================
+    # 快照
+    # ============================================
+
+    def _params(self) -> List[Any]:
+        return [self.num_perm, self.bands, self.threshold, self.shingle_size, FEATURES_VERSION]
+
+    def export_state(self) -> Dict[str, Any]:
+        # 群集代表依加入順序排列，還原時重建的桶與原本相同
+        return {
+            "params": self._params(),
+            "signatures": [
+                [doc_id, base64.b64encode(signature.tobytes()).decode("ascii")]
+                for doc_id, signature in self._signatures.items()
+            ],
+            "members": dict(self._cluster_of),
+        }
+
+    def restore_state(self, state: Dict[str, Any]) -> bool:
+        """
+        由快照還原
+
+        Returns:
+            False 表示參數不同（呼叫端應改為重建）
+        """
+        if state.get("params") != self._params():
+            return False
+
+        self._signatures = {}
+        self._buckets = [{} for _ in range(self.bands)]
+        for doc_id, encoded in state.get("signatures", []):
+            signature = np.frombuffer(base64.b64decode(encoded), dtype=np.uint32)
+            self._signatures[doc_id] = signature
+            for band, key in enumerate(self._band_keys(signature)):
+                self._buckets[band].setdefault(key, doc_id)
+
+        self._cluster_of = dict(state.get("members", {}))
+        self._sizes = {doc_id: 1 for doc_id in self._signatures}
+        for cluster_id in self._cluster_of.values():
+            self._sizes[cluster_id] = self._sizes.get(cluster_id, 1) + 1
+        return True
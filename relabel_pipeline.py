@@ -0,0 +1,284 @@
+"""
+AI-CARE Lung - 批次重新標註模組
+==============================
+功能：
+1. 依區塊列出病人訊息的日誌位置（不載入訊息物件）
+2. 以 ProcessPoolExecutor 平行讀取日誌、執行偵測器（意圖 / 情緒 / 緊急程度）並編碼
+3. 批次寫回新版本並標記版本，已是目前版本的訊息自動略過
+
+關鍵字規則或分類器更新後執行，讓既有訊息的預設標註與新版本一致。
+請在 Streamlit 應用停止時執行（同一份對話日誌不可由兩個行程同時寫入，應用執行中會因日誌鎖定直接失敗）：
+
+    python relabel_pipeline.py [--workers 4] [--chunk-size 5000] [--force]
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any, Iterator, Tuple, Callable, Deque
+
+from models import MessageRole, UrgencyLevel
+from keyword_matcher import DetectionResult
+from text_classifier import DETECTION_VERSION, detect, detect_batch
+from segment_log import SegmentReader
+
+# ============================================
+# 設定
+# ============================================
+
+# 每個區塊的訊息數（也是每次寫回的批次大小）
+DEFAULT_CHUNK_SIZE = 5000
+
+# 偵測器：文字 → DetectionResult（須為模組層級函數，才能傳給子行程）
+Detector = Callable[[str], DetectionResult]
+
+# 區塊內容：[(message_id, 分段, 位移), ...]
+Chunk = List[Tuple[str, int, int]]
+
+
+@dataclass
+class RelabelStats:
+    """重新標註統計"""
+    scanned: int = 0        # 檢查的病人訊息數
+    relabeled: int = 0      # 寫回的訊息數
+    changed: int = 0        # 標註有變動的訊息數
+    skipped: int = 0        # 已是目前版本而略過
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """每秒檢查訊息數"""
+        return self.scanned / self.elapsed if self.elapsed > 0 else 0.0
+
+
+@dataclass
+class ChunkResult:
+    """單一區塊的處理結果"""
+    updates: List[Tuple[str, str, bytes]]   # (message_id, session_id, 新版本訊息 JSON)
+    changed: int
+    skipped: int
+    # 病人統計用的標註變動：(patient_id, (舊意圖, 舊情緒), (新意圖, 新情緒))
+    label_changes: List[Tuple[str, Tuple[str, str], Tuple[str, str]]] = field(default_factory=list)
+
+
+# ============================================
+# 子行程工作
+# ============================================
+
+def relabel_record(data: Dict[str, Any], detector: Detector, version: str) -> bool:
+    """
+    重新標註一筆訊息字典（就地修改）
+
+    Returns:
+        預設標註是否有變動
+    """
+    return apply_detection(data, detector(data.get("content", "")), version)
+
+
+def apply_detection(data: Dict[str, Any], detection: DetectionResult, version: str) -> bool:
+    """將偵測結果寫入訊息字典（就地修改），回傳預設標註是否有變動"""
+    new_labels = (detection.intent.value, detection.emotion.value, detection.urgency.value)
+    old_labels = (data.get("detected_intent"), data.get("detected_emotion"), data.get("detected_urgency"))
+
+    data["detected_intent"], data["detected_emotion"], data["detected_urgency"] = new_labels
+    data["needs_human_review"] = bool(data.get("needs_human_review")) or detection.urgency == UrgencyLevel.EMERGENCY
+    data["detection_version"] = version
+    return new_labels != old_labels
+
+
+def relabel_chunk(
+    log_directory: str,
+    chunk: Chunk,
+    version: str,
+    force: bool = False,
+    detector: Detector = detect
+) -> ChunkResult:
+    """
+    讀取、偵測並編碼一個區塊（於子行程中執行）
+
+    直接從日誌讀取原始紀錄，不需要在子行程建立對話儲存
+    """
+    reader = SegmentReader(log_directory)
+    pending = []
+    skipped = 0
+    try:
+        for message_id, segment_no, offset in chunk:
+            data = reader.read_at((segment_no, offset))["d"]
+            if not force and data.get("detection_version") == version:
+                skipped += 1
+                continue
+            pending.append((message_id, data))
+    finally:
+        reader.close()
+
+    # 預設偵測器整個區塊一次預測（分類模型向量化）
+    texts = [data.get("content", "") for _, data in pending]
+    detections = detect_batch(texts) if detector is detect else [detector(text) for text in texts]
+
+    updates = []
+    label_changes = []
+    changed = 0
+    for (message_id, data), detection in zip(pending, detections):
+        old_labels = (data.get("detected_intent"), data.get("detected_emotion"))
+        if apply_detection(data, detection, version):
+            changed += 1
+            new_labels = (data["detected_intent"], data["detected_emotion"])
+            if new_labels != old_labels:
+                label_changes.append((data.get("patient_id", ""), old_labels, new_labels))
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        updates.append((message_id, data.get("session_id", ""), payload))
+    return ChunkResult(updates, changed, skipped, label_changes)
+
+
+# ============================================
+# 串流讀取
+# ============================================
+
+def iter_message_chunks(store, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Chunk]:
+    """依區塊列出病人訊息的日誌位置（不載入訊息物件）"""
+    message_ids = store.indexes.role_message_ids(MessageRole.PATIENT.value)
+
+    chunk: Chunk = []
+    for message_id in message_ids:
+        position = store.messages.location(message_id)
+        if position is None:
+            continue
+        chunk.append((message_id, position[0], position[1]))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+# ============================================
+# 重新標註
+# ============================================
+
+def _relabel_in_memory(store, version: str, detector: Detector, force: bool, stats: RelabelStats):
+    """沒有日誌的儲存器：直接更新訊息物件"""
+    results = []
+    for message_id in store.indexes.role_message_ids(MessageRole.PATIENT.value):
+        message = store.messages.get(message_id)
+        if message is None:
+            continue
+        stats.scanned += 1
+        if not force and message.detection_version == version:
+            stats.skipped += 1
+            continue
+        detection = detector(message.content)
+        results.append((
+            message_id,
+            detection.intent.value,
+            detection.emotion.value,
+            detection.urgency.value,
+            detection.urgency == UrgencyLevel.EMERGENCY
+        ))
+    stats.changed += store.update_detections(results, version)
+    stats.relabeled += len(results)
+
+
+def relabel_messages(
+    store=None,
+    version: str = DETECTION_VERSION,
+    detector: Detector = detect,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    force: bool = False
+) -> RelabelStats:
+    """
+    重新計算並寫回所有病人訊息的預設標註
+
+    子行程負責讀取日誌、偵測與編碼；主行程只附加日誌並更新位置。
+
+    Args:
+        store: ConversationStore（預設為全域實例）
+        version: 寫入的版本標記
+        detector: 偵測函數
+        workers: 行程數；0 表示在目前行程內執行（小量資料或除錯用）
+        chunk_size: 區塊大小
+        force: 連已是目前版本的訊息也重新標註
+    """
+    if store is None:
+        from conversation_store import get_conversation_store
+        store = get_conversation_store()
+
+    stats = RelabelStats()
+    start = time.perf_counter()
+
+    if store.storage is None:
+        _relabel_in_memory(store, version, detector, force, stats)
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+    # 子行程讀取前，確保日誌內容已寫出
+    store.storage.sync()
+    log_directory = store.storage.directory
+
+    def write_back(chunk: Chunk, result: ChunkResult):
+        store.write_message_updates(result.updates, result.label_changes)
+        stats.scanned += len(chunk)
+        stats.relabeled += len(result.updates)
+        stats.changed += result.changed
+        stats.skipped += result.skipped
+
+    chunks = iter_message_chunks(store, chunk_size)
+
+    if workers == 0:
+        for chunk in chunks:
+            write_back(chunk, relabel_chunk(log_directory, chunk, version, force, detector))
+    else:
+        workers = workers or os.cpu_count() or 1
+        # 最多同時送出 2 倍行程數的區塊，讀取與偵測重疊進行但記憶體有上限
+        max_pending = workers * 2
+        pending: Deque[Tuple[Chunk, Future]] = deque()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk in chunks:
+                future = executor.submit(relabel_chunk, log_directory, chunk, version, force, detector)
+                pending.append((chunk, future))
+                if len(pending) >= max_pending:
+                    done_chunk, done = pending.popleft()
+                    write_back(done_chunk, done.result())
+            while pending:
+                done_chunk, done = pending.popleft()
+                write_back(done_chunk, done.result())
+
+    store.checkpoint()
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="重新標註歷史病人訊息")
+    parser.add_argument("--workers", type=int, default=None, help="行程數（0 = 不使用子行程）")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--version", default=DETECTION_VERSION, help="寫入的版本標記")
+    parser.add_argument("--force", action="store_true", help="已是目前版本的訊息也重新標註")
+    args = parser.parse_args()
+
+    stats = relabel_messages(
+        version=args.version,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        force=args.force
+    )
+
+    print(f"檢查 {stats.scanned} 筆，略過 {stats.skipped} 筆")
+    print(f"重新標註 {stats.relabeled} 筆（{stats.changed} 筆有變動）")
+    print(f"耗時 {stats.elapsed:.1f} 秒，{stats.rate:,.0f} 筆/秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+AI-CARE Lung - 研究資料匯出模組
+==============================
+功能：
+1. 分批讀取症狀回報工作表（或本地 CSV 鏡像），不一次載入全部資料
+2. 依工作表結構定義（sheet_schema）以位置解碼每一列
+3. 可選擇將病人ID假名化（HMAC-SHA256）
+4. 串流寫出 gzip 壓縮的 CSV / JSONL
+
+記憶體用量只與批次大小有關，多年份資料也能匯出。
+
+三軍總醫院 數位醫療中心
+"""
+
+import csv
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import secrets
+from datetime import date
+from typing import Dict, List, Optional, Any, Iterable, Iterator
+
+from sheet_schema import REPORTS_SCHEMA
+
+# ============================================
+# 設定
+# ============================================
+
+# 每批讀取的列數
+DEFAULT_BLOCK_SIZE = 1000
+
+# 匯出欄位（與症狀回報工作表結構定義一致）
+REPORT_EXPORT_COLUMNS = REPORTS_SCHEMA.keys
+
+
+# ============================================
+# 資料來源
+# ============================================
+
+def iter_sheet_rows(worksheet, block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[List[str]]:
+    """
+    分批讀取工作表（第一列為標題列）
+
+    每次只向 Google Sheets 要求 block_size 列，讀到工作表的列數（row_count）為止。
+    API 會省略批次尾端的空白列，所以批次不足 block_size 列不代表資料已讀完；
+    工作表沒有 row_count 時才以空白批次判斷結束。
+    """
+    yield worksheet.row_values(1)
+
+    total = getattr(worksheet, "row_count", None)
+    start = 2
+    while total is None or start <= total:
+        end = start + block_size - 1
+        if total is not None:
+            end = min(end, total)
+        block = worksheet.get(f"{start}:{end}")
+        if not block and total is None:
+            break
+        for row in block:
+            yield row
+        start = end + 1
+
+
+def iter_csv_rows(path: str) -> Iterator[List[str]]:
+    """讀取本地 CSV 鏡像（可為 .csv 或 .csv.gz，第一列為標題列）"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8-sig", newline="") as f:
+        for row in csv.reader(f):
+            yield row
+
+
+# ============================================
+# 解碼與假名化
+# ============================================
+
+class Pseudonymizer:
+    """
+    病人ID假名化
+
+    同一把金鑰下，同一病人永遠得到相同代號，可跨檔案串接；
+    沒有金鑰則無法反推原始病歷號。
+    """
+
+    def __init__(self, key: Optional[str] = None, prefix: str = "P"):
+        self.key = (key or secrets.token_hex(16)).encode("utf-8")
+        self.prefix = prefix
+        self._cache: Dict[str, str] = {}
+
+    def __call__(self, patient_id: str) -> str:
+        pseudonym = self._cache.get(patient_id)
+        if pseudonym is None:
+            digest = hmac.new(self.key, patient_id.encode("utf-8"), hashlib.sha256).hexdigest()
+            pseudonym = f"{self.prefix}_{digest[:16]}"
+            self._cache[patient_id] = pseudonym
+        return pseudonym
+
+
+def iter_report_records(
+    rows: Iterable[List[str]],
+    pseudonymizer: Optional[Pseudonymizer] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    將原始列解碼為研究用記錄（第一列必須是標題列）
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if not header:
+        return
+
+    layout = REPORTS_SCHEMA.bind(header)
+    start = start_date.isoformat() if start_date else None
+    end = end_date.isoformat() if end_date else None
+
+    for row in rows:
+        if not any(row):
+            continue
+        record = layout.decode(row)
+
+        report_date = record.get("report_date") or ""
+        if start and report_date < start:
+            continue
+        if end and report_date > end:
+            continue
+
+        if pseudonymizer and record.get("patient_id"):
+            record["patient_id"] = pseudonymizer(record["patient_id"])
+
+        yield record
+
+
+# ============================================
+# 寫出
+# ============================================
+
+def write_jsonl_gz(records: Iterable[Dict[str, Any]], path: str) -> int:
+    """逐筆寫出 gzip JSONL，回傳筆數"""
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def write_csv_gz(records: Iterable[Dict[str, Any]], path: str, fieldnames: Optional[List[str]] = None) -> int:
+    """
+    逐筆寫出 gzip CSV，回傳筆數
+
+    未指定欄位時以第一筆記錄的欄位為準
+    """
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        writer = None
+        for record in records:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=fieldnames or list(record.keys()), extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow(record)
+            count += 1
+        if writer is None and fieldnames:
+            csv.DictWriter(f, fieldnames=fieldnames).writeheader()
+    return count
+
+
+def export_reports(
+    rows: Iterable[List[str]],
+    path: str,
+    fmt: str = "jsonl",
+    pseudonym_key: Optional[str] = None,
+    pseudonymize: bool = False,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> int:
+    """
+    匯出症狀回報
+
+    Args:
+        rows: 原始列（iter_sheet_rows 或 iter_csv_rows 的結果）
+        path: 輸出檔路徑
+        fmt: "jsonl" 或 "csv"
+        pseudonym_key: 假名化金鑰（未提供且 pseudonymize=True 時隨機產生）
+        pseudonymize: 是否假名化病人ID
+
+    Returns:
+        匯出筆數
+    """
+    pseudonymizer = Pseudonymizer(pseudonym_key) if (pseudonymize or pseudonym_key) else None
+    records = iter_report_records(rows, pseudonymizer, start_date, end_date)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    if fmt == "csv":
+        return write_csv_gz(records, path, fieldnames=REPORT_EXPORT_COLUMNS)
+    if fmt == "jsonl":
+        return write_jsonl_gz(records, path)
+    raise ValueError(f"不支援的匯出格式: {fmt}")
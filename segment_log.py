@@ -0,0 +1,357 @@
+"""
+AI-CARE Lung - 附加式分段日誌模組
+================================
+功能：
+1. 只附加（append-only）的 JSONL 紀錄檔，超過大小自動換新分段
+2. 批次 fsync（每 N 筆或每 T 秒），兼顧耐久性與寫入速度
+3. 依 (分段, 位移) 隨機讀取單筆紀錄
+4. 快照檢查點：重啟時載入快照，只重播快照之後的紀錄
+5. 行程間互斥：開啟時對目錄鎖定檔取得獨占鎖，同一目錄已有寫入者時立即失敗
+
+對話資料寫入後即落地，重新部署或 Streamlit 重啟都不會遺失。
+
+三軍總醫院 數位醫療中心
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Any, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+# ============================================
+# 設定
+# ============================================
+
+# 單一分段大小上限
+DEFAULT_MAX_SEGMENT_BYTES = 16 * 1024 * 1024
+
+# fsync 批次：累積筆數或經過秒數任一達到即同步
+DEFAULT_SYNC_EVERY = 64
+DEFAULT_SYNC_INTERVAL = 1.0
+
+_SEGMENT_PREFIX = "segment_"
+_SEGMENT_SUFFIX = ".log"
+_SNAPSHOT_NAME = "snapshot.json.gz"
+_LOCK_NAME = ".lock"
+
+# 紀錄位置：(分段編號, 位移)
+LogPosition = Tuple[int, int]
+
+
+def encode_record(record: Dict[str, Any]) -> bytes:
+    """紀錄 → 日誌行（精簡 JSON + 換行）"""
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class LogLockedError(RuntimeError):
+    """日誌目錄已由其他寫入者開啟"""
+    pass
+
+
+def _segment_path(directory: str, segment_no: int) -> str:
+    return os.path.join(directory, f"{_SEGMENT_PREFIX}{segment_no:06d}{_SEGMENT_SUFFIX}")
+
+
+class SegmentReader:
+    """
+    唯讀的日誌讀取器
+
+    不開啟寫入檔，可在其他行程（例如批次工作）中安全地隨機讀取。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._files: Dict[int, Any] = {}
+
+    def read_at(self, position: LogPosition) -> Dict[str, Any]:
+        segment_no, offset = position
+        f = self._files.get(segment_no)
+        if f is None:
+            f = open(_segment_path(self.directory, segment_no), "rb")
+            self._files[segment_no] = f
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+class SegmentLog:
+    """
+    分段日誌
+
+    每筆紀錄為一行精簡 JSON。位置以 (分段編號, 位元組位移) 表示，
+    可用於之後的隨機讀取。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_segment_bytes: int = DEFAULT_MAX_SEGMENT_BYTES,
+        sync_every: int = DEFAULT_SYNC_EVERY,
+        sync_interval: float = DEFAULT_SYNC_INTERVAL
+    ):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = self._acquire_directory_lock()
+
+        self._lock = threading.RLock()
+        self._reader = SegmentReader(directory)
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
+
+        segments = self.segments()
+        self._segment_no = segments[-1] if segments else 1
+        self._writer = None
+        self._open_writer()
+
+    # ============================================
+    # 分段檔案
+    # ============================================
+
+    def _segment_path(self, segment_no: int) -> str:
+        return _segment_path(self.directory, segment_no)
+
+    def _acquire_directory_lock(self):
+        """
+        取得目錄獨占鎖（不等待）
+
+        兩個寫入者同時附加時，其中一方的檢查點位置會越過另一方的紀錄，
+        那些紀錄之後永遠不會被重播；因此第二個寫入者必須直接失敗。
+        行程結束時作業系統會自動釋放鎖。
+        """
+        lock_file = open(os.path.join(self.directory, _LOCK_NAME), "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            raise LogLockedError(
+                f"對話日誌 {self.directory} 正由其他行程使用（例如 Streamlit 應用），請先停止該行程再執行"
+            ) from None
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()).encode("ascii"))
+        lock_file.flush()
+        return lock_file
+
+    def segments(self) -> List[int]:
+        """現有分段編號（由小到大）"""
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(numbers)
+
+    def total_bytes(self) -> int:
+        """所有分段檔案的大小"""
+        return sum(os.path.getsize(self._segment_path(n)) for n in self.segments())
+
+    def _open_writer(self):
+        path = self._segment_path(self._segment_no)
+        self._writer = open(path, "ab")
+        self._truncate_partial_tail(path)
+
+    def _truncate_partial_tail(self, path: str):
+        """移除上次異常中斷留下的不完整最後一行"""
+        size = self._writer.tell()
+        if size == 0:
+            return
+        with open(path, "rb") as f:
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            data = f.read()
+        self._writer.truncate(data.rfind(b"\n") + 1)
+        self._writer.seek(0, os.SEEK_END)
+
+    def _rotate(self):
+        """目前分段已滿，換新分段"""
+        self._sync_locked()
+        self._writer.close()
+        self._segment_no += 1
+        self._open_writer()
+
+    # ============================================
+    # 寫入
+    # ============================================
+
+    def append(self, record: Dict[str, Any]) -> LogPosition:
+        """附加一筆紀錄，回傳其位置"""
+        line = encode_record(record)
+
+        with self._lock:
+            if self._writer.tell() >= self.max_segment_bytes:
+                self._rotate()
+
+            position = (self._segment_no, self._writer.tell())
+            self._writer.write(line)
+            self._writer.flush()
+
+            self._pending_sync += 1
+            if (self._pending_sync >= self.sync_every
+                    or time.monotonic() - self._last_sync >= self.sync_interval):
+                self._sync_locked()
+
+            return position
+
+    def append_many(self, records: List[Dict[str, Any]]) -> List[LogPosition]:
+        """批次附加多筆紀錄，回傳各筆位置"""
+        return self.append_encoded([encode_record(record) for record in records])
+
+    def append_encoded(self, lines: List[bytes]) -> List[LogPosition]:
+        """
+        批次附加已編碼的日誌行（一次 flush / fsync 判斷）
+
+        lines 須由 encode_record 產生；編碼可在其他行程先完成
+        """
+        with self._lock:
+            positions = []
+            for line in lines:
+                if self._writer.tell() >= self.max_segment_bytes:
+                    self._rotate()
+                positions.append((self._segment_no, self._writer.tell()))
+                self._writer.write(line)
+            self._writer.flush()
+
+            self._pending_sync += len(lines)
+            if (self._pending_sync >= self.sync_every
+                    or time.monotonic() - self._last_sync >= self.sync_interval):
+                self._sync_locked()
+
+            return positions
+
+    def _sync_locked(self):
+        if self._pending_sync:
+            os.fsync(self._writer.fileno())
+            self._pending_sync = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        """立即 fsync"""
+        with self._lock:
+            self._writer.flush()
+            self._sync_locked()
+
+    @property
+    def position(self) -> LogPosition:
+        """下一筆紀錄的位置（即目前結尾）"""
+        with self._lock:
+            return (self._segment_no, self._writer.tell())
+
+    # ============================================
+    # 讀取
+    # ============================================
+
+    def read_at(self, position: LogPosition) -> Dict[str, Any]:
+        """讀取指定位置的紀錄"""
+        with self._lock:
+            return self._reader.read_at(position)
+
+    def replay(self, start: LogPosition = (0, 0)) -> Iterator[Tuple[LogPosition, Dict[str, Any]]]:
+        """
+        依序讀取 start 之後的所有紀錄
+
+        Yields:
+            (位置, 紀錄)
+        """
+        start_segment, start_offset = start
+        for segment_no in self.segments():
+            if segment_no < start_segment:
+                continue
+            with open(self._segment_path(segment_no), "rb") as f:
+                offset = start_offset if segment_no == start_segment else 0
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 不完整的最後一行
+                    yield (segment_no, offset), json.loads(line)
+                    offset += len(line)
+
+    # ============================================
+    # 快照
+    # ============================================
+
+    def write_snapshot(self, state: Dict[str, Any], position: Optional[LogPosition] = None):
+        """
+        寫入快照檢查點（原子替換）
+
+        Args:
+            state: 可 JSON 序列化的狀態
+            position: 快照涵蓋到的日誌位置（預設為目前結尾）
+        """
+        if position is None:
+            self.sync()
+            position = self.position
+
+        payload = {"position": list(position), "state": state, "created_at": time.time()}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".snapshot_")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=5) as f:
+                    f.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_path, os.path.join(self.directory, _SNAPSHOT_NAME))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load_snapshot(self) -> Tuple[Optional[Dict[str, Any]], LogPosition]:
+        """
+        載入快照
+
+        Returns:
+            (狀態, 快照位置)；沒有快照時為 (None, (0, 0))
+        """
+        path = os.path.join(self.directory, _SNAPSHOT_NAME)
+        if not os.path.exists(path):
+            return None, (0, 0)
+        try:
+            with gzip.open(path, "rb") as f:
+                payload = json.loads(f.read())
+        except (OSError, ValueError):
+            # 快照損毀時從頭重播
+            return None, (0, 0)
+        return payload["state"], tuple(payload["position"])
+
+    # ============================================
+    # 關閉
+    # ============================================
+
+    def close(self):
+        with self._lock:
+            if self._writer:
+                self._writer.flush()
+                self._sync_locked()
+                self._writer.close()
+                self._writer = None
+            self._reader.close()
+            if self._lock_file is not None:
+                # 關閉檔案即釋放鎖
+                self._lock_file.close()
+                self._lock_file = None
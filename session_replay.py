@@ -0,0 +1,446 @@
+"""
+AI-CARE Lung - 會話重播模組
+==========================
+功能：
+1. 讀取已儲存的 ConversationSession，依序把病人輸入送回 app.py 的
+   handle_text_input / handle_score_selection（真正的對話邏輯，不另寫一份）
+2. 無頭執行：重播期間 app 模組的 st 換成只有 session_state / rerun 的替身，
+   記錄函數換成收集器，不會寫入對話日誌
+3. 每一步計時，並將產生的 AI 回應與當時記錄的回應逐則比對（相同 / 範本變體 / 不同，附 diff）
+4. 可對大量真實會話批次重播，作為對話邏輯的回歸測試與效能量測
+
+需安裝 Streamlit（匯入 app.py 用），但不需要啟動伺服器：
+
+    python session_replay.py --session <session_id> --diff
+    python session_replay.py --limit 1000 --output replay.jsonl
+    python benchmarks.py replay --sessions 1000
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import difflib
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any, Iterable, Iterator
+
+from models import MessageRole, ConversationSession, ConversationMessage
+
+# ============================================
+# 設定
+# ============================================
+
+# 每則不同回應最多保留的 diff 行數
+MAX_DIFF_LINES = 40
+
+# 比對結果
+STATUS_MATCH = "match"        # 內容完全相同
+STATUS_VARIANT = "variant"    # 同一專家範本、抽到不同變體
+STATUS_MISMATCH = "mismatch"  # 內容不同
+STATUS_SKIPPED = "skipped"    # 無法重播（例如按鈕輸入無法解析分數）
+
+_BUTTON_SCORE = re.compile(r"^\s*(\d+)")
+
+
+# ============================================
+# 無頭執行環境
+# ============================================
+
+class _HeadlessSessionState(dict):
+    """st.session_state 替身（屬性與鍵兩種存取方式）"""
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name: str, value: Any):
+        self[name] = value
+
+    def __delattr__(self, name: str):
+        del self[name]
+
+
+class _RerunRequested(Exception):
+    """st.rerun()：與 Streamlit 相同，中止目前這一步"""
+
+
+class _HeadlessStreamlit:
+    """
+    重播用的 st 替身
+
+    只實作對話處理函數用到的 session_state 與 rerun；
+    其他顯示函數一律不輸出（重播不需要畫面）。
+    """
+
+    def __init__(self):
+        self.session_state = _HeadlessSessionState()
+
+    def rerun(self):
+        raise _RerunRequested()
+
+    def __getattr__(self, name: str) -> Any:
+        return lambda *args, **kwargs: None
+
+
+class _MessageRecorder:
+    """取代 log_patient_input / log_ai_response：收集產生的訊息，不寫入儲存"""
+
+    def __init__(self):
+        self.patient_messages: List[Dict[str, Any]] = []
+        self.ai_messages: List[Dict[str, Any]] = []
+
+    def log_patient_input(self, patient_id: str, content: str, input_method: str = "text",
+                          raw_input: Optional[str] = None, session_id: Optional[str] = None):
+        self.patient_messages.append({"content": content, "input_method": input_method})
+
+    def log_ai_response(self, patient_id: str, content: str, source=None,
+                        template_id: Optional[str] = None, session_id: Optional[str] = None):
+        self.ai_messages.append({
+            "content": content,
+            "source": source.value if source is not None else None,
+            "template_id": template_id,
+        })
+
+
+# app 模組層級的替換不可重疊
+_headless_lock = threading.Lock()
+
+
+@contextmanager
+def headless_app():
+    """
+    暫時替換 app 模組的 st 與記錄函數
+
+    Yields:
+        (app 模組, _HeadlessStreamlit, _MessageRecorder)
+    """
+    import app
+
+    with _headless_lock:
+        fake_st, recorder = _HeadlessStreamlit(), _MessageRecorder()
+        originals = (app.st, app.log_patient_input, app.log_ai_response)
+        app.st = fake_st
+        app.log_patient_input = recorder.log_patient_input
+        app.log_ai_response = recorder.log_ai_response
+        try:
+            yield app, fake_st, recorder
+        finally:
+            app.st, app.log_patient_input, app.log_ai_response = originals
+
+
+# ============================================
+# 重播結果
+# ============================================
+
+@dataclass
+class ReplayStep:
+    """一則病人輸入的重播結果"""
+    message_id: str
+    input_method: Optional[str]
+    content: str
+    symptom_id: Optional[str]
+    elapsed: float = 0.0
+    status: str = STATUS_MATCH
+    recorded: List[str] = field(default_factory=list)
+    generated: List[str] = field(default_factory=list)
+    diff: str = ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "message_id": self.message_id,
+            "input_method": self.input_method,
+            "content": self.content,
+            "symptom_id": self.symptom_id,
+            "elapsed_ms": round(self.elapsed * 1000, 3),
+            "status": self.status,
+            "diff": self.diff,
+        }
+
+
+@dataclass
+class ReplayResult:
+    """單一會話的重播結果"""
+    session_id: str
+    patient_id: str
+    steps: List[ReplayStep] = field(default_factory=list)
+    prelude_messages: int = 0    # 第一則病人輸入前的 AI 訊息（歡迎詞、第一題，不重播）
+    unreplayed_inputs: int = 0   # 症狀評分結束後的輸入（開放式問題，不經過處理函數）
+    error: Optional[str] = None
+
+    def count(self, status: str) -> int:
+        return sum(1 for step in self.steps if step.status == status)
+
+    @property
+    def elapsed(self) -> float:
+        return sum(step.elapsed for step in self.steps)
+
+    @property
+    def passed(self) -> bool:
+        return self.error is None and self.count(STATUS_MISMATCH) == 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "patient_id": self.patient_id,
+            "passed": self.passed,
+            "steps": len(self.steps),
+            "matched": self.count(STATUS_MATCH),
+            "variants": self.count(STATUS_VARIANT),
+            "mismatched": self.count(STATUS_MISMATCH),
+            "skipped": self.count(STATUS_SKIPPED),
+            "prelude_messages": self.prelude_messages,
+            "unreplayed_inputs": self.unreplayed_inputs,
+            "elapsed_ms": round(self.elapsed * 1000, 3),
+            "error": self.error,
+            "details": [step.to_dict() for step in self.steps if step.status != STATUS_MATCH],
+        }
+
+
+@dataclass
+class ReplaySummary:
+    """批次重播統計"""
+    sessions: int = 0
+    passed: int = 0
+    errors: int = 0
+    steps: int = 0
+    statuses: Dict[str, int] = field(default_factory=dict)
+    step_times: List[float] = field(default_factory=list)
+    wall_time: float = 0.0
+
+    def add(self, result: ReplayResult):
+        self.sessions += 1
+        self.passed += result.passed
+        self.errors += result.error is not None
+        self.steps += len(result.steps)
+        for step in result.steps:
+            self.statuses[step.status] = self.statuses.get(step.status, 0) + 1
+            self.step_times.append(step.elapsed)
+
+    def percentile(self, q: float) -> float:
+        """步驟耗時百分位數（秒）"""
+        if not self.step_times:
+            return 0.0
+        ordered = sorted(self.step_times)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def format(self) -> str:
+        statuses = "，".join(f"{status} {count:,}" for status, count in sorted(self.statuses.items()))
+        return (
+            f"會話 {self.sessions:,}（通過 {self.passed:,}，錯誤 {self.errors:,}），步驟 {self.steps:,}（{statuses}）\n"
+            f"步驟耗時 p50 {self.percentile(50) * 1000:.3f} ms，p95 {self.percentile(95) * 1000:.3f} ms，"
+            f"最大 {max(self.step_times, default=0) * 1000:.3f} ms；總耗時 {self.wall_time:.1f} 秒"
+        )
+
+
+# ============================================
+# 重播
+# ============================================
+
+def _compare(step: ReplayStep, recorded: List[ConversationMessage], generated: List[Dict[str, Any]]):
+    step.recorded = [message.content for message in recorded]
+    step.generated = [message["content"] for message in generated]
+    if step.recorded == step.generated:
+        step.status = STATUS_MATCH
+        return
+
+    variant = len(recorded) == len(generated)
+    for old, new in zip(recorded, generated):
+        if old.content != new["content"] and (old.template_id is None or old.template_id != new["template_id"]):
+            variant = False
+    step.status = STATUS_VARIANT if variant else STATUS_MISMATCH
+
+    diff = difflib.unified_diff(
+        "\n\n".join(step.recorded).splitlines(), "\n\n".join(step.generated).splitlines(),
+        "recorded", "generated", lineterm="", n=1
+    )
+    step.diff = "\n".join(list(diff)[:MAX_DIFF_LINES])
+
+
+def replay_session(
+    session: ConversationSession,
+    messages: List[ConversationMessage],
+    seed: Optional[int] = 0
+) -> ReplayResult:
+    """
+    重播單一會話
+
+    Args:
+        session: 要重播的會話
+        messages: 會話訊息（依時間順序，get_session_messages 的結果）
+        seed: 專家範本變體抽選的亂數種子（None 表示不固定）
+    """
+    result = ReplayResult(session.session_id, session.patient_id)
+
+    # 依病人輸入切分：每則輸入 → 直到下一則輸入前的 AI 回應
+    turns: List[List[Any]] = []
+    for message in messages:
+        if message.role == MessageRole.PATIENT:
+            turns.append([message, []])
+        elif turns:
+            turns[-1][1].append(message)
+        else:
+            result.prelude_messages += 1
+
+    if seed is not None:
+        random.seed(seed)
+
+    with headless_app() as (app, fake_st, recorder):
+        state = fake_st.session_state
+        app.init_session_state()
+        state.logged_in = True
+        state.current_page = "ai_chat"
+        state.patient = {"id": session.patient_id, "name": "", "post_op_day": 0}
+        state.conversation_session_id = session.session_id
+
+        for position, (message, recorded) in enumerate(turns):
+            index = state.current_symptom_index
+            if index >= len(app.SYMPTOMS):
+                result.unreplayed_inputs = len(turns) - position
+                break
+
+            symptom = app.SYMPTOMS[index]
+            step = ReplayStep(message.message_id, message.input_method, message.content, symptom["id"])
+            result.steps.append(step)
+
+            if message.input_method == "button":
+                matched = _BUTTON_SCORE.match(message.content)
+                if matched is None or int(matched.group(1)) > 10:
+                    step.status = STATUS_SKIPPED
+                    continue
+                handler, handler_args = app.handle_score_selection, (int(matched.group(1)), "button")
+            else:
+                handler, handler_args = app.handle_text_input, (message.raw_input or message.content, symptom)
+
+            generated_from = len(recorder.ai_messages)
+            start = time.perf_counter()
+            try:
+                handler(*handler_args)
+            except _RerunRequested:
+                pass
+            except Exception as e:
+                step.elapsed = time.perf_counter() - start
+                step.status = STATUS_MISMATCH
+                result.error = f"{message.message_id}: {type(e).__name__}: {e}"
+                break
+            step.elapsed = time.perf_counter() - start
+
+            _compare(step, recorded, recorder.ai_messages[generated_from:])
+
+    return result
+
+
+def iter_session_ids(store, patient_id: Optional[str] = None, completed_only: bool = False) -> Iterator[str]:
+    """儲存中的會話 ID（可依病人篩選）"""
+    if patient_id is not None:
+        session_ids = store.get_patient_session_ids(patient_id)
+    else:
+        session_ids = store.sessions.keys()
+    for session_id in session_ids:
+        if completed_only:
+            session = store.sessions.get(session_id)
+            if session is None or not session.is_completed:
+                continue
+        yield session_id
+
+
+def replay_sessions(
+    session_ids: Iterable[str],
+    store=None,
+    seed: Optional[int] = 0
+) -> Iterator[ReplayResult]:
+    """依序重播多個會話（找不到的會話略過）"""
+    if store is None:
+        from conversation_store import get_conversation_store
+        store = get_conversation_store()
+
+    for session_id in session_ids:
+        session = store.sessions.get(session_id)
+        if session is None:
+            continue
+        yield replay_session(session, store.get_session_messages(session_id), seed=seed)
+
+
+def run_replay(
+    session_ids: Iterable[str],
+    store=None,
+    seed: Optional[int] = 0,
+    output: Optional[str] = None,
+    on_result=None
+) -> ReplaySummary:
+    """
+    批次重播並統計
+
+    Args:
+        output: 每個會話一行 JSON 的結果檔
+        on_result: 每個會話完成後呼叫（進度顯示、印出 diff 等）
+    """
+    summary = ReplaySummary()
+    out = open(output, "w", encoding="utf-8") if output else None
+    start = time.perf_counter()
+    try:
+        for result in replay_sessions(session_ids, store, seed):
+            summary.add(result)
+            if out is not None:
+                out.write(json.dumps(result.to_dict(), ensure_ascii=False) + "\n")
+            if on_result is not None:
+                on_result(result)
+    finally:
+        if out is not None:
+            out.close()
+    summary.wall_time = time.perf_counter() - start
+    return summary
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="重播已儲存的對話會話並比對回應")
+    parser.add_argument("--session", action="append", default=[], help="會話 ID（可重複）")
+    parser.add_argument("--patient", help="只重播此病人的會話")
+    parser.add_argument("--limit", type=int, help="最多重播的會話數")
+    parser.add_argument("--completed-only", action="store_true", help="只重播已完成的會話")
+    parser.add_argument("--seed", type=int, default=0, help="專家範本變體的亂數種子")
+    parser.add_argument("--output", help="輸出每個會話結果的 JSONL")
+    parser.add_argument("--diff", action="store_true", help="印出不同回應的 diff")
+    args = parser.parse_args()
+
+    from conversation_store import get_conversation_store
+    conversation_store = get_conversation_store()
+
+    if args.session:
+        session_ids: Iterable[str] = args.session
+    else:
+        session_ids = iter_session_ids(conversation_store, args.patient, args.completed_only)
+    if args.limit is not None:
+        session_ids = list(session_ids)[:args.limit]
+
+    def report(result: ReplayResult):
+        if result.passed and not args.diff:
+            return
+        print(
+            f"{'✅' if result.passed else '❌'} {result.session_id}  步驟 {len(result.steps)}，"
+            f"不同 {result.count(STATUS_MISMATCH)}，變體 {result.count(STATUS_VARIANT)}，"
+            f"{result.elapsed * 1000:.2f} ms"
+        )
+        if result.error:
+            print(f"   錯誤：{result.error}")
+        if args.diff:
+            for step in result.steps:
+                if step.diff:
+                    print(f"   [{step.status}] {step.content!r}\n{step.diff}")
+
+    summary = run_replay(session_ids, conversation_store, args.seed, args.output, report)
+    print(summary.format())
+
+
+if __name__ == "__main__":
+    main()
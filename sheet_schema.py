@@ -0,0 +1,374 @@
+"""
+AI-CARE Lung - 工作表結構定義模組
+================================
+功能：
+1. 每張工作表一份宣告式欄位定義（單一來源）
+2. 依實際標題列產生位置式編碼器 / 解碼器
+3. 標題列驗證（缺少必要欄位、重複標題）
+4. 結構遷移（補上新欄位）
+5. 寫入前重新核對標題列，欄位被搬動時立即改用新位置
+
+欄位位置一律由工作表標題列決定，手動搬動欄位不會讓登入等功能讀錯資料。
+
+三軍總醫院 數位醫療中心
+"""
+
+import time
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Dict, List, Optional, Any, Tuple, Callable
+
+
+class SchemaError(Exception):
+    """工作表結構不符"""
+    pass
+
+
+# ============================================
+# 欄位型別轉換
+# ============================================
+
+def _decode_str(value: Any) -> Any:
+    return "" if value is None else value
+
+
+# 數值欄位：空白或無法解析時回傳 None（「未填」與 0 分不同），需要預設值的欄位以 Column.default 指定
+
+def _decode_int(value: Any) -> Any:
+    if value == "" or value is None:
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _decode_float(value: Any) -> Any:
+    if value == "" or value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+_DECODERS: Dict[str, Callable[[Any], Any]] = {
+    "str": _decode_str,
+    "int": _decode_int,
+    "float": _decode_float,
+}
+
+
+# ============================================
+# 結構定義
+# ============================================
+
+@dataclass(frozen=True)
+class Column:
+    """欄位定義"""
+    key: str                    # 程式內使用的欄位名稱
+    title: str                  # 工作表標題
+    kind: str = "str"           # str, int, float
+    required: bool = False      # 標題列缺少時視為錯誤（不自動補欄位）
+    default: Any = None         # 數值欄位空白時的值（None 表示保留為未填）
+
+    def decoder(self) -> Callable[[Any], Any]:
+        decode = _DECODERS[self.kind]
+        if self.default is None:
+            return decode
+        default = self.default
+        return lambda value: default if (decoded := decode(value)) is None else decoded
+
+
+class SheetSchema:
+    """工作表結構"""
+
+    def __init__(self, name: str, columns: List[Column], rows: int = 1000, cols: int = 20):
+        self.name = name
+        self.columns = columns
+        self.rows = rows
+        self.cols = max(cols, len(columns))
+
+        self.keys = [c.key for c in columns]
+        self.header = [c.title for c in columns]
+        self._by_key = {c.key: c for c in columns}
+
+        if len(set(self.keys)) != len(self.keys) or len(set(self.header)) != len(self.header):
+            raise SchemaError(f"{name}：欄位名稱重複")
+
+    def column(self, key: str) -> Column:
+        return self._by_key[key]
+
+    def bind(self, header: List[str]) -> "SheetLayout":
+        """依實際標題列建立版面"""
+        return SheetLayout(self, header)
+
+    @property
+    def default_layout(self) -> "SheetLayout":
+        """依定義順序的版面（新建工作表時使用）"""
+        return SheetLayout(self, self.header)
+
+
+class SheetLayout:
+    """
+    工作表版面 - 結構定義與實際標題列的對應
+
+    建立時只做一次標題查找，之後編碼 / 解碼都是位置式存取。
+    """
+
+    def __init__(self, schema: SheetSchema, header: List[str]):
+        self.schema = schema
+        self.header = list(header)
+
+        titles = [t for t in self.header if t]
+        if len(set(titles)) != len(titles):
+            raise SchemaError(f"{schema.name}：標題列有重複欄位")
+
+        title_positions = {title: i for i, title in enumerate(self.header) if title}
+
+        self.positions: Dict[str, int] = {}
+        self.missing: List[str] = []
+        for column in schema.columns:
+            if column.title in title_positions:
+                self.positions[column.key] = title_positions[column.title]
+            else:
+                self.missing.append(column.key)
+
+        missing_required = [k for k in self.missing if schema.column(k).required]
+        if missing_required:
+            titles = "、".join(schema.column(k).title for k in missing_required)
+            raise SchemaError(f"{schema.name}：缺少必要欄位 {titles}")
+
+        self.width = len(self.header)
+        self._compile()
+
+    def _compile(self):
+        """產生位置式編碼器 / 解碼器"""
+        present = [c for c in self.schema.columns if c.key in self.positions]
+
+        self._decode_keys = [c.key for c in present]
+        self._decode_casts = [c.decoder() for c in present]
+        self._missing_defaults = {k: self.schema.column(k).decoder()("") for k in self.missing}
+
+        positions = [self.positions[c.key] for c in present]
+        if len(positions) == 1:
+            getter = itemgetter(positions[0])
+            self._getter = lambda row: (getter(row),)
+        elif positions:
+            self._getter = itemgetter(*positions)
+        else:
+            self._getter = lambda row: ()
+
+        # 編碼：寫入列的寬度涵蓋所有已知欄位
+        self._encode_width = max(positions, default=-1) + 1
+        self._encode_slots = [(c.key, self.positions[c.key]) for c in present]
+
+    # ============================================
+    # 位置
+    # ============================================
+
+    def index(self, key: str) -> int:
+        """0-based 欄位位置"""
+        if key not in self.positions:
+            raise SchemaError(f"{self.schema.name}：工作表缺少欄位 {self.schema.column(key).title}")
+        return self.positions[key]
+
+    def column(self, key: str) -> int:
+        """1-based 欄位編號（gspread update_cell / find 使用）"""
+        return self.index(key) + 1
+
+    # ============================================
+    # 編碼 / 解碼
+    # ============================================
+
+    def decode(self, row: List[Any]) -> Dict[str, Any]:
+        """工作表列 → 欄位字典"""
+        if len(row) < self.width:
+            row = list(row) + [""] * (self.width - len(row))
+        record = {
+            key: cast(value)
+            for key, cast, value in zip(self._decode_keys, self._decode_casts, self._getter(row))
+        }
+        if self._missing_defaults:
+            record.update(self._missing_defaults)
+        return record
+
+    def decode_rows(self, rows: List[List[Any]]) -> List[Dict[str, Any]]:
+        return [self.decode(row) for row in rows]
+
+    def encode(self, record: Dict[str, Any]) -> List[Any]:
+        """欄位字典 → 工作表列（依實際欄位順序）"""
+        row: List[Any] = [""] * self._encode_width
+        for key, position in self._encode_slots:
+            value = record.get(key)
+            row[position] = "" if value is None else value
+        return row
+
+
+# ============================================
+# 遷移
+# ============================================
+
+def migrate_worksheet(worksheet, schema: SheetSchema) -> SheetLayout:
+    """
+    檢查並遷移工作表標題列
+
+    缺少的非必要欄位補在最右側
+    """
+    header = worksheet.row_values(1)
+    if not any(header):
+        worksheet.update("A1", [schema.header])
+        return schema.default_layout
+
+    layout = schema.bind(header)
+    new_header = list(layout.header)
+
+    for key in layout.missing:
+        new_header.append(schema.column(key).title)
+
+    if new_header != layout.header:
+        if len(new_header) > worksheet.col_count:
+            worksheet.add_cols(len(new_header) - worksheet.col_count)
+        worksheet.update("A1", [new_header])
+        layout = schema.bind(new_header)
+
+    return layout
+
+
+class LayoutCache:
+    """
+    工作表版面快取
+
+    讀取時標題列每 ttl 秒重新讀取一次；寫入前一律以 for_write() 核對目前標題列，
+    有人搬動欄位時立即重新對應，不會把資料寫進錯誤的欄位（例如覆蓋密碼雜湊）
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._layouts: Dict[Tuple[str, str], Tuple[float, SheetLayout]] = {}
+
+    @staticmethod
+    def _key(worksheet, schema: SheetSchema) -> Tuple[str, str]:
+        return (str(getattr(worksheet, "id", worksheet.title)), schema.name)
+
+    def get(self, worksheet, schema: SheetSchema) -> SheetLayout:
+        key = self._key(worksheet, schema)
+        cached = self._layouts.get(key)
+        now = time.monotonic()
+        if cached and now - cached[0] < self.ttl:
+            return cached[1]
+
+        layout = schema.bind(worksheet.row_values(1))
+        self._layouts[key] = (now, layout)
+        return layout
+
+    def for_write(self, worksheet, schema: SheetSchema) -> SheetLayout:
+        """
+        寫入用版面：讀取目前標題列，與快取不同時重新對應並更新快取
+
+        每次寫入多一次標題列讀取，換來位置式寫入不會寫錯欄
+        """
+        key = self._key(worksheet, schema)
+        header = worksheet.row_values(1)
+        cached = self._layouts.get(key)
+        if cached and cached[1].header == header:
+            return cached[1]
+
+        layout = schema.bind(header)
+        self._layouts[key] = (time.monotonic(), layout)
+        return layout
+
+    def invalidate(self):
+        self._layouts.clear()
+
+
+# ============================================
+# 各工作表定義
+# ============================================
+
+PATIENTS_SCHEMA = SheetSchema("病人資料", [
+    Column("patient_id", "病人ID", required=True),
+    Column("name", "姓名"),
+    Column("gender", "性別"),
+    Column("age", "年齡", "int", default=0),
+    Column("birthday", "生日"),
+    Column("phone", "手機號碼"),
+    Column("surgery_date", "手術日期"),
+    Column("surgery_type", "手術類型"),
+    Column("cancer_stage", "癌症分期"),
+    Column("password_hash", "密碼雜湊", required=True),
+    Column("registered_at", "註冊時間"),
+    Column("last_login", "最後登入"),
+    Column("status", "狀態"),
+], rows=1000, cols=20)
+
+REPORTS_SCHEMA = SheetSchema("症狀回報", [
+    Column("report_id", "回報ID", required=True),
+    Column("patient_id", "病人ID", required=True),
+    Column("report_date", "回報日期", required=True),
+    Column("report_time", "回報時間"),
+    Column("method", "回報方式"),
+    Column("pain", "疼痛分數", "int"),
+    Column("fatigue", "疲勞分數", "int"),
+    Column("dyspnea", "呼吸困難分數", "int"),
+    Column("cough", "咳嗽分數", "int"),
+    Column("sleep", "睡眠分數", "int"),
+    Column("appetite", "食慾分數", "int"),
+    Column("mood", "心情分數", "int"),
+    Column("pain_description", "疼痛描述"),
+    Column("fatigue_description", "疲勞描述"),
+    Column("dyspnea_description", "呼吸困難描述"),
+    Column("cough_description", "咳嗽描述"),
+    Column("sleep_description", "睡眠描述"),
+    Column("appetite_description", "食慾描述"),
+    Column("mood_description", "心情描述"),
+    Column("open_ended_1", "開放式回答1"),
+    Column("open_ended_2", "開放式回答2"),
+    Column("additional_notes", "額外備註"),
+    Column("avg_score", "平均分數", "float"),
+    Column("max_symptom", "最高分數項目"),
+    Column("created_at", "建立時間"),
+], rows=10000, cols=30)
+
+CONVERSATIONS_SCHEMA = SheetSchema("對話記錄", [
+    Column("message_id", "訊息ID", required=True),
+    Column("session_id", "會話ID"),
+    Column("patient_id", "病人ID", required=True),
+    Column("role", "角色"),
+    Column("content", "內容"),
+    Column("source", "訊息來源"),
+    Column("input_method", "輸入方式"),
+    Column("template_id", "範本ID"),
+    Column("intent", "偵測意圖"),
+    Column("emotion", "偵測情緒"),
+    Column("timestamp", "時間戳記"),
+    Column("content_hash", "內容雜湊"),  # 長內容存於本地內容儲存（blob_store）
+], rows=50000, cols=15)
+
+ACHIEVEMENTS_SCHEMA = SheetSchema("成就記錄", [
+    Column("record_id", "記錄ID", required=True),
+    Column("patient_id", "病人ID", required=True),
+    Column("achievement_id", "成就ID", required=True),
+    Column("achievement_name", "成就名稱"),
+    Column("unlock_date", "解鎖日期"),
+    Column("points", "獲得積分", "int", default=0),
+], rows=5000, cols=10)
+
+ALERTS_SCHEMA = SheetSchema("異常警示", [
+    Column("alert_id", "警示ID", required=True),
+    Column("patient_id", "病人ID", required=True),
+    Column("report_id", "回報ID"),
+    Column("symptom", "症狀"),
+    Column("score", "分數", "float"),
+    Column("baseline_mean", "基準平均", "float"),
+    Column("baseline_std", "基準標準差", "float"),
+    Column("z_score", "Z分數", "float"),
+    Column("observations", "基準回報次數", "int"),
+    Column("created_at", "建立時間"),
+    Column("status", "處理狀態"),            # open, acknowledged, closed（個管師更新）
+], rows=5000, cols=15)
+
+# 症狀分數欄位（依 SymptomType 順序）
+SCORE_KEYS = ["pain", "fatigue", "dyspnea", "cough", "sleep", "appetite", "mood"]
+
+ALL_SCHEMAS = [PATIENTS_SCHEMA, REPORTS_SCHEMA, CONVERSATIONS_SCHEMA, ACHIEVEMENTS_SCHEMA, ALERTS_SCHEMA]
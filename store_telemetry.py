@@ -0,0 +1,496 @@
+"""
+AI-CARE Lung - 對話儲存遙測模組
+==============================
+功能：
+1. 定期收集對話儲存的筆數（訊息 / 會話 / 開放式回應 / 病人）、快取與移出狀態、寫入速率
+2. 估計記憶體用量：隨機抽樣快取物件以 sys.getsizeof 遞迴加總後外推，
+   索引依結構估算；有啟用 tracemalloc 時一併記錄實際配置量，另讀取行程 RSS
+3. 匯出指標：JSONL（每次收集一行）與 Prometheus 文字格式
+4. 門檻警報：超過設定值時觸發一次（回到門檻以下後才會再觸發），並保留最近紀錄
+
+門檻可用環境變數覆寫（單位見 THRESHOLD_ENV），例如：
+
+    AICARE_ALARM_RSS_MB=1500 AICARE_ALARM_MESSAGES=2000000 streamlit run app.py
+
+啟動時設定 AICARE_TRACEMALLOC=1 會開啟 tracemalloc（有額外負擔，除錯時使用）。
+在 Streamlit 行程內收集才有記憶體數字；命令列只看得到日誌重播後的狀態：
+
+    python store_telemetry.py [--prometheus]
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from dataclasses import dataclass, field, asdict, fields
+from datetime import datetime
+from enum import Enum
+from typing import Dict, List, Optional, Any, Callable, Deque, Tuple
+
+from models import LOCAL_DATA_DIR
+
+# ============================================
+# 設定
+# ============================================
+
+METRICS_PATH = os.path.join(LOCAL_DATA_DIR, "metrics", "store_telemetry.jsonl")
+
+# 每次估計抽樣的快取物件數
+DEFAULT_SAMPLE_SIZE = 200
+
+# 背景收集間隔（秒）
+DEFAULT_INTERVAL = 60.0
+
+# 保留的歷史快照數（側邊欄趨勢用）
+HISTORY_SIZE = 120
+RECENT_ALARMS = 50
+
+# 次要索引：每則訊息約出現在病人 / 日期 / 角色三個 ID 串列
+INDEX_BYTES_PER_MESSAGE = 3 * 8
+
+# 門檻欄位 → 環境變數
+THRESHOLD_ENV = {
+    "max_messages": "AICARE_ALARM_MESSAGES",
+    "max_sessions": "AICARE_ALARM_SESSIONS",
+    "max_approx_mb": "AICARE_ALARM_APPROX_MB",
+    "max_rss_mb": "AICARE_ALARM_RSS_MB",
+    "max_insert_rate": "AICARE_ALARM_INSERT_RATE",
+    "max_detection_pending": "AICARE_ALARM_DETECTION_PENDING",
+}
+
+
+@dataclass
+class TelemetryThresholds:
+    """警報門檻（None 表示不檢查）"""
+    max_messages: Optional[float] = 5_000_000
+    max_sessions: Optional[float] = 500_000
+    max_approx_mb: Optional[float] = 1024
+    max_rss_mb: Optional[float] = 2048
+    max_insert_rate: Optional[float] = 200      # 訊息 / 秒
+    max_detection_pending: Optional[float] = 800
+
+    @classmethod
+    def from_env(cls) -> "TelemetryThresholds":
+        thresholds = cls()
+        for name, env in THRESHOLD_ENV.items():
+            value = os.environ.get(env)
+            if value is None:
+                continue
+            setattr(thresholds, name, None if value.lower() in ("", "none", "off") else float(value))
+        return thresholds
+
+
+# 門檻 → 快照欄位
+_ALARM_FIELDS = {
+    "max_messages": ("messages", "訊息數"),
+    "max_sessions": ("sessions", "會話數"),
+    "max_approx_mb": ("approx_mb", "估計記憶體 (MB)"),
+    "max_rss_mb": ("rss_mb", "行程 RSS (MB)"),
+    "max_insert_rate": ("insert_rate", "寫入速率（訊息/秒）"),
+    "max_detection_pending": ("detection_pending", "待偵測訊息"),
+}
+
+
+# ============================================
+# 大小估計
+# ============================================
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """
+    物件遞迴大小（sys.getsizeof 加總）
+
+    列舉成員為全域共用，不計入；同一物件只算一次
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, Enum) or obj is None or isinstance(obj, bool):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, datetime)):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(deep_sizeof(item, seen) for item in obj)
+
+    slots = getattr(type(obj), "__slots__", ())
+    for name in slots:
+        size += deep_sizeof(getattr(obj, name, None), seen)
+    if hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def _process_rss() -> Optional[int]:
+    """目前行程的常駐記憶體（位元組）；Linux 讀 /proc，其他平台取峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 單位為位元組，Linux 為 KB
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+# ============================================
+# 快照
+# ============================================
+
+@dataclass
+class TelemetrySnapshot:
+    """單次收集結果"""
+    timestamp: str
+    uptime: float = 0.0
+
+    # 筆數
+    messages: int = 0
+    sessions: int = 0
+    responses: int = 0
+    patients: int = 0
+    cached_messages: int = 0
+    cached_responses: int = 0
+    resident_sessions: int = 0
+    spilled_sessions: int = 0
+    session_spill_count: int = 0
+    session_load_count: int = 0
+
+    # 索引
+    fulltext_docs: int = 0
+    fulltext_terms: int = 0
+    near_duplicate_docs: int = 0
+    near_duplicate_clusters: int = 0
+
+    # 背景偵測
+    detection_pending: int = 0
+    detection_processed: int = 0
+    detection_inline: int = 0
+    detection_escalated: int = 0
+
+    # 速率（與上一次收集比較）
+    insert_rate: float = 0.0
+    session_rate: float = 0.0
+
+    # 記憶體（位元組）
+    message_cache_bytes: int = 0
+    response_cache_bytes: int = 0
+    session_bytes: int = 0
+    location_bytes: int = 0
+    index_bytes: int = 0
+    fulltext_bytes: int = 0
+    near_duplicate_bytes: int = 0
+    approx_bytes: int = 0
+    rss_bytes: Optional[int] = None
+    traced_bytes: Optional[int] = None
+    traced_peak_bytes: Optional[int] = None
+    log_bytes: Optional[int] = None
+
+    @property
+    def approx_mb(self) -> float:
+        return self.approx_bytes / 1024 / 1024
+
+    @property
+    def rss_mb(self) -> Optional[float]:
+        return None if self.rss_bytes is None else self.rss_bytes / 1024 / 1024
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class Alarm:
+    """門檻警報"""
+    name: str
+    label: str
+    value: float
+    threshold: float
+    timestamp: str
+
+    @property
+    def message(self) -> str:
+        return f"{self.label} {self.value:,.1f} 超過門檻 {self.threshold:,.0f}"
+
+
+AlarmHandler = Callable[[Alarm], None]
+
+
+class StoreTelemetry:
+    """
+    對話儲存遙測
+
+    collect() 可隨時呼叫（側邊欄重新整理時）；start() 另開背景執行緒定期收集、寫出指標並檢查門檻。
+    """
+
+    def __init__(
+        self,
+        store,
+        thresholds: Optional[TelemetryThresholds] = None,
+        sample_size: int = DEFAULT_SAMPLE_SIZE,
+        metrics_path: Optional[str] = METRICS_PATH,
+        seed: int = 0
+    ):
+        self.store = store
+        self.thresholds = thresholds or TelemetryThresholds.from_env()
+        self.sample_size = sample_size
+        self.metrics_path = metrics_path
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._previous: Optional[Tuple[float, int, int]] = None
+        self._active_alarms: set = set()
+        self._handlers: List[AlarmHandler] = []
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+        self.history: Deque[TelemetrySnapshot] = deque(maxlen=HISTORY_SIZE)
+        self.recent_alarms: Deque[Alarm] = deque(maxlen=RECENT_ALARMS)
+
+    # ============================================
+    # 收集
+    # ============================================
+
+    def _sampled_bytes(self, objects: List[Any], total: int) -> int:
+        if not objects:
+            return 0
+        return int(sum(deep_sizeof(obj) for obj in objects) / len(objects) * total)
+
+    def collect(self) -> TelemetrySnapshot:
+        """收集一次快照（筆數在鎖內讀取，大小估計在鎖外計算）"""
+        store = self.store
+        now = time.monotonic()
+        snapshot = TelemetrySnapshot(timestamp=datetime.now().isoformat(), uptime=now - self._started_at)
+
+        with store._lock:
+            snapshot.messages = len(store.messages)
+            snapshot.sessions = len(store.sessions)
+            snapshot.responses = len(store.open_ended_responses)
+            snapshot.patients = len(store.indexes.patient_stats)
+            snapshot.cached_messages = store.messages.cached_count
+            snapshot.cached_responses = store.open_ended_responses.cached_count
+            snapshot.resident_sessions = store.sessions.resident_count
+            snapshot.spilled_sessions = store.sessions.spilled_count
+            snapshot.session_spill_count = store.sessions.spill_count
+            snapshot.session_load_count = store.sessions.load_count
+            snapshot.session_bytes = store.sessions.resident_bytes
+            snapshot.fulltext_docs = len(store.fulltext)
+            snapshot.fulltext_terms = store.fulltext.term_count
+            snapshot.fulltext_bytes = store.fulltext.approx_bytes()
+            snapshot.near_duplicate_docs = len(store.near_duplicates)
+            snapshot.near_duplicate_clusters = store.near_duplicates.cluster_count
+            snapshot.near_duplicate_bytes = store.near_duplicates.approx_bytes()
+
+            with self._lock:
+                message_sample = store.messages.sample_cached(self.sample_size, self._rng)
+                response_sample = store.open_ended_responses.sample_cached(self.sample_size, self._rng)
+                location_sample = store.messages.sample_keys(self.sample_size, self._rng)
+
+        pool = store.detection_pool
+        if pool is not None:
+            snapshot.detection_pending = pool.pending
+            snapshot.detection_processed = pool.processed
+            snapshot.detection_inline = pool.inline_count
+            snapshot.detection_escalated = pool.escalated
+
+        snapshot.message_cache_bytes = self._sampled_bytes(message_sample, snapshot.cached_messages)
+        snapshot.response_cache_bytes = self._sampled_bytes(response_sample, snapshot.cached_responses)
+        # 位置索引：鍵字串 + 位置 tuple + 字典項目（約 3 個指標）
+        if location_sample:
+            per_entry = sum(deep_sizeof(entry) - sys.getsizeof(entry) for entry in location_sample)
+            per_entry = per_entry / len(location_sample) + 24
+            snapshot.location_bytes = int(per_entry * (snapshot.messages + snapshot.responses))
+        snapshot.index_bytes = snapshot.messages * INDEX_BYTES_PER_MESSAGE
+        snapshot.approx_bytes = (
+            snapshot.message_cache_bytes + snapshot.response_cache_bytes + snapshot.session_bytes
+            + snapshot.location_bytes + snapshot.index_bytes
+            + snapshot.fulltext_bytes + snapshot.near_duplicate_bytes
+        )
+
+        snapshot.rss_bytes = _process_rss()
+        if tracemalloc.is_tracing():
+            snapshot.traced_bytes, snapshot.traced_peak_bytes = tracemalloc.get_traced_memory()
+        if store.storage is not None:
+            try:
+                snapshot.log_bytes = store.storage.total_bytes()
+            except OSError:
+                snapshot.log_bytes = None
+
+        with self._lock:
+            if self._previous is not None:
+                previous_time, previous_messages, previous_sessions = self._previous
+                elapsed = now - previous_time
+                if elapsed > 0:
+                    snapshot.insert_rate = max(0, snapshot.messages - previous_messages) / elapsed
+                    snapshot.session_rate = max(0, snapshot.sessions - previous_sessions) / elapsed
+            self._previous = (now, snapshot.messages, snapshot.sessions)
+            self.history.append(snapshot)
+
+        return snapshot
+
+    # ============================================
+    # 警報
+    # ============================================
+
+    def add_alarm_handler(self, handler: AlarmHandler):
+        """註冊警報處理器（可能於背景執行緒呼叫）"""
+        self._handlers.append(handler)
+
+    def check(self, snapshot: TelemetrySnapshot) -> List[Alarm]:
+        """
+        檢查門檻
+
+        Returns:
+            目前超過門檻的項目；剛越過門檻的項目會通知處理器並記錄
+        """
+        alarms, raised = [], []
+        with self._lock:
+            for name, (attribute, label) in _ALARM_FIELDS.items():
+                threshold = getattr(self.thresholds, name)
+                value = getattr(snapshot, attribute)
+                if threshold is None or value is None:
+                    continue
+                if value <= threshold:
+                    self._active_alarms.discard(name)
+                    continue
+
+                alarm = Alarm(name, label, float(value), float(threshold), snapshot.timestamp)
+                alarms.append(alarm)
+                if name not in self._active_alarms:
+                    self._active_alarms.add(name)
+                    self.recent_alarms.append(alarm)
+                    raised.append(alarm)
+
+        # 處理器在鎖外呼叫（處理器內可再呼叫 collect）
+        for alarm in raised:
+            for handler in self._handlers:
+                handler(alarm)
+        return alarms
+
+    # ============================================
+    # 匯出
+    # ============================================
+
+    def write_metrics(self, snapshot: TelemetrySnapshot):
+        """附加一行 JSON 到指標檔"""
+        if not self.metrics_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.metrics_path)), exist_ok=True)
+        with open(self.metrics_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(snapshot.to_dict(), ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def to_prometheus(snapshot: TelemetrySnapshot, prefix: str = "aicare_store") -> str:
+        """Prometheus 文字格式（gauge）"""
+        lines = []
+        for item in fields(snapshot):
+            value = getattr(snapshot, item.name)
+            if item.name == "timestamp" or value is None:
+                continue
+            lines.append(f"# TYPE {prefix}_{item.name} gauge")
+            lines.append(f"{prefix}_{item.name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def tracemalloc_top(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """tracemalloc 依檔案統計的前幾名（未啟用時為空）"""
+        if not tracemalloc.is_tracing():
+            return []
+        statistics = tracemalloc.take_snapshot().statistics("filename")[:limit]
+        return [
+            {"file": str(stat.traceback[0].filename), "bytes": stat.size, "blocks": stat.count}
+            for stat in statistics
+        ]
+
+    # ============================================
+    # 背景收集
+    # ============================================
+
+    def tick(self) -> Tuple[TelemetrySnapshot, List[Alarm]]:
+        """收集、寫出並檢查門檻"""
+        snapshot = self.collect()
+        self.write_metrics(snapshot)
+        return snapshot, self.check(snapshot)
+
+    def start(self, interval: float = DEFAULT_INTERVAL):
+        """啟動背景收集執行緒（重複呼叫不會建立第二個）"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.tick()
+                except Exception as e:   # 遙測失敗不影響應用
+                    print(f"[telemetry] 收集失敗：{e}", file=sys.stderr)
+
+        self._thread = threading.Thread(target=run, name="store-telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+# ============================================
+# 全域實例
+# ============================================
+
+_telemetry: Optional[StoreTelemetry] = None
+_telemetry_lock = threading.Lock()
+
+
+def get_store_telemetry(start: bool = True) -> StoreTelemetry:
+    """全域對話儲存的遙測（第一次呼叫時建立並啟動背景收集）"""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            if os.environ.get("AICARE_TRACEMALLOC") == "1" and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            from conversation_store import get_conversation_store
+            _telemetry = StoreTelemetry(get_conversation_store())
+            _telemetry.add_alarm_handler(
+                lambda alarm: print(f"[telemetry] ⚠️ {alarm.message}", file=sys.stderr)
+            )
+            if start:
+                _telemetry.start()
+        return _telemetry
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="對話儲存遙測")
+    parser.add_argument("--prometheus", action="store_true", help="輸出 Prometheus 文字格式")
+    args = parser.parse_args()
+
+    telemetry = get_store_telemetry(start=False)
+    snapshot, alarms = telemetry.tick()
+    if args.prometheus:
+        print(telemetry.to_prometheus(snapshot), end="")
+    else:
+        print(json.dumps(snapshot.to_dict(), ensure_ascii=False, indent=2))
+    for alarm in alarms:
+        print(f"⚠️ {alarm.message}")
+    telemetry.store.close()
+
+
+if __name__ == "__main__":
+    main()
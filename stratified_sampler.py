@@ -0,0 +1,94 @@
+"""
+AI-CARE Lung - 分層抽樣模組
+==========================
+功能：
+1. 每個分層各自做水庫抽樣（reservoir sampling），單次串流掃描
+2. 依分層平均分配樣本數；樣本不足的分層把剩餘名額讓給其他分層
+3. 固定亂數種子時結果可重現（同一份資料、同一種子 → 同一批次）
+
+用於從大量訊息中抽出類別平衡的標註批次，不需匯出全部資料。
+
+三軍總醫院 數位醫療中心
+"""
+
+import random
+from typing import Dict, List, Any, Hashable, Iterable, Tuple
+
+
+class StratifiedReservoir:
+    """
+    分層水庫抽樣
+
+    每個分層保留至多 capacity 筆的均勻樣本（Algorithm R）；
+    capacity 設為總樣本數即可保證任何分配方式都有足夠候選。
+    """
+
+    def __init__(self, capacity: int, seed: int = 0):
+        self.capacity = capacity
+        self._rng = random.Random(seed)
+        self._reservoirs: Dict[Hashable, List[Any]] = {}
+        self._seen: Dict[Hashable, int] = {}
+
+    def add(self, stratum: Hashable, item: Any):
+        seen = self._seen.get(stratum, 0) + 1
+        self._seen[stratum] = seen
+
+        reservoir = self._reservoirs.get(stratum)
+        if reservoir is None:
+            reservoir = self._reservoirs[stratum] = []
+
+        if len(reservoir) < self.capacity:
+            reservoir.append(item)
+        else:
+            slot = self._rng.randrange(seen)
+            if slot < self.capacity:
+                reservoir[slot] = item
+
+    def extend(self, pairs: Iterable[Tuple[Hashable, Any]]):
+        for stratum, item in pairs:
+            self.add(stratum, item)
+
+    @property
+    def counts(self) -> Dict[Hashable, int]:
+        """各分層掃描到的總筆數"""
+        return dict(self._seen)
+
+    def sample(self, n: int) -> Dict[Hashable, List[Any]]:
+        """
+        平均分配後從各分層取樣
+
+        Returns:
+            分層 → 樣本（分層依固定順序處理，同樣的輸入與種子得到同樣的結果）
+        """
+        strata = sorted(self._reservoirs, key=repr)
+        quotas = allocate_balanced({s: len(self._reservoirs[s]) for s in strata}, n)
+        return {
+            stratum: self._rng.sample(self._reservoirs[stratum], quotas[stratum])
+            for stratum in strata if quotas[stratum] > 0
+        }
+
+
+def allocate_balanced(available: Dict[Hashable, int], n: int) -> Dict[Hashable, int]:
+    """
+    平均分配 n 個名額（water-filling）
+
+    每個分層先取平均份額；可用筆數不足的分層取完為止，剩下的名額再平均分給其他分層。
+    餘數依分層順序分配。
+    """
+    quotas = {stratum: 0 for stratum in available}
+    remaining = min(n, sum(available.values()))
+    open_strata = [s for s in available if available[s] > 0]
+
+    while remaining > 0 and open_strata:
+        share, extra = divmod(remaining, len(open_strata))
+        still_open = []
+        for i, stratum in enumerate(open_strata):
+            want = share + (1 if i < extra else 0)
+            take = min(want, available[stratum] - quotas[stratum])
+            quotas[stratum] += take
+            remaining -= take
+            if quotas[stratum] < available[stratum]:
+                still_open.append(stratum)
+        open_strata = still_open
+
+    return quotas
@@ -0,0 +1,14 @@
+"""
+AI-CARE Lung - 測試共用設定
+==========================
+模組皆在專案根目錄；本地資料寫到暫存目錄，不碰 local_data/
+
+三軍總醫院 數位醫療中心
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("AICARE_DATA_DIR", tempfile.mkdtemp(prefix="aicare-test-"))
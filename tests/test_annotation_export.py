@@ -0,0 +1,72 @@
+"""標註匯出：已有的多數決只放在唯讀的 consensus_*，回匯時不算成新的標籤"""
+
+from annotation_import import parse_label
+from conversation_store import ConversationStore
+
+
+def test_consensus_not_reimported_as_new_label():
+    store = ConversationStore()
+    message = store.add_patient_message("P001", "今天胸口很痛")
+    store.merge_annotations({
+        message.message_id: {
+            "nurse_a": {"intent": "symptom_report", "emotion": None, "urgency": None,
+                        "entities": None, "time": None},
+            "nurse_b": {"intent": "symptom_report", "emotion": None, "urgency": None,
+                        "entities": None, "time": None},
+        }
+    })
+
+    record = next(store.iter_annotation_export())
+    assert record["consensus_intent"] == "symptom_report"
+    assert record["annotated_intent"] is None
+    # 沒有填寫的列：指定 --annotator 也不會被記成該標註者的標籤
+    assert parse_label(record, default_annotator="nurse_c") is None
+    assert parse_label(record) is None
+
+
+def test_export_interleaves_roles_by_time():
+    store = ConversationStore()
+    expected = []
+    for i in range(3):
+        expected.append(store.add_patient_message("P001", f"第{i}天還是會咳嗽").message_id)
+        expected.append(store.add_ai_message("P001", f"回覆{i}").message_id)
+
+    exported = [r["message_id"] for r in store.iter_annotation_export(include_ai_responses=True)]
+    assert exported == expected
+
+
+def _prefilled_record():
+    store = ConversationStore()
+    store.add_patient_message("P001", "沒有咳嗽，但傷口很痛")
+    record = next(store.iter_annotation_export(prefill_entities=True))
+    assert record["entities_prefilled"] and record["annotated_entities"]
+    return record
+
+
+def test_untouched_prefill_is_not_a_human_label():
+    record = _prefilled_record()
+    record["annotated_intent"] = "symptom_report"
+    record["annotator_id"] = "nurse_a"
+
+    _, annotator, label = parse_label(record)
+    assert annotator == "nurse_a"
+    assert label["intent"] == "symptom_report"
+    assert label["entities"] is None
+
+
+def test_edited_prefill_counts_with_default_annotator():
+    record = _prefilled_record()
+    # 標註者刪掉「很」，其餘保留
+    record["annotated_entities"] = [e for e in record["annotated_entities"] if e["label"] != "severity"]
+
+    _, annotator, label = parse_label(record, default_annotator="nurse_b")
+    assert annotator == "nurse_b"
+    assert [e["label"] for e in label["entities"]] == ["cough", "body_location", "pain"]
+
+
+def test_legacy_prefill_without_hash_compares_with_extractor():
+    record = _prefilled_record()
+    del record["entities_prefill_hash"]
+    record["annotator_id"] = "nurse_a"
+
+    assert parse_label(record) is None
@@ -0,0 +1,39 @@
+"""族群分析：百分等級與逐筆比較的結果一致"""
+
+import numpy as np
+
+from cohort_analytics import CohortAnalytics, SYMPTOM_KEYS
+
+
+def _cohort(patients=40, days=10, seed=0):
+    rng = np.random.default_rng(seed)
+    cube = rng.integers(0, 11, (patients, days, len(SYMPTOM_KEYS))).astype(np.float32)
+    cube[rng.random(cube.shape) < 0.5] = np.nan
+    return CohortAnalytics([f"P{i:03d}" for i in range(patients)], cube)
+
+
+def _brute_force_ranks(scores):
+    counts = (~np.isnan(scores)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        at_or_below = (scores[None, :] <= scores[:, None]).sum(axis=1)
+        return np.where(np.isnan(scores), np.nan, at_or_below / counts * 100)
+
+
+def test_percentile_ranks_match_pairwise_counts():
+    cohort = _cohort()
+    expected = _brute_force_ranks(cohort.scores)
+    np.testing.assert_allclose(cohort.percentile_ranks(), expected, rtol=1e-5)
+
+
+def test_compare_patient_ranks_only_that_patient():
+    cohort = _cohort()
+    result = cohort.compare_patient("P007", post_op_day=3)
+    expected = _brute_force_ranks(cohort.scores)[7, 3]
+
+    assert ("ranks",) not in cohort._cache
+    for s, symptom in enumerate(SYMPTOM_KEYS):
+        rank = result[symptom]["percentile_rank"]
+        if np.isnan(expected[s]):
+            assert rank is None
+        else:
+            assert rank == round(float(expected[s]), 1)
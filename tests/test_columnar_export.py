@@ -0,0 +1,71 @@
+"""欄式匯出：.npz 與 Parquet 讀寫往返"""
+
+import numpy as np
+import pytest
+
+from columnar_export import (
+    MESSAGE_COLUMNS, iter_message_rows, read_npz_columns, write_npz, write_parquet
+)
+from conversation_store import ConversationStore
+
+
+def _store():
+    store = ConversationStore()
+    store.add_patient_message("P001", "傷口今天有點痛")
+    store.add_ai_message("P001", "請問疼痛大約幾分？", template_id="pain_scale")
+    store.add_patient_message("P002", "咳嗽比昨天少")
+    store.add_ai_message("P002", "很好，請繼續觀察")   # template_id 為 None
+    store.add_patient_message("P001", "大概三分")
+    return store
+
+
+@pytest.mark.parametrize("chunk_rows", [2, 65536])
+def test_npz_round_trip(tmp_path, chunk_rows):
+    rows = list(iter_message_rows(_store(), include_ai_responses=True))
+    path = str(tmp_path / "messages.npz")
+
+    # chunk_rows=2：五筆跨三塊，字典代碼與字串位移須跨塊接續
+    assert write_npz(iter(rows), path, chunk_rows=chunk_rows) == 5
+    columns = read_npz_columns(path)
+
+    for i, (name, _) in enumerate(MESSAGE_COLUMNS):
+        assert columns[name].tolist() == [row[i] for row in rows], name
+    assert columns["template_id"].tolist() == [None, "pain_scale", None, None, None]
+
+
+def test_npz_keeps_codes_with_none_as_minus_one(tmp_path):
+    rows = list(iter_message_rows(_store(), include_ai_responses=True))
+    path = str(tmp_path / "messages.npz")
+    write_npz(rows, path, chunk_rows=2)
+
+    codes = read_npz_columns(path, decode=False)
+    assert codes["template_id"].dtype == np.int32
+    assert codes["template_id"].tolist() == [-1, 0, -1, -1, -1]
+    # 動態字典依出現順序編碼
+    assert codes["patient_id"].tolist() == [0, 0, 1, 1, 0]
+    with np.load(path) as data:
+        assert data["template_id__categories"].tolist() == ["pain_scale"]
+
+
+def test_npz_empty_export(tmp_path):
+    path = str(tmp_path / "empty.npz")
+    assert write_npz(iter_message_rows(ConversationStore()), path) == 0
+
+    columns = read_npz_columns(path)
+    assert set(columns) == {name for name, _ in MESSAGE_COLUMNS}
+    assert all(len(values) == 0 for values in columns.values())
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    rows = list(iter_message_rows(_store(), include_ai_responses=True))
+    path = str(tmp_path / "messages.parquet")
+    assert write_parquet(iter(rows), path, chunk_rows=2) == 5
+
+    parquet = pq.ParquetFile(path)
+    assert parquet.num_row_groups == 3
+    table = parquet.read().to_pydict()
+    for i, (name, _) in enumerate(MESSAGE_COLUMNS):
+        assert table[name] == [row[i] for row in rows], name
@@ -0,0 +1,121 @@
+"""對話儲存：多執行緒同時寫入與讀取"""
+
+import sys
+import threading
+
+from columnar_export import iter_message_rows
+from conversation_store import ConversationStore
+from segment_log import SegmentLog
+
+
+def _run_threads(targets):
+    errors = []
+
+    def guarded(target):
+        try:
+            target()
+        except Exception as e:  # 收集後在主執行緒斷言
+            errors.append(e)
+
+    threads = [threading.Thread(target=guarded, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_reads_outside_store_lock_survive_lru_eviction(tmp_path):
+    # 快取極小：讀取幾乎每次都要從日誌讀回並移出其他項目
+    store = ConversationStore(storage=SegmentLog(str(tmp_path)), max_cached_records=5)
+    patients = [f"P{i:03d}" for i in range(4)]
+    for patient_id in patients:
+        store.add_patient_message(patient_id, "第一則")
+    done = threading.Event()
+
+    def write(patient_id):
+        def run():
+            for i in range(200):
+                store.add_patient_message(patient_id, f"傷口第{i}次換藥")
+        return run
+
+    def read(patient_id):
+        def run():
+            while not done.is_set():
+                assert all(m.patient_id == patient_id for m in store.get_patient_messages(patient_id))
+                list(iter_message_rows(store))
+        return run
+
+    writers = [write(patient_id) for patient_id in patients]
+    readers = [read(patient_id) for patient_id in patients]
+
+    def write_all():
+        try:
+            assert not _run_threads(writers)
+        finally:
+            done.set()
+
+    # 頻繁切換執行緒，讓讀寫交錯更容易發生
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        assert _run_threads([write_all] + readers) == []
+        assert len(list(iter_message_rows(store))) == len(patients) * 201
+        for patient_id in patients:
+            assert len(store.get_patient_messages(patient_id)) == 201
+    finally:
+        sys.setswitchinterval(interval)
+        store.close()
+
+
+def test_patient_reads_do_not_wait_for_global_lock():
+    store = ConversationStore()
+    store.add_patient_message("P001", "傷口有點痛")
+    result = {}
+
+    def read():
+        result["stats"] = store.get_patient_stats("P001")
+        result["messages"] = store.get_patient_messages("P001")
+
+    # 全域鎖被占用（例如另一位病人正在附加日誌）時，病人狀態仍可讀取
+    with store._lock:
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    assert result["stats"]["total_messages"] == 1
+    assert len(result["messages"]) == 1
+
+
+def test_concurrent_sessions_keep_aggregates_and_checkpoints_consistent(tmp_path):
+    # 檢查點頻繁觸發：快照須與分片鎖下更新的病人狀態一致
+    store = ConversationStore(storage=SegmentLog(str(tmp_path)), checkpoint_every=7, shard_count=4)
+    patients = [f"P{i:03d}" for i in range(12)]
+
+    def chat(patient_id):
+        def run():
+            for turn in range(3):
+                session = store.start_session(patient_id)
+                for i in range(5):
+                    store.add_patient_message(patient_id, f"第{turn}次 咳嗽{i}天")
+                    store.add_ai_message(patient_id, "請問還有其他不舒服嗎？")
+                store.end_session(session.session_id)
+        return run
+
+    assert _run_threads([chat(patient_id) for patient_id in patients]) == []
+    assert store.check_aggregates() == []
+    expected = {patient_id: store.get_patient_stats(patient_id) for patient_id in patients}
+    for patient_id in patients:
+        assert expected[patient_id]["total_sessions"] == 3
+        assert expected[patient_id]["total_messages"] == 15
+        assert len(store.get_patient_messages(patient_id)) == 30
+    store.close()
+
+    restored = ConversationStore(storage=SegmentLog(str(tmp_path)))
+    try:
+        assert restored.check_aggregates() == []
+        for patient_id in patients:
+            assert restored.get_patient_stats(patient_id) == expected[patient_id]
+            assert not restored.get_current_session(patient_id)
+    finally:
+        restored.close()
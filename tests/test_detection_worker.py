@@ -0,0 +1,37 @@
+"""背景偵測：緊急訊息一定會通知升級處理器"""
+
+from conversation_store import ConversationStore
+from detection_worker import EscalationRecorder
+
+EMERGENCY_TEXT = "我呼吸困難，胸口劇痛，快要喘不過氣"
+
+
+def test_background_emergency_is_recorded(tmp_path):
+    store = ConversationStore()
+    recorder = EscalationRecorder(str(tmp_path / "escalations.jsonl"))
+    pool = store.enable_async_detection(workers=1)
+    pool.add_escalation_handler(recorder)
+    try:
+        message = store.add_patient_message("P001", EMERGENCY_TEXT)
+        # 先以預設標註寫入，偵測結果稍後寫回
+        assert message.detection_version is None
+        pool.flush()
+    finally:
+        store.close()
+
+    assert [r["message_id"] for r in recorder.recent()] == [message.message_id]
+
+
+def test_inline_emergency_is_recorded_when_queue_full(tmp_path, monkeypatch):
+    store = ConversationStore()
+    recorder = EscalationRecorder(str(tmp_path / "escalations.jsonl"))
+    pool = store.enable_async_detection(workers=1)
+    pool.add_escalation_handler(recorder)
+    monkeypatch.setattr(pool, "has_capacity", lambda: False)
+    try:
+        message = store.add_patient_message("P001", EMERGENCY_TEXT)
+        assert message.needs_human_review
+    finally:
+        store.close()
+
+    assert [r["message_id"] for r in recorder.recent()] == [message.message_id]
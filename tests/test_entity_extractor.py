@@ -0,0 +1,19 @@
+"""症狀實體擷取：緊鄰的同標籤片段合併"""
+
+from entity_extractor import entity_extractor
+
+
+def _spans(text):
+    return [(e["text"], e["label"], e["negated"]) for e in entity_extractor.extract_entities(text)]
+
+
+def test_adjacent_same_label_spans_merge():
+    assert _spans("胸口疼痛") == [("胸口", "body_location", False), ("疼痛", "pain", False)]
+
+
+def test_merged_span_keeps_negation():
+    assert _spans("沒有疼痛") == [("疼痛", "pain", True)]
+
+
+def test_different_labels_stay_separate():
+    assert _spans("傷口很痛") == [("傷口", "body_location", False), ("很", "severity", False), ("痛", "pain", False)]
@@ -0,0 +1,65 @@
+"""全文檢索：布林查詢、排除詞與篩選"""
+
+from datetime import date
+
+from fulltext_index import FullTextIndex, ParsedQuery, KIND_MESSAGE, KIND_RESPONSE
+
+DOCS = [
+    # (文件ID, 類型, 病人, 日期, 文字)
+    ("m1", KIND_MESSAGE, "P001", date(2026, 1, 1), "傷口紅腫，有點痛"),
+    ("m2", KIND_MESSAGE, "P001", date(2026, 1, 2), "今天咳血了"),
+    ("m3", KIND_MESSAGE, "P002", date(2026, 1, 3), "有血痰，沒有發燒"),
+    ("m4", KIND_MESSAGE, "P002", date(2026, 1, 4), "傷口痛，沒有發燒但有發冷"),
+    ("r1", KIND_RESPONSE, "P003", date(2026, 1, 5), "傷口還好，會喘"),
+]
+
+
+def _index():
+    index = FullTextIndex()
+    for doc_id, kind, patient_id, doc_date, text in DOCS:
+        index.add(doc_id, kind, patient_id, doc_date, len(text), index.terms(text))
+    return index
+
+
+def _search(query, **filters):
+    """索引候選再以子字串確認（與 ConversationStore.search 相同）"""
+    index = _index()
+    parsed = ParsedQuery(query)
+    texts = {doc_id: text for doc_id, _, _, _, text in DOCS}
+    docs, _ = index.search(parsed, **filters)
+    found = [index.doc(doc)[0] for doc in docs.tolist()]
+    return sorted(doc_id for doc_id in found if parsed.matches(texts[doc_id]))
+
+
+def test_and_requires_every_term():
+    assert _search("傷口 紅腫") == ["m1"]
+    assert _search("傷口") == ["m1", "m4", "r1"]
+
+
+def test_or_unions_clauses():
+    assert _search("咳血 OR 血痰") == ["m2", "m3"]
+
+
+def test_short_exclusion_removed_in_index():
+    index = _index()
+    docs, _ = index.search(ParsedQuery("傷口 -沒有"))
+    assert sorted(index.doc(doc)[0] for doc in docs.tolist()) == ["m1", "r1"]
+
+
+def test_long_exclusion_keeps_bigram_only_matches():
+    # 「沒有」與「發冷」都出現但不相連，不應被排除
+    assert _search("傷口 -沒有發冷") == ["m1", "m4", "r1"]
+    assert _search("傷口 -沒有發燒") == ["m1", "r1"]
+
+
+def test_single_character_query():
+    assert _search("喘") == ["r1"]
+    assert _search("痛") == ["m1", "m4"]
+
+
+def test_date_patient_and_kind_filters():
+    assert _search("傷口", start_date=date(2026, 1, 2)) == ["m4", "r1"]
+    assert _search("傷口", end_date=date(2026, 1, 4)) == ["m1", "m4"]
+    assert _search("傷口", patient_id="P001") == ["m1"]
+    assert _search("傷口", patient_id="P999") == []
+    assert _search("傷口", kind=KIND_RESPONSE) == ["r1"]
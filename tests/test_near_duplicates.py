@@ -0,0 +1,41 @@
+"""近似重複群集：否定詞與數字不同不可同群，語助詞不影響"""
+
+import pytest
+
+from near_duplicates import NearDuplicateIndex
+
+
+@pytest.mark.parametrize("negated, positive", [
+    ("沒有發燒", "有發燒"),
+    ("不會喘", "會喘"),
+    ("今天傷口沒有痛", "今天傷口有痛"),
+])
+def test_negation_pairs_are_separate_clusters(negated, positive):
+    index = NearDuplicateIndex()
+    assert index.add("a", negated) == "a"
+    assert index.add("b", positive) == "b"
+
+
+def test_different_scores_are_separate_clusters():
+    index = NearDuplicateIndex()
+    index.add("a", "5分")
+    assert index.add("b", "6分") == "b"
+
+
+@pytest.mark.parametrize("text", ["5 分", "5分。", "大概5分吧"])
+def test_score_variants_join_one_cluster(text):
+    index = NearDuplicateIndex()
+    index.add("a", "5分")
+    assert index.add("b", text) == "a"
+    assert index.cluster_size("a") == 2
+
+
+def test_snapshot_round_trip_keeps_clusters():
+    index = NearDuplicateIndex()
+    for doc_id, text in [("a", "5分"), ("b", "大概5分吧"), ("c", "沒有發燒")]:
+        index.add(doc_id, text)
+
+    restored = NearDuplicateIndex()
+    assert restored.restore_state(index.export_state())
+    assert restored.cluster_of("b") == "a"
+    assert restored.add("d", "有發燒") == "d"
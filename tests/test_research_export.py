@@ -0,0 +1,44 @@
+"""研究匯出：分批讀取工作表不因批次尾端的空白列提早停止"""
+
+from research_export import iter_sheet_rows
+
+
+class _Worksheet:
+    """模擬 gspread：get 省略範圍尾端的空白列"""
+
+    def __init__(self, rows, row_count=None):
+        self.rows = rows
+        if row_count is not None:
+            self.row_count = row_count
+        self.requests = []
+
+    def row_values(self, index):
+        return self.rows[index - 1]
+
+    def get(self, a1_range):
+        self.requests.append(a1_range)
+        start, end = (int(part) for part in a1_range.split(":"))
+        block = self.rows[start - 1:end]
+        while block and not any(block[-1]):
+            block = block[:-1]
+        return block
+
+
+def test_short_block_does_not_end_the_sheet():
+    # 第一批（2-4 列）尾端是空白列，之後還有資料
+    rows = [["病人ID"], ["A"], ["B"], [], ["C"], ["D"]]
+    sheet = _Worksheet(rows, row_count=len(rows))
+
+    data = [row for row in iter_sheet_rows(sheet, block_size=3) if any(row)]
+
+    assert data == [["病人ID"], ["A"], ["B"], ["C"], ["D"]]
+    assert sheet.requests == ["2:4", "5:6"]
+
+
+def test_without_row_count_stops_on_empty_block():
+    rows = [["病人ID"], ["A"], [], [], ["B"]]
+    sheet = _Worksheet(rows)
+
+    data = [row for row in iter_sheet_rows(sheet, block_size=2) if any(row)]
+
+    assert data == [["病人ID"], ["A"], ["B"]]
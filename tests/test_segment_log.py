@@ -0,0 +1,24 @@
+"""分段日誌：同一目錄只能有一個寫入者"""
+
+import pytest
+
+from segment_log import SegmentLog, LogLockedError
+
+
+def test_second_writer_fails_fast(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    try:
+        with pytest.raises(LogLockedError):
+            SegmentLog(str(tmp_path))
+    finally:
+        log.close()
+
+
+def test_lock_released_on_close(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    position = log.append({"t": "x"})
+    log.close()
+
+    reopened = SegmentLog(str(tmp_path))
+    assert reopened.read_at(position) == {"t": "x"}
+    reopened.close()
@@ -0,0 +1,53 @@
+"""工作表結構：空白數值欄位保留為未填、寫入前核對標題列"""
+
+from research_export import iter_report_records
+from sheet_schema import PATIENTS_SCHEMA, REPORTS_SCHEMA, LayoutCache
+
+
+def _report_row(**values):
+    record = {"report_id": "R1", "patient_id": "P1", "report_date": "2025-01-01"}
+    record.update(values)
+    return REPORTS_SCHEMA.default_layout.encode(record)
+
+
+def test_blank_score_cell_exports_as_missing():
+    rows = [REPORTS_SCHEMA.header, _report_row(pain="", fatigue=0, dyspnea="3", avg_score="")]
+    record = next(iter_report_records(rows))
+    assert record["pain"] is None
+    assert record["fatigue"] == 0
+    assert record["dyspnea"] == 3
+    assert record["avg_score"] is None
+
+
+def test_invalid_score_cell_is_missing():
+    record = REPORTS_SCHEMA.default_layout.decode(_report_row(pain="n/a"))
+    assert record["pain"] is None
+
+
+def test_column_default_applies_to_blank_cells():
+    layout = PATIENTS_SCHEMA.default_layout
+    record = layout.decode(layout.encode({"patient_id": "P1", "password_hash": "x"}))
+    assert record["age"] == 0
+
+
+class _Worksheet:
+    def __init__(self, header):
+        self.id = 1
+        self.title = "病人資料"
+        self.header = header
+
+    def row_values(self, row):
+        return list(self.header)
+
+
+def test_for_write_rebinds_after_column_move():
+    header = list(PATIENTS_SCHEMA.header)
+    worksheet = _Worksheet(header)
+    cache = LayoutCache(ttl=300)
+    assert cache.get(worksheet, PATIENTS_SCHEMA).column("last_login") == header.index("最後登入") + 1
+
+    # 有人把「最後登入」搬到最前面：讀取快取仍是舊位置，寫入前必須改用新位置
+    moved = ["最後登入"] + [title for title in header if title != "最後登入"]
+    worksheet.header = moved
+    assert cache.for_write(worksheet, PATIENTS_SCHEMA).column("last_login") == 1
+    assert cache.get(worksheet, PATIENTS_SCHEMA).column("password_hash") == moved.index("密碼雜湊") + 1
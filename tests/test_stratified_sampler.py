@@ -0,0 +1,61 @@
+"""分層抽樣：名額分配、同種子可重現、標註批次排除已標註的重複句"""
+
+from conversation_store import ConversationStore
+from stratified_sampler import StratifiedReservoir, allocate_balanced
+
+
+def test_allocate_balanced_rolls_over_small_strata():
+    # 平均 4 筆；a 只有 1 筆、b 只有 2 筆，剩下的 5 筆依序分給 c、d
+    quotas = allocate_balanced({"a": 1, "b": 2, "c": 10, "d": 10}, 16)
+    assert quotas == {"a": 1, "b": 2, "c": 7, "d": 6}
+    assert sum(quotas.values()) == 16
+
+
+def test_allocate_balanced_caps_at_available():
+    assert allocate_balanced({"a": 1, "b": 2, "c": 0}, 10) == {"a": 1, "b": 2, "c": 0}
+
+
+def test_allocate_balanced_even_split_with_remainder():
+    assert allocate_balanced({"a": 5, "b": 5, "c": 5}, 7) == {"a": 3, "b": 2, "c": 2}
+
+
+def _reservoir_sample(seed):
+    reservoir = StratifiedReservoir(5, seed)
+    reservoir.extend((i % 3, i) for i in range(300))
+    return reservoir.sample(9)
+
+
+def test_same_seed_gives_same_sample():
+    assert _reservoir_sample(7) == _reservoir_sample(7)
+    assert _reservoir_sample(7) != _reservoir_sample(8)
+    assert {stratum: len(items) for stratum, items in _reservoir_sample(7).items()} == {0: 3, 1: 3, 2: 3}
+
+
+def _store_with_messages():
+    store = ConversationStore()
+    for i in range(40):
+        store.add_patient_message(f"P{i % 4:03d}", f"傷口第{i}天還是會痛")
+    return store
+
+
+def test_sample_for_annotation_same_seed_same_batch():
+    store = _store_with_messages()
+    first = [r["message_id"] for r in store.sample_for_annotation(10, seed=3)]
+    again = [r["message_id"] for r in store.sample_for_annotation(10, seed=3)]
+    assert first == again
+    assert len(set(first)) == 10
+
+
+def test_collapse_duplicates_skips_annotated_member_not_cluster():
+    store = ConversationStore()
+    annotated = store.add_patient_message("P001", "5分")
+    duplicate = store.add_patient_message("P002", "大概5分吧")
+    assert store.near_duplicates.cluster_of(duplicate.message_id) == annotated.message_id
+    store.merge_annotations({annotated.message_id: {"nurse_a": {
+        "intent": "symptom_report", "emotion": None, "urgency": None, "entities": None, "time": None
+    }}})
+
+    batch = store.sample_for_annotation(5, collapse_duplicates=True)
+
+    # 群集第一筆已標註：由未標註的重複句代表群集
+    assert [r["message_id"] for r in batch] == [duplicate.message_id]
@@ -0,0 +1,74 @@
+"""分類器訓練資料：對話儲存中的人工標註"""
+
+import sys
+
+import conversation_store
+from conversation_store import ConversationStore
+from text_classifier import TextClassifier, iter_store_examples, main, train_classifier
+
+
+def _label(intent, emotion=None):
+    return {"intent": intent, "emotion": emotion, "urgency": None, "entities": None, "time": None}
+
+
+def test_store_examples_use_merged_labels():
+    store = ConversationStore()
+    labelled = store.add_patient_message("P001", "傷口今天有點痛")
+    store.add_patient_message("P001", "謝謝")
+    store.merge_annotations({labelled.message_id: {"nurse_a": _label("symptom_report", "anxious")}})
+
+    examples = list(iter_store_examples(store))
+
+    assert examples == [
+        (labelled.message_id, "傷口今天有點痛", {"intent": "symptom_report", "emotion": "anxious"})
+    ]
+
+
+# 兩類意圖各自的訓練文字（用字不重疊，模型應能完全分開）
+MEDICATION_TEXTS = ["止痛藥要飯前吃嗎", "藥吃完了可以再開嗎", "這個藥一天吃幾次", "忘記吃藥怎麼辦"]
+APPOINTMENT_TEXTS = ["下週回診幾點", "門診可以改時間嗎", "我想預約回診", "掛號要帶健保卡嗎"]
+
+
+def _labelled_store():
+    store = ConversationStore()
+    labels = {}
+    for intent, texts in (("medication_question", MEDICATION_TEXTS), ("appointment_related", APPOINTMENT_TEXTS)):
+        for text in texts:
+            message = store.add_patient_message("P001", text)
+            labels[message.message_id] = {"nurse_a": _label(intent)}
+    store.add_patient_message("P001", "今天天氣不錯")  # 未標註，不應進入訓練資料
+    store.merge_annotations(labels)
+    return store
+
+
+def test_store_round_trip_train_then_predict(tmp_path):
+    store = _labelled_store()
+
+    model, report = train_classifier(iter_store_examples(store))
+    assert report["intent"]["train"] == len(MEDICATION_TEXTS) + len(APPOINTMENT_TEXTS)
+    assert report["emotion"]["train"] == 0
+    assert "emotion" not in model.heads
+
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    loaded = TextClassifier.load(path)
+    assert loaded.version == model.version
+
+    intents, _ = loaded.predict_batch(MEDICATION_TEXTS + APPOINTMENT_TEXTS)["intent"]
+    assert intents == (["medication_question"] * len(MEDICATION_TEXTS)
+                       + ["appointment_related"] * len(APPOINTMENT_TEXTS))
+
+
+def test_train_from_store_command(tmp_path, monkeypatch, capsys):
+    store = _labelled_store()
+    monkeypatch.setattr(conversation_store, "get_conversation_store", lambda: store)
+    path = str(tmp_path / "model.npz")
+    monkeypatch.setattr(sys, "argv", [
+        "text_classifier.py", "train", "--from-store", "--holdout", "0", "--output", path
+    ])
+
+    main()
+
+    assert "intent: 訓練 8 筆" in capsys.readouterr().out
+    intents, _ = TextClassifier.load(path).predict_batch(["藥吃完了可以再開嗎"])["intent"]
+    assert intents == ["medication_question"]
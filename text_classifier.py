@@ -0,0 +1,385 @@
+"""
+AI-CARE Lung - 意圖 / 情緒分類器模組
+===================================
+功能：
+1. 字元 n-gram（1-3 字）特徵雜湊：不需詞典，新詞與錯字也有特徵
+2. 多項式單純貝氏（multinomial naive Bayes），以人工標註匯出檔或對話儲存中的標註訓練
+3. 權重存成壓縮 .npz（float16，約 1 MB），匯入模組時載入一次
+4. 向量化 predict_batch：整批文字一次查表加總，可在每則訊息寫入時直接執行
+5. 與關鍵字規則合併：沒有模型、信心不足或規則判定為緊急時沿用規則結果；
+   緊急程度與症狀一律由規則決定
+
+    python text_classifier.py train labels/*.jsonl [--from-store] [--holdout 0.1]
+
+訓練後重新啟動應用即會載入新模型（偵測版本隨模型改變，可再執行 relabel_pipeline.py）。
+
+三軍總醫院 數位醫療中心
+"""
+
+import argparse
+import hashlib
+import os
+import unicodedata
+import warnings
+import zlib
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Tuple
+
+import numpy as np
+
+from models import IntentCategory, EmotionCategory, LOCAL_DATA_DIR
+from keyword_matcher import DetectionResult, keyword_matcher, DETECTION_VERSION as RULES_VERSION
+
+# ============================================
+# 設定
+# ============================================
+
+MODEL_PATH = os.path.join(LOCAL_DATA_DIR, "text_classifier.npz")
+
+# 雜湊特徵數（2 的次方）
+DEFAULT_N_FEATURES = 1 << 16
+NGRAM_SIZES = (1, 2, 3)
+
+# 拉普拉斯平滑
+DEFAULT_ALPHA = 0.1
+
+# 模型信心低於此值時沿用規則結果
+MIN_CONFIDENCE = 0.6
+
+# 分類目標：名稱 → (標註欄位, 列舉類別)
+HEADS = {
+    "intent": ("annotated_intent", IntentCategory),
+    "emotion": ("annotated_emotion", EmotionCategory),
+}
+
+
+# ============================================
+# 特徵
+# ============================================
+
+def _grams(text: str) -> Iterator[str]:
+    # 前後加上邊界符號，句首 / 句尾的字另有特徵
+    padded = "\x02" + unicodedata.normalize("NFKC", text).lower() + "\x03"
+    for n in NGRAM_SIZES:
+        for i in range(len(padded) - n + 1):
+            yield padded[i:i + n]
+
+
+def hash_features(texts: Iterable[str], n_features: int = DEFAULT_N_FEATURES) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    文字 → 稀疏特徵（CSR 格式，重複的 n-gram 重複出現即為計數）
+
+    Returns:
+        (特徵編號 int32, 各文字的起點 indptr int64)
+    """
+    mask = n_features - 1
+    indices: List[int] = []
+    indptr = [0]
+    for text in texts:
+        indices.extend(zlib.crc32(gram.encode("utf-8")) & mask for gram in _grams(text))
+        indptr.append(len(indices))
+    return np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)
+
+
+# ============================================
+# 模型
+# ============================================
+
+class NaiveBayesHead:
+    """
+    單一分類目標的多項式單純貝氏
+
+    weights[特徵, 類別] = log P(特徵 | 類別)；預測時對每則文字的特徵列加總再加上先驗。
+    """
+
+    def __init__(self, classes: List[str], weights: np.ndarray, log_prior: np.ndarray):
+        self.classes = list(classes)
+        self.weights = weights.astype(np.float32)
+        self.log_prior = log_prior.astype(np.float32)
+
+    @classmethod
+    def fit(
+        cls,
+        indices: np.ndarray,
+        indptr: np.ndarray,
+        labels: List[str],
+        n_features: int,
+        alpha: float = DEFAULT_ALPHA
+    ) -> "NaiveBayesHead":
+        classes = sorted(set(labels))
+        codes = {label: i for i, label in enumerate(classes)}
+        y = np.array([codes[label] for label in labels], dtype=np.int64)
+
+        # 每個特徵出現的類別 = 所屬文字的類別
+        feature_class = np.repeat(y, np.diff(indptr))
+        counts = np.bincount(
+            feature_class * n_features + indices, minlength=len(classes) * n_features
+        ).reshape(len(classes), n_features).astype(np.float64)
+
+        smoothed = counts + alpha
+        weights = np.log(smoothed / smoothed.sum(axis=1, keepdims=True)).T
+        log_prior = np.log(np.bincount(y, minlength=len(classes)) / len(y))
+        return cls(classes, weights, log_prior)
+
+    def predict_proba(self, indices: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+        n_docs = len(indptr) - 1
+        scores = np.zeros((n_docs, len(self.classes)), dtype=np.float32)
+        starts = indptr[:-1]
+        nonempty = starts < indptr[1:]
+        if len(indices):
+            # 空文字沒有特徵，reduceat 只取非空文字的起點
+            scores[nonempty] = np.add.reduceat(self.weights[indices], starts[nonempty], axis=0)
+        scores += self.log_prior
+        scores -= scores.max(axis=1, keepdims=True)
+        probs = np.exp(scores)
+        probs /= probs.sum(axis=1, keepdims=True)
+        return probs
+
+
+class TextClassifier:
+    """意圖 / 情緒分類器（共用同一份雜湊特徵）"""
+
+    def __init__(self, heads: Dict[str, NaiveBayesHead], n_features: int = DEFAULT_N_FEATURES):
+        self.heads = heads
+        self.n_features = n_features
+
+        digest = hashlib.sha1(str(n_features).encode("ascii"))
+        for name in sorted(heads):
+            digest.update(name.encode("utf-8"))
+            digest.update("|".join(heads[name].classes).encode("utf-8"))
+            digest.update(heads[name].weights.astype(np.float16).tobytes())
+        self.version = "nb-" + digest.hexdigest()[:8]
+
+    def predict_batch(self, texts: List[str]) -> Dict[str, Tuple[List[str], np.ndarray]]:
+        """
+        整批預測
+
+        Returns:
+            分類目標 → (預測類別值列表, 信心 ndarray)
+        """
+        indices, indptr = hash_features(texts, self.n_features)
+        results = {}
+        for name, head in self.heads.items():
+            probs = head.predict_proba(indices, indptr)
+            best = probs.argmax(axis=1)
+            results[name] = ([head.classes[i] for i in best.tolist()], probs[np.arange(len(best)), best])
+        return results
+
+    # ============================================
+    # 存檔
+    # ============================================
+
+    def save(self, path: str):
+        arrays: Dict[str, Any] = {"n_features": np.array(self.n_features)}
+        for name, head in self.heads.items():
+            arrays[f"{name}__classes"] = np.array(head.classes)
+            arrays[f"{name}__weights"] = head.weights.astype(np.float16)
+            arrays[f"{name}__prior"] = head.log_prior
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TextClassifier":
+        with np.load(path, allow_pickle=False) as data:
+            heads = {
+                name: NaiveBayesHead(
+                    data[f"{name}__classes"].tolist(),
+                    data[f"{name}__weights"],
+                    data[f"{name}__prior"]
+                )
+                for name in HEADS if f"{name}__classes" in data
+            }
+            return cls(heads, int(data["n_features"]))
+
+
+def _load_default() -> Optional[TextClassifier]:
+    if not os.path.exists(MODEL_PATH):
+        return None
+    try:
+        return TextClassifier.load(MODEL_PATH)
+    except (OSError, ValueError, KeyError) as e:
+        warnings.warn(f"無法載入分類模型 {MODEL_PATH}，改用關鍵字規則：{e}")
+        return None
+
+
+# 匯入時載入一次；沒有模型時為 None
+classifier = _load_default()
+
+# 偵測版本：規則版本 + 模型版本（重新標註工作據此找出過期的預設標註）
+DETECTION_VERSION = f"{RULES_VERSION}+{classifier.version}" if classifier else RULES_VERSION
+
+
+# ============================================
+# 偵測（模型 + 規則）
+# ============================================
+
+def detect_batch(texts: List[str], model: Optional[TextClassifier] = None) -> List[DetectionResult]:
+    """
+    整批偵測
+
+    規則先跑一次（緊急程度與症狀、以及沒有模型時的意圖 / 情緒）；
+    模型信心足夠、且規則沒有判定為緊急求助時，意圖 / 情緒改用模型結果。
+    """
+    model = model or classifier
+    results = [keyword_matcher.detect(text) for text in texts]
+    if model is None or not texts:
+        return results
+
+    predictions = model.predict_batch(texts)
+    emergency = [result.intent == IntentCategory.EMERGENCY for result in results]
+    for name, enum_cls in (("intent", IntentCategory), ("emotion", EmotionCategory)):
+        if name not in predictions:
+            continue
+        labels, confidence = predictions[name]
+        confident = (confidence >= MIN_CONFIDENCE).tolist()
+        for result, label, ok, rule_emergency in zip(results, labels, confident, emergency):
+            if ok and not rule_emergency:
+                setattr(result, name, enum_cls(label))
+    return results
+
+
+def detect(text: str) -> DetectionResult:
+    """模組層級偵測函數（可傳入子行程）"""
+    return detect_batch([text])[0]
+
+
+# ============================================
+# 訓練資料
+# ============================================
+
+def iter_export_examples(paths: List[str]) -> Iterator[Tuple[str, str, Dict[str, Optional[str]]]]:
+    """
+    標註匯出檔 → (message_id, 文字, {分類目標: 標籤})
+
+    驗證規則與標註回匯相同，無效或未標註的紀錄略過
+    """
+    from annotation_import import iter_annotation_records, parse_label
+
+    for path in paths:
+        for _, record in iter_annotation_records(path):
+            if not isinstance(record, dict) or not record.get("content"):
+                continue
+            try:
+                parsed = parse_label(record, default_annotator="export")
+            except ValueError:
+                continue
+            if parsed is None:
+                continue
+            message_id, _, label = parsed
+            yield message_id, record["content"], {name: label[name] for name in HEADS}
+
+
+def iter_store_examples(store) -> Iterator[Tuple[str, str, Dict[str, Optional[str]]]]:
+    """
+    對話儲存中已有人工標註的病人訊息
+
+    標籤取自匯出紀錄的 consensus_*（多位標註者的多數決）；匯出的 annotated_* 留給標註者填寫，一律為空
+    """
+    for record in store.iter_annotation_export():
+        labels = {name: record.get(f"consensus_{name}") for name in HEADS}
+        if any(labels.values()):
+            yield record["message_id"], record["content"], labels
+
+
+def _is_holdout(message_id: str, holdout: float) -> bool:
+    # 依 message_id 固定切分，重新訓練時驗證集不變
+    return zlib.crc32(message_id.encode("utf-8")) % 1000 < holdout * 1000
+
+
+def train_classifier(
+    examples: Iterable[Tuple[str, str, Dict[str, Optional[str]]]],
+    n_features: int = DEFAULT_N_FEATURES,
+    alpha: float = DEFAULT_ALPHA,
+    holdout: float = 0.0
+) -> Tuple[TextClassifier, Dict[str, Dict[str, Any]]]:
+    """
+    訓練分類器
+
+    Args:
+        examples: (message_id, 文字, {分類目標: 標籤})
+        holdout: 保留作驗證的比例（依 message_id 雜湊切分）
+
+    Returns:
+        (分類器, 各分類目標的驗證結果 {"train", "test", "model_accuracy", "rules_accuracy"})
+    """
+    train: Dict[str, Tuple[List[str], List[str]]] = {name: ([], []) for name in HEADS}
+    test: Dict[str, Tuple[List[str], List[str]]] = {name: ([], []) for name in HEADS}
+    for message_id, text, labels in examples:
+        split = test if holdout and _is_holdout(message_id, holdout) else train
+        for name, label in labels.items():
+            if label is not None:
+                split[name][0].append(text)
+                split[name][1].append(label)
+
+    heads = {}
+    for name, (texts, labels) in train.items():
+        if labels:
+            indices, indptr = hash_features(texts, n_features)
+            heads[name] = NaiveBayesHead.fit(indices, indptr, labels, n_features, alpha)
+    if not heads:
+        raise ValueError("沒有可用的標註資料")
+    model = TextClassifier(heads, n_features)
+
+    report = {}
+    for name, (texts, labels) in test.items():
+        report[name] = {"train": len(train[name][1]), "test": len(labels)}
+        if not labels or name not in heads:
+            continue
+        combined = detect_batch(texts, model)
+        rules = [keyword_matcher.detect(text) for text in texts]
+        report[name]["model_accuracy"] = float(np.mean(
+            [getattr(result, name).value == label for result, label in zip(combined, labels)]
+        ))
+        report[name]["rules_accuracy"] = float(np.mean(
+            [getattr(result, name).value == label for result, label in zip(rules, labels)]
+        ))
+    return model, report
+
+
+# ============================================
+# 主程式
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="意圖 / 情緒分類器")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="以人工標註訓練並存檔")
+    train_parser.add_argument("paths", nargs="*", help="標註匯出檔（.json / .jsonl，可加 .gz）")
+    train_parser.add_argument("--from-store", action="store_true", help="一併使用對話儲存中的人工標註")
+    train_parser.add_argument("--output", default=MODEL_PATH)
+    train_parser.add_argument("--n-features", type=int, default=DEFAULT_N_FEATURES)
+    train_parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA)
+    train_parser.add_argument("--holdout", type=float, default=0.1, help="驗證集比例")
+
+    predict_parser = subparsers.add_parser("predict", help="預測輸入文字")
+    predict_parser.add_argument("texts", nargs="+")
+    predict_parser.add_argument("--model", default=MODEL_PATH)
+
+    args = parser.parse_args()
+
+    if args.command == "train":
+        sources = [iter_export_examples(args.paths)]
+        if args.from_store:
+            from conversation_store import get_conversation_store
+            sources.append(iter_store_examples(get_conversation_store()))
+        examples = (example for source in sources for example in source)
+
+        model, report = train_classifier(examples, args.n_features, args.alpha, args.holdout)
+        model.save(args.output)
+        print(f"模型 {model.version}：{args.output}（{os.path.getsize(args.output) / 1024:,.0f} KB）")
+        for name, result in report.items():
+            line = f"{name}: 訓練 {result['train']} 筆、驗證 {result['test']} 筆"
+            if "model_accuracy" in result:
+                line += f"，準確率 模型 {result['model_accuracy']:.1%} / 規則 {result['rules_accuracy']:.1%}"
+            print(line)
+    else:
+        model = TextClassifier.load(args.model)
+        for text, result in zip(args.texts, detect_batch(args.texts, model)):
+            print(f"{text}\t{result.intent.value}\t{result.emotion.value}\t{result.urgency.value}")
+
+
+if __name__ == "__main__":
+    main()